@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Compare resuming a huge session from JSON (parsed whole or streamed) and from a binary archive.
+
+Usage:
+    python benchmarks/bench_archive.py [--sizes N [N ...]]
+
+For each size a synthetic session is written both as a single-file JSON
+session and as a .rsa archive. Each load then runs in a fresh interpreter:
+the JSON path parses, validates, de-duplicates and trims the whole file at
+once; the stream path backs the file up and feeds it through
+ContextWindowLoader as load_session does (the file was backed up once
+beforehand, in its own interpreter, so the backup only hashes it; that
+first backup is timed separately); the archive path reads only the tail that fits NUM_CTX and
+MAX_MESSAGES. Wall time and the peak RSS added by the load are
+reported, along with the time to page back to the oldest messages.
+(Retrieval-memory indexing is left out of all three.)
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_tokenizer import REPO_DIR, synthetic_messages
+
+def session_messages(count):
+    """count unique messages drawn from a pool of synthetic ones."""
+    pool = synthetic_messages(min(count, 2000))
+    yield {"role": "system", "content": "You are the narrator of a long story."}
+    for i in range(count):
+        msg = pool[i % len(pool)]
+        yield {"role": msg["role"], "content": f"{msg['content']} ({i})"}
+
+def write_json_session(path, count):
+    with open(path, 'w') as f:
+        f.write('{"version": 1, "facts": [], "story_setting": null, "messages": [')
+        for i, msg in enumerate(session_messages(count)):
+            f.write((", " if i else "") + json.dumps(msg))
+        f.write("]}")
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def child(kind, path):
+    """Load path the given way and print a JSON result line."""
+    sys.path.insert(0, REPO_DIR)
+    import main as story
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if kind == "backup":
+        story.create_backup(path)
+        kept = []
+        page_time = 0.0
+    elif kind == "json":
+        loaded = story.read_session_file(path)["messages"]
+        loaded = story.remove_duplicate_messages(story.validate_messages(loaded))
+        kept = story.MessageHistory(story.trim_messages_to_fit(loaded, story.NUM_CTX, story.MAX_MESSAGES))
+        page_time = 0.0
+    elif kind == "stream":
+        story.create_backup(path)
+        loader = story.ContextWindowLoader(story.NUM_CTX, story.MAX_MESSAGES)
+        story.stream_session_file(path, loader.add)
+        kept = story.MessageHistory(loader.result())
+        page_time = 0.0
+    else:
+        archive = story.SessionArchive(path)
+        tail, _ = archive.tail(story.NUM_CTX, story.MAX_MESSAGES)
+        kept = story.MessageHistory(story.trim_messages_to_fit(tail, story.NUM_CTX, story.MAX_MESSAGES))
+        elapsed = time.perf_counter() - start
+        archive.messages(1, 1 + story.ARCHIVE_PAGE_SIZE)
+        page_time = time.perf_counter() - start - elapsed
+    elapsed = time.perf_counter() - start - page_time
+    print(json.dumps({"time": elapsed, "page": page_time, "rss": peak_rss_mb() - baseline, "kept": len(kept)}))
+
+def measure(kind, path):
+    result = subprocess.run([sys.executable, __file__, "--child", kind, path],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="session sizes in messages")
+    parser.add_argument("--child", nargs=2, metavar=("KIND", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    # main.py creates its working directories on import
+    workdir = tempfile.mkdtemp(prefix="bench_archive_")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import main as story
+
+    print(f"{'':>9} {'JSON':>8} {'1st':>8} {'parse':>18} {'stream':>17} {'archive':>43}")
+    print(f"{'messages':>9} {'MB':>8} {'backup':>8} {'load':>9} {'+RSS MB':>8} {'load':>8} {'+RSS MB':>8} {'MB':>8} {'export':>7} "
+          f"{'load':>8} {'+RSS MB':>8} {'page':>8}")
+    for count in args.sizes:
+        json_path = os.path.join(workdir, f"session_{count}.json")
+        archive_path = os.path.join(workdir, f"session_{count}.rsa")
+        write_json_session(json_path, count)
+        start = time.perf_counter()
+        story.write_session_archive(archive_path, {"messages": session_messages(count)})
+        export_time = time.perf_counter() - start
+        # In a child too: a child inherits the parent's peak RSS as its baseline
+        backup_time = measure("backup", json_path)["time"]
+
+        from_json = measure("json", json_path)
+        streamed = measure("stream", json_path)
+        from_archive = measure("archive", archive_path)
+        if not from_json["kept"] == streamed["kept"] == from_archive["kept"]:
+            raise SystemExit(f"loads disagree: {from_json['kept']}, {streamed['kept']} and "
+                             f"{from_archive['kept']} messages kept")
+        print(f"{count:>9} {os.path.getsize(json_path) / 1e6:>8.1f} {backup_time:>7.1f}s {from_json['time'] * 1000:>7.0f}ms "
+              f"{from_json['rss']:>8.1f} {streamed['time'] * 1000:>6.0f}ms {streamed['rss']:>8.1f} "
+              f"{os.path.getsize(archive_path) / 1e6:>8.1f} {export_time:>6.1f}s "
+              f"{from_archive['time'] * 1000:>6.1f}ms {from_archive['rss']:>8.1f} {from_archive['page'] * 1000:>6.2f}ms")
+        os.remove(json_path)
+        os.remove(archive_path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Benchmark extractive context compression against plain truncation.
+
+Usage:
+    python benchmarks/bench_compression.py [--messages N] [--no-numpy]
+
+A synthetic session is generated in which every exchange states one unique
+fact (a named character finding a named object) somewhere among filler
+sentences. Both methods compress all but the last 20 messages to the same
+token budget; the report shows latency, output size and how many of the
+facts survived.
+
+Extractive compression is linear in the text it scores, at about 0.15 ms per
+synthetic message (~260 tokens), and most of that is tokenizing sentences
+with a regex. 1000 messages take ~150 ms and 2000 ~300 ms, but 5000 (~1.3M
+tokens, ten times NUM_CTX) take 0.6-0.8 s with numpy and ~0.9 s without. So
+"well under a second for thousands of messages" holds only up to about
+3000 messages.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from bench_tokenizer import REPO_DIR, synthetic_messages
+
+SYLLABLES = "ka lo mi ra ve tun sel dor im ash bel qua zen fi or".split()
+
+def invented_name(rng):
+    return "".join(rng.choice(SYLLABLES) for _ in range(3)).capitalize()
+
+def fact_session(count, seed=11):
+    """Synthetic messages, each assistant reply carrying one unique fact at a random position."""
+    rng = random.Random(seed)
+    session = synthetic_messages(count, seed)
+    facts = []
+    for msg in session:
+        if msg["role"] != "assistant":
+            continue
+        who, what = invented_name(rng), invented_name(rng)
+        fact = f"{who} found the {what} relic beneath the old bridge."
+        sentences = msg["content"].split(". ")
+        sentences.insert(rng.randint(0, len(sentences)), fact.rstrip("."))
+        msg["content"] = ". ".join(sentences)
+        facts.append((who, what))
+    return session, facts
+
+def truncate_exchanges(messages_list, threshold=20):
+    """The previous compress_older_messages: first 100/150 characters of each exchange."""
+    system_message, body = messages_list[0], messages_list[1:]
+    recent, older = body[-threshold:], body[:-threshold]
+    compressed = []
+    for i in range(0, len(older) - 1, 2):
+        user_content, assistant_content = older[i]["content"], older[i+1]["content"]
+        compressed.append({"role": "system", "content":
+            f"[COMPRESSED EXCHANGE] User: {user_content[:100]}{'...' if len(user_content) > 100 else ''}\n"
+            f"Assistant: {assistant_content[:150]}{'...' if len(assistant_content) > 150 else ''}"})
+    return [system_message] + compressed + recent
+
+def fact_recall(compressed_messages, facts):
+    words = set(" ".join(msg["content"] for msg in compressed_messages).split())
+    return sum(1 for who, what in facts if who in words and what in words) / len(facts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000, help="synthetic session size")
+    parser.add_argument("--no-numpy", action="store_true", help="force the pure-Python scorer")
+    args = parser.parse_args()
+
+    # main.py creates its working directories on import
+    os.chdir(tempfile.mkdtemp(prefix="bench_compression_"))
+    sys.path.insert(0, REPO_DIR)
+    import main as story
+    if args.no_numpy:
+        story.numpy = None
+
+    session, facts = fact_session(args.messages)
+    session.insert(0, {"role": "system", "content": story.DEFAULT_SYSTEM_MESSAGE})
+    older_facts = facts[:-10]  # The last 20 messages are kept verbatim by both methods
+    recent_tokens = story.calculate_token_usage(session[-20:]) + story.count_message_tokens(session[0])
+
+    start = time.perf_counter()
+    truncated = truncate_exchanges(session)
+    truncate_time = time.perf_counter() - start
+    budget = story.calculate_token_usage(truncated) - recent_tokens
+
+    start = time.perf_counter()
+    extracted = story.compress_older_messages(session, threshold=20, token_budget=budget)
+    extract_time = time.perf_counter() - start
+
+    print(f"{len(session)} messages, ~{story.calculate_token_usage(session)} tokens, "
+          f"scorer: {'numpy' if story.numpy is not None else 'pure Python'}")
+    print(f"{'method':<12} {'time':>10} {'older tokens':>13} {'facts kept':>11}")
+    for name, elapsed, result in (("truncate", truncate_time, truncated), ("extractive", extract_time, extracted)):
+        older = story.calculate_token_usage(result) - recent_tokens
+        print(f"{name:<12} {elapsed * 1000:8.1f} ms {older:>13} {fact_recall(result[1:-20], older_facts):>10.1%}")
+
+if __name__ == "__main__":
+    main()
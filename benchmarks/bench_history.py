@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Benchmark history operations on a large story session.
+
+Usage:
+    python benchmarks/bench_history.py [--session FILE] [--messages N] [--repeat N]
+
+Without --session a synthetic session of N role-play messages is generated.
+Each operation reports its median latency and the peak memory it allocates
+(tracemalloc); the process peak RSS is printed at the end.
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench_tokenizer import REPO_DIR, synthetic_messages
+
+def timed(name, fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<28} {statistics.median(times) * 1000:9.2f} ms   peak alloc {peak / 1e6:7.2f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--session", help="session JSON file to load")
+    parser.add_argument("--messages", type=int, default=5000, help="synthetic session size")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per operation")
+    args = parser.parse_args()
+
+    if args.session:
+        with open(args.session, 'rb') as f:
+            raw = f.read()
+    else:
+        raw = None
+
+    # main.py creates its working directories on import
+    os.chdir(tempfile.mkdtemp(prefix="bench_history_"))
+    sys.path.insert(0, REPO_DIR)
+    import main as story
+
+    if raw is None:
+        session_messages = [{"role": "system", "content": story.DEFAULT_SYSTEM_MESSAGE}]
+        session_messages += synthetic_messages(args.messages)
+        raw = json.dumps({"version": 1, "messages": session_messages}, indent=2)
+
+    def load():
+        data = json.loads(raw)
+        session_messages = data["messages"] if isinstance(data, dict) else data
+        story.messages[:] = story.validate_messages(session_messages)
+
+    def request_body():
+        request = story.assemble_request_messages(story.messages)
+        return story.encode_chat_body(story.MODEL, request, story.resolve_generation_options("chat"))
+
+    encoder = story.ChatBodyEncoder()
+
+    def request_body_reused():
+        # What the client sends on the next turn: the previous body's prefix is copied
+        request = story.assemble_request_messages(story.messages)
+        return encoder.encode(story.MODEL, request, story.resolve_generation_options("chat"))
+
+    def summary_request():
+        summary_messages = story.assemble_request_messages(story.messages).copy()
+        summary_messages.append({"role": "user", "content": "Summarize the story."})
+        return summary_messages
+
+    load()
+    print(f"{len(story.messages)} messages, ~{story.calculate_token_usage(story.messages)} tokens "
+          f"({story.get_tokenizer().name})")
+    timed("load", load, args.repeat)
+    timed("trim", lambda: story.trim_messages_to_fit(story.messages, story.NUM_CTX // 4, None), args.repeat)
+    timed("compress preview", lambda: story.compress_older_messages(story.messages, 20), args.repeat)
+    timed("history backup copy", lambda: story.messages.copy(), args.repeat)
+    timed("summary request", summary_request, args.repeat)
+    timed("request body", request_body, args.repeat)
+    timed("request body (reused)", request_body_reused, args.repeat)
+    story.CONVERSATION_LIMIT = False
+    timed("summary request (full)", summary_request, args.repeat)
+    timed("request body (full)", request_body, args.repeat)
+    timed("request body (full, reused)", request_body_reused, args.repeat)
+    print(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+if __name__ == "__main__":
+    main()
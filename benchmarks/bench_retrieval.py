@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Benchmark the retrieval memory on a long synthetic story.
+
+Usage:
+    python benchmarks/bench_retrieval.py [--messages N] [--window N] [--queries N]
+
+Every assistant reply in the synthetic session states one unique fact (see
+bench_compression.py). Only the last --window messages are treated as sent;
+for facts outside that window a narration naming the character is used as
+the query, and a fact counts as recalled when the recall block contains it.
+Index build, reload and per-turn sync/recall latencies are reported too.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from bench_tokenizer import REPO_DIR
+from bench_compression import fact_session
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000, help="synthetic session size")
+    parser.add_argument("--window", type=int, default=40, help="messages kept in the sent window")
+    parser.add_argument("--queries", type=int, default=200, help="facts probed")
+    args = parser.parse_args()
+
+    # main.py creates its working directories on import
+    os.chdir(tempfile.mkdtemp(prefix="bench_retrieval_"))
+    sys.path.insert(0, REPO_DIR)
+    import main as story
+
+    session, facts = fact_session(args.messages)
+    history = story.MessageHistory([{"role": "system", "content": story.DEFAULT_SYSTEM_MESSAGE}] + session)
+    memory = story.story_memory
+
+    start = time.perf_counter()
+    memory.sync(history)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    memory.sync(history)
+    resync_time = time.perf_counter() - start
+    start = time.perf_counter()
+    memory.load(memory.path)
+    load_time = time.perf_counter() - start
+
+    window = [history[0]] + list(history[-args.window:])
+    older_facts = facts[:-(args.window // 2)]
+    step = max(1, len(older_facts) // args.queries)
+    probes = older_facts[::step][:args.queries]
+    hits = 0
+    times = []
+    for who, what in probes:
+        narration = {"role": "user", "content": f"The Narrator asks where {who} went after that day."}
+        start = time.perf_counter()
+        block = story.build_recall_block(window + [narration])
+        times.append(time.perf_counter() - start)
+        hits += what in block
+
+    print(f"{len(history)} messages, ~{story.calculate_token_usage(history)} tokens, "
+          f"{len(memory.passages)} passages, {os.path.getsize(memory.path) / 1e6:.1f} MB on disk")
+    print(f"index build      {build_time * 1000:9.1f} ms")
+    print(f"per-turn sync    {resync_time * 1000:9.1f} ms")
+    print(f"reload from disk {load_time * 1000:9.1f} ms")
+    print(f"recall           {statistics.median(times) * 1000:9.2f} ms median, "
+          f"{max(times) * 1000:.2f} ms max ({story.RETRIEVAL_SLOT_TOKENS}-token slot)")
+    print(f"facts outside the {args.window}-message window: "
+          f"window only 0.0%, with recall {hits / len(probes):.1%} ({len(probes)} probed)")
+
+if __name__ == "__main__":
+    main()
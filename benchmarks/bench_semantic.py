@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Exercise the semantic memory against a local stand-in embedding server.
+
+Usage:
+    python benchmarks/bench_semantic.py [--messages N] [--dim N] [--window N] [--queries N]
+
+The stand-in answers Ollama's /api/embed with deterministic hashed
+bag-of-words vectors, so no model is needed. The report shows how long the
+background embedder takes for a synthetic session, how many texts reach the
+server again when the session is reloaded, forked or rebuilt from the cache
+(all should be 0), the similarity search latency, and whether passages still
+map to their own rows afterwards.
+"""
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench_tokenizer import REPO_DIR, synthetic_messages
+
+class StandInEmbedder(BaseHTTPRequestHandler):
+    dim = 256
+    texts_embedded = 0
+    requests_served = 0
+
+    @classmethod
+    def embed(cls, text):
+        vector = [0.0] * cls.dim
+        for word in text.lower().split():
+            digest = hashlib.md5(word.strip(".,!?\"'").encode()).digest()
+            vector[int.from_bytes(digest[:4], "little") % cls.dim] += 1.0 if digest[4] & 1 else -1.0
+        return vector
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        type(self).texts_embedded += len(texts)
+        type(self).requests_served += 1
+        payload = json.dumps({"model": body["model"], "embeddings": [self.embed(text) for text in texts]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+def wait_for(semantic):
+    while semantic.thread is not None:
+        time.sleep(0.01)
+    if semantic.error:
+        raise SystemExit(f"embedding failed: {semantic.error}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000, help="synthetic session size")
+    parser.add_argument("--dim", type=int, default=256, help="stand-in embedding dimension")
+    parser.add_argument("--window", type=int, default=40, help="messages in the sent window (sets the search depth)")
+    parser.add_argument("--queries", type=int, default=100, help="passages probed")
+    args = parser.parse_args()
+
+    StandInEmbedder.dim = args.dim
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInEmbedder)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # main.py creates its working directories on import
+    os.chdir(tempfile.mkdtemp(prefix="bench_semantic_"))
+    sys.path.insert(0, REPO_DIR)
+    import main as story
+    if story.numpy is None:
+        raise SystemExit("the semantic memory needs numpy")
+    story.EMBED_URL = f"http://127.0.0.1:{server.server_port}/api/embed"
+    memory = story.story_memory
+    memory.semantic = story.SemanticIndex(memory.path)
+    memory.reset()
+
+    session = synthetic_messages(args.messages)
+    history = story.MessageHistory([{"role": "system", "content": story.DEFAULT_SYSTEM_MESSAGE}] + session)
+
+    start = time.perf_counter()
+    memory.sync(history)
+    queued = time.perf_counter() - start
+    wait_for(memory.semantic)
+    embed_time = time.perf_counter() - start
+    print(f"{len(history)} messages, {len(memory.passages)} passages, dim {args.dim}")
+    print(f"initial embedding    {embed_time:8.2f} s  ({StandInEmbedder.texts_embedded} texts in "
+          f"{StandInEmbedder.requests_served} requests; sync returned after {queued * 1000:.0f} ms)")
+
+    def resent(label, action):
+        before = StandInEmbedder.texts_embedded
+        start = time.perf_counter()
+        action()
+        wait_for(memory.semantic)
+        print(f"{label:<20} {time.perf_counter() - start:8.2f} s  ({StandInEmbedder.texts_embedded - before} texts re-embedded)")
+
+    session_memory = memory.path_for(os.path.join(story.sessions_dir, "bench.json"))
+    resent("save", lambda: memory.save_as(session_memory))
+    resent("reload", lambda: memory.load(session_memory))
+    resent("fork", lambda: (memory.save_as(memory.path_for(os.path.join(story.sessions_dir, "fork.json"))),
+                            memory.load(memory.path)))
+
+    def rebuild_from_cache():
+        memory.semantic.remove_files()
+        memory.load(memory.path)
+    resent("rebuild from cache", rebuild_from_cache)
+
+    # Hashed bag-of-words vectors carry no meaning, so check the plumbing instead:
+    # every probed passage, used as the query, must rank itself first
+    step = max(1, len(memory.passages) // args.queries)
+    probes = list(range(0, len(memory.passages), step))[:args.queries]
+    limit = story.SEMANTIC_TOP_K + 3 * args.window
+    hits = 0
+    times = []
+    for passage_id in probes:
+        start = time.perf_counter()
+        ranked = memory.semantic.rank(memory.passages[passage_id][2], limit)
+        times.append(time.perf_counter() - start)
+        hits += ranked[:1] == [passage_id]
+    matrix = memory.semantic.matrix
+    vector = matrix[0].copy()
+    start = time.perf_counter()
+    for _ in range(20):
+        scores = matrix @ vector
+        story.numpy.argpartition(-scores, limit - 1)[:limit]
+    search_time = (time.perf_counter() - start) / 20
+    print(f"rank (incl. query embedding) {statistics.median(times) * 1000:.2f} ms median, "
+          f"matrix search alone {search_time * 1000:.2f} ms over {matrix.shape[0]} rows")
+    print(f"passages ranking themselves first after the rebuild: {hits}/{len(probes)}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Benchmark token counting throughput on a large story session.
+
+Usage:
+    python benchmarks/bench_tokenizer.py [--session FILE] [--tokenizer PATH] [--messages N]
+
+Without --session a synthetic session of N role-play messages is generated.
+--tokenizer takes a GGUF model file or a tokenizer.json; without it the
+configured TOKENIZER_PATH / local Ollama store is used, falling back to the
+heuristic estimate.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def synthetic_messages(count, seed=7):
+    rng = random.Random(seed)
+    words = ("the lantern flickered as Whiskers crept along the damp corridor, his tail low; "
+             "Oliver hooted softly from the rafters and the old door groaned open onto moonlit "
+             "stone where Elder Oakroot waited with the glowing seed").split()
+    result = []
+    for i in range(count):
+        sentences = []
+        for _ in range(rng.randint(3, 12)):
+            sentence = " ".join(rng.choice(words) for _ in range(rng.randint(6, 20)))
+            sentences.append(rng.choice(['*{}.*', '"{}!"', '{}.', 'Oliver: "{}?"']).format(sentence.capitalize()))
+        result.append({"role": "user" if i % 2 == 0 else "assistant", "content": " ".join(sentences)})
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--session", help="session JSON file to tokenize")
+    parser.add_argument("--tokenizer", help="GGUF model file or tokenizer.json")
+    parser.add_argument("--messages", type=int, default=5000, help="synthetic session size")
+    args = parser.parse_args()
+
+    if args.session:
+        with open(args.session, 'r') as f:
+            data = json.load(f)
+        session_messages = data["messages"] if isinstance(data, dict) else data
+    else:
+        session_messages = synthetic_messages(args.messages)
+    tokenizer_path = os.path.abspath(args.tokenizer) if args.tokenizer else None
+
+    # main.py creates its working directories on import
+    os.chdir(tempfile.mkdtemp(prefix="bench_tokenizer_"))
+    sys.path.insert(0, REPO_DIR)
+    import main as story
+
+    if tokenizer_path:
+        story.TOKENIZER_PATH = tokenizer_path
+    start = time.perf_counter()
+    # Importing main already resolved a tokenizer; load again to time it
+    tokenizer = story._tokenizer = story.load_tokenizer()
+    load_time = time.perf_counter() - start
+
+    texts = [msg["content"] for msg in session_messages]
+    total_chars = sum(len(text) for text in texts)
+    print(f"Tokenizer: {tokenizer.name} (loaded in {load_time:.2f}s)")
+    print(f"Session: {len(texts)} messages, {total_chars / 1e6:.2f}M characters")
+
+    def run(label, count):
+        start = time.perf_counter()
+        tokens = sum(count(text) for text in texts)
+        elapsed = time.perf_counter() - start
+        print(f"{label:<28} {tokens:>10} tokens  {elapsed * 1000:9.1f} ms  "
+              f"{total_chars / elapsed / 1e6:7.2f} MB/s  {tokens / elapsed / 1e3:9.1f} ktok/s")
+        return tokens
+
+    heuristic = story.HeuristicTokenizer()
+    run("heuristic", heuristic.count)
+    if hasattr(tokenizer, "_word_cache"):
+        tokenizer._word_cache.clear()
+    exact = run("tokenizer (cold)", tokenizer.count)
+    run("tokenizer (word cache)", tokenizer.count)
+    story._token_count_cache.clear()
+    story.TOKEN_CACHE_SIZE = max(story.TOKEN_CACHE_SIZE, len(texts))
+    run("estimate_tokens (first)", story.estimate_tokens)
+    run("estimate_tokens (memoized)", story.estimate_tokens)
+
+    if not isinstance(tokenizer, story.HeuristicTokenizer):
+        estimate = sum(heuristic.count(text) for text in texts)
+        print(f"Heuristic error vs tokenizer: {(estimate - exact) / exact * 100:+.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,30 @@ import readline
 import random
 import hashlib
 import logging
+import re
+import struct
+import mmap
+import math
+import zlib
+import sqlite3
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from bisect import bisect_left
+from collections import deque
+from itertools import accumulate, islice
 from copy import deepcopy
+from requests.adapters import HTTPAdapter
+
+try:
+    import regex  # Optional: exact Unicode classes for BPE pre-tokenization
+except ImportError:
+    regex = None
+
+try:
+    import numpy  # Optional: vectorized sentence scoring for context compression
+except ImportError:
+    numpy = None
 
 # Setup logging
 logging.basicConfig(
@@ -21,8 +44,22 @@ logging.basicConfig(
 # Configuration
 API_URL = "http://192.168.50.177:11434/api/chat"
 MODEL = "hf.co/mradermacher/Pantheon-RP-1.8-24b-Small-3.1-i1-GGUF:Q4_K_M"
+# HTTP client
+HTTP_POOL_CONNECTIONS = 1  # Number of hosts to keep connection pools for
+HTTP_POOL_MAXSIZE = 4  # Keep-alive connections kept per host
+HTTP_CONNECT_TIMEOUT = 10  # Seconds; reads are unbounded since prompt evaluation can take minutes
+STREAM_CHUNK_SIZE = 8192  # Max bytes read from the response stream at a time
+PARTIAL_RESPONSE_FILE = "sessions/.partial_response.json"  # Checkpoint of the reply being streamed
+PARTIAL_CHECKPOINT_CHUNKS = 64  # Checkpoint the reply after this many streamed chunks (Ollama sends about one token per chunk)
 # Parameters
-NUM_CTX = 131072
+NUM_CTX = 131072  # Largest context a request may ask for
+# Requests ask for the smallest of these context sizes that fits the prompt plus
+# the reply, so a short story doesn't make the backend reserve a full-size KV
+# cache. Every change reloads the model, so a smaller size is only taken once the
+# request fits well within it. An empty list always sends NUM_CTX.
+NUM_CTX_BUCKETS = [8192, 16384, 32768, 65536, 131072]
+NUM_CTX_SHRINK_RATIO = 0.5  # Shrink only when the request fits in this share of the smaller bucket
+NUM_CTX_MARGIN = 0.1  # Headroom for error in the token estimate
 TEMPERATURE = 0.8
 TOP_K = 40
 TOP_P = 0.85
@@ -33,7 +70,100 @@ MICROSTAT_ETA = 0.1
 #NUM_THREAD = 18
 MAX_MESSAGES = 120
 CONVERSATION_LIMIT = True  # Set to False if you want to disable trimming
-SESSION_FORMAT_VERSION = 1  # For future compatibility checks
+CONTEXT_RESPONSE_RESERVE = 4096  # Tokens kept free for the reply when trimming what is sent
+CONTEXT_TRIM_TARGET = 0.85  # When the sent window overflows, cut it back to this share of the budget
+CHAPTER_MARKER_TITLE = "CHAPTER SUMMARY"  # Messages containing it are pinned when trimming
+COMPRESSION_RATIO = 0.3  # Default share of their tokens that compressed older exchanges keep
+RETRIEVAL_MEMORY = True  # Recall passages from outside the sent window that match the latest narration
+RETRIEVAL_TOP_K = 4  # Passages recalled per turn
+RETRIEVAL_SLOT_TOKENS = 1024  # Prompt budget reserved for recalled passages
+RETRIEVAL_PASSAGE_CHARS = 800  # Messages are indexed in passages of a few sentences up to this size
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEMANTIC_MEMORY = False  # Also recall by embedding similarity (needs numpy and an embedding model)
+EMBED_URL = API_URL.rsplit("/api/", 1)[0] + "/api/embed"
+EMBED_MODEL = "nomic-embed-text"
+EMBED_BATCH_SIZE = 32  # Passages per embedding request
+EMBED_TIMEOUT = 120  # Seconds
+SEMANTIC_TOP_K = 2  # Passages recalled by similarity in addition to the keyword matches
+EMBEDDING_CACHE_FILE = "sessions/.embedding_cache.sqlite3"  # Vectors by text hash, shared by all sessions
+EMBEDDING_CACHE_MAX_ENTRIES = 50000
+SEMANTIC_RETRY_SECONDS = 60  # After an embedding error, wait this long before trying the backend again
+# /summarize keeps a rolling summary and only sends what was added since the last run
+SUMMARY_SEGMENT_TOKENS = 16384  # New history folded into the summary per request
+SUMMARY_MERGE_FANOUT = 4  # Chapter summaries of one level merged into a single summary a level up
+# A never-summarized history longer than one segment is summarized map-reduce style:
+# segments in parallel across these chat endpoints, then the partial summaries merged
+SUMMARY_BACKENDS = [API_URL]
+SUMMARY_PARALLELISM = 2  # Concurrent segment requests per backend
+SUMMARY_CACHE_DIR = "sessions/.summary_cache"  # Finished segment summaries, so interrupted runs resume
+SUMMARY_CACHE_MAX_ENTRIES = 2000
+# Opt-in: summarize the oldest messages on a worker thread once usage crosses the
+# watermark, and swap the result in like /summarize option 4
+AUTO_COMPACT = False
+AUTO_COMPACT_WATERMARK = 0.8  # Share of NUM_CTX
+AUTO_COMPACT_KEEP_RECENT = 10  # Messages left uncompressed
+SESSION_FORMAT_VERSION = 2  # For future compatibility checks; 2 is the segmented format
+SESSION_SEGMENT_MESSAGES = 256  # Messages per segment file of a saved session
+SESSION_READ_CHUNK = 1 << 20  # Characters read at a time when streaming a session file
+ARCHIVE_DIR = "sessions/archives"  # Binary session archives (.rsa), opened with mmap
+ARCHIVE_PAGE_SIZE = 20  # Messages shown per /history page
+# The temp session is an append-only journal; it is folded into a new snapshot
+# after this many entries or bytes
+TEMP_JOURNAL_COMPACT_OPS = 200
+TEMP_JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024
+# Saves run on a background writer; saves of the same file queued within this
+# many seconds of each other are merged into one write
+PERSIST_COALESCE_SECONDS = 0.3
+PERSIST_FLUSH_TIMEOUT = 30  # Seconds to wait for pending saves on exit
+# Backups are stored deduplicated by content; retention keeps the last N copies
+# of each file plus the newest copy of each recent day and week
+BACKUP_STORE_DIR = "sessions/backups/store"
+BACKUP_KEEP_LAST = 10
+BACKUP_KEEP_DAILY = 7
+BACKUP_KEEP_WEEKLY = 8
+BACKUP_COMPRESSION_LEVEL = 6
+BACKUP_READ_CHUNK = 1 << 20  # Bytes hashed at a time when checking whether a file changed
+SESSION_CATALOG_FILE = "sessions/.catalog.sqlite3"  # Metadata index for the load menu
+SESSION_LIST_LIMIT = 40  # Sessions shown per load menu listing
+# Tokenizer: path to a GGUF model file or a tokenizer.json. When unset, the local
+# Ollama model store is searched for MODEL; without a vocabulary the word/char
+# heuristic is used.
+TOKENIZER_PATH = None
+OLLAMA_MODELS_DIR = os.environ.get("OLLAMA_MODELS", os.path.expanduser("~/.ollama/models"))
+TOKEN_CACHE_SIZE = 20000  # Memoized per-text token counts
+# Fit the heuristic estimate to the token counts the server reports back
+TOKEN_CALIBRATION = True
+TOKEN_CALIBRATION_FILE = "sessions/.token_calibration.json"
+CALIBRATION_MIN_SAMPLES = 4  # Samples needed before the correction is applied
+CALIBRATION_REFIT_EVERY = 2  # Refit after this many new samples
+CALIBRATION_DECAY = 0.98  # Weight kept by older samples each time a new one arrives
+# "stable" keeps the already-sent prompt prefix byte-identical so the backend can
+# reuse its KV cache, and sends facts and mid-story prompt changes in a late
+# context block; "inline" rewrites the system prompt in place.
+PROMPT_ASSEMBLY_MODE = "stable"
+SHOW_PROMPT_CACHE_STATS = False  # Print prefix reuse after every reply
+
+# Generation profiles: every request path resolves its options from here.
+# Profiles may only override sampling options; anything in MODEL_LOAD_OPTIONS
+# must stay identical across profiles or the backend reloads the model.
+BASE_GENERATION_OPTIONS = {
+    "num_ctx": NUM_CTX,
+    "temperature": TEMPERATURE,
+    "top_k": TOP_K,
+    "top_p": TOP_P,
+    "min_p": MIN_P,
+    "microstat": MICROSTAT,
+    "microstat_tau": MICROSTAT_TAU,
+    "microstat_eta": MICROSTAT_ETA,
+    #"num_thread": NUM_THREAD
+}
+GENERATION_PROFILES = {
+    "chat": {},
+    "summary": {},
+}
+MODEL_LOAD_OPTIONS = ("num_ctx", "num_batch", "num_gpu", "main_gpu", "num_thread",
+                      "use_mmap", "use_mlock", "low_vram")
 
 # Enhanced system message with more examples for multiple characters and anthropomorphic animals
 DEFAULT_SYSTEM_MESSAGE = """
@@ -127,13 +257,732 @@ Elder Oakroot: "Which is why we need brave hearts, not just old paws. Hazel, you
 Follow these rules to make the story engaging and consistent.
 """
 
+# ===== Tokenizer =====
+
+class HeuristicTokenizer:
+    """Approximate token counts from word and character counts."""
+
+    name = "heuristic"
+    message_overhead = 0
+    calibration_samples = 0  # Server-reported counts the weights were fitted on
+
+    def __init__(self, word_weight=1.0, char_weight=0.25):
+        self.word_weight = word_weight
+        self.char_weight = char_weight
+
+    def count(self, text):
+        words = len(text.split())
+        chars = len(text)
+        # Improved estimation formula considering both word and character counts
+        return int(self.word_weight * words + self.char_weight * chars)
+
+def _bytes_to_unicode():
+    """Map every byte to a printable character, as byte-level BPE vocabularies do."""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    mapping = {}
+    extra = 0
+    for b in range(256):
+        if b in printable:
+            mapping[b] = chr(b)
+        else:
+            mapping[b] = chr(256 + extra)
+            extra += 1
+    return mapping
+
+BYTE_LEVEL_TABLE = str.maketrans({chr(b): c for b, c in _bytes_to_unicode().items()})
+
+# Pre-tokenizer patterns keyed by the GGUF tokenizer.ggml.pre name. The stdlib
+# versions approximate the Unicode property classes (letters, case) for when
+# the optional regex module is missing.
+PRETOKENIZE_PATTERNS = {
+    "default": r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""",
+    "llama-bpe": r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+    "tekken": r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+|[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*|\p{N}| ?[^\s\p{L}\p{N}]+[\r\n/]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+}
+STDLIB_PRETOKENIZE_PATTERNS = {
+    "default": r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""",
+    "llama-bpe": r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|(?:[^\r\n\w]|_)?[^\W\d_]+|\d{1,3}| ?(?:[^\s\w]|_)+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+    "tekken": r"""(?:[^\r\n\w]|_)?[A-Z]*[^\W\d_A-Z]+|(?:[^\r\n\w]|_)?[A-Z]+[^\W\d_A-Z]*|\d| ?(?:[^\s\w]|_)+[\r\n/]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+}
+PRETOKENIZER_ALIASES = {"llama3": "llama-bpe", "llama-v3": "llama-bpe", "gpt2": "default", "gpt-2": "default"}
+
+def compile_pretokenizer(name, source_pattern=None):
+    """Compile the pre-tokenizer regex for a vocabulary."""
+    name = PRETOKENIZER_ALIASES.get(name, name)
+    if name not in PRETOKENIZE_PATTERNS:
+        name = "default"
+    if regex is not None:
+        return regex.compile(source_pattern or PRETOKENIZE_PATTERNS[name])
+    return re.compile(STDLIB_PRETOKENIZE_PATTERNS[name])
+
+class BPETokenizer:
+    """Offline BPE tokenizer for byte-level (GPT-2 style) and SentencePiece vocabularies.
+    
+    Merge priority comes either from a merges list (ranks) or, for SentencePiece
+    vocabularies, from the score of the merged token.
+    """
+
+    WORD_CACHE_SIZE = 100000
+    message_overhead = 0
+
+    def __init__(self, vocab, ranks=None, scores=None, byte_level=True, pretokenizer=None,
+                 add_space_prefix=True, name="bpe"):
+        self.vocab = vocab
+        self.ranks = ranks
+        self.scores = scores
+        self.byte_level = byte_level
+        self.pretokenizer = pretokenizer
+        self.add_space_prefix = add_space_prefix
+        self.name = name
+        self._word_cache = {}
+
+    def _split(self, text):
+        if self.byte_level:
+            return self.pretokenizer.findall(text)
+        # SentencePiece: spaces become "▁" and every word carries its leading marker
+        text = text.replace(" ", "▁")
+        if self.add_space_prefix and not text.startswith("▁"):
+            text = "▁" + text
+        return re.findall("▁[^▁]*|[^▁]+", text)
+
+    def _rank(self, left, right):
+        if self.ranks is not None:
+            return self.ranks.get((left, right))
+        score = self.scores.get(left + right)
+        return None if score is None else -score
+
+    def _count_word(self, word):
+        symbols = list(word.encode("utf-8").decode("latin-1").translate(BYTE_LEVEL_TABLE)) if self.byte_level else list(word)
+        while len(symbols) > 1:
+            best = None
+            best_rank = None
+            for i in range(len(symbols) - 1):
+                rank = self._rank(symbols[i], symbols[i + 1])
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best, best_rank = i, rank
+            if best is None:
+                break
+            symbols[best:best + 2] = [symbols[best] + symbols[best + 1]]
+        if self.byte_level:
+            return len(symbols)
+        # Byte fallback for pieces missing from a SentencePiece vocabulary
+        return sum(1 if symbol in self.vocab else len(symbol.encode("utf-8")) for symbol in symbols)
+
+    def count(self, text):
+        total = 0
+        cache = self._word_cache
+        for word in self._split(text):
+            tokens = cache.get(word)
+            if tokens is None:
+                tokens = self._count_word(word)
+                if len(cache) >= self.WORD_CACHE_SIZE:
+                    cache.clear()
+                cache[word] = tokens
+            total += tokens
+        return total
+
+GGUF_SCALAR_FORMATS = {0: "B", 1: "b", 2: "H", 3: "h", 4: "I", 5: "i", 6: "f", 7: "?", 10: "Q", 11: "q", 12: "d"}
+
+def _read_gguf_string(f):
+    length, = struct.unpack("<Q", f.read(8))
+    return f.read(length).decode("utf-8", errors="replace")
+
+def _read_gguf_value(f, value_type):
+    if value_type == 8:
+        return _read_gguf_string(f)
+    if value_type == 9:
+        item_type, count = struct.unpack("<IQ", f.read(12))
+        if item_type in (8, 9):
+            return [_read_gguf_value(f, item_type) for _ in range(count)]
+        fmt = GGUF_SCALAR_FORMATS[item_type]
+        return list(struct.unpack(f"<{count}{fmt}", f.read(struct.calcsize(fmt) * count)))
+    fmt = GGUF_SCALAR_FORMATS[value_type]
+    return struct.unpack(f"<{fmt}", f.read(struct.calcsize(fmt)))[0]
+
+def read_gguf_metadata(path):
+    """Read the key/value metadata of a GGUF file without touching the tensor data."""
+    with open(path, "rb") as f:
+        if f.read(4) != b"GGUF":
+            raise ValueError(f"{path} is not a GGUF file")
+        version, = struct.unpack("<I", f.read(4))
+        if version < 2:
+            raise ValueError(f"Unsupported GGUF version {version}")
+        _tensor_count, kv_count = struct.unpack("<QQ", f.read(16))
+        metadata = {}
+        for _ in range(kv_count):
+            key = _read_gguf_string(f)
+            value_type, = struct.unpack("<I", f.read(4))
+            metadata[key] = _read_gguf_value(f, value_type)
+    return metadata
+
+def load_gguf_tokenizer(path):
+    """Build a tokenizer from the vocabulary stored in a GGUF model file."""
+    metadata = read_gguf_metadata(path)
+    model = metadata.get("tokenizer.ggml.model")
+    tokens = metadata.get("tokenizer.ggml.tokens")
+    if not tokens:
+        raise ValueError(f"No tokenizer vocabulary in {path}")
+    
+    if model == "gpt2":
+        merges = metadata.get("tokenizer.ggml.merges", [])
+        ranks = {tuple(merge.split(" ", 1)): i for i, merge in enumerate(merges)}
+        pre = metadata.get("tokenizer.ggml.pre", "default")
+        return BPETokenizer(set(tokens), ranks=ranks, pretokenizer=compile_pretokenizer(pre),
+                            name=f"gguf bpe ({pre})")
+    if model == "llama":
+        scores = metadata.get("tokenizer.ggml.scores") or [0.0] * len(tokens)
+        return BPETokenizer(set(tokens), scores=dict(zip(tokens, scores)), byte_level=False,
+                            add_space_prefix=metadata.get("tokenizer.ggml.add_space_prefix", True),
+                            name="gguf sentencepiece")
+    raise ValueError(f"Unsupported tokenizer model '{model}' in {path}")
+
+def load_hf_tokenizer(path):
+    """Build a tokenizer from a Hugging Face tokenizer.json file."""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    model = data.get("model", {})
+    if model.get("type") != "BPE":
+        raise ValueError(f"Unsupported tokenizer type '{model.get('type')}' in {path}")
+    
+    ranks = {}
+    for i, merge in enumerate(model.get("merges", [])):
+        pair = tuple(merge.split(" ", 1)) if isinstance(merge, str) else tuple(merge)
+        ranks[pair] = i
+    
+    pre_tokenizer = json.dumps(data.get("pre_tokenizer"))
+    if "ByteLevel" in pre_tokenizer:
+        split_patterns = re.findall(r'"Regex": ("(?:[^"\\]|\\.)*")', pre_tokenizer)
+        source_pattern = json.loads(split_patterns[0]) if split_patterns else None
+        name = "tekken" if source_pattern and "\\p{Lu}" in source_pattern else (
+            "llama-bpe" if source_pattern and "\\p{N}{1,3}" in source_pattern else "default")
+        return BPETokenizer(set(model.get("vocab", {})), ranks=ranks,
+                            pretokenizer=compile_pretokenizer(name, source_pattern), name=f"tokenizer.json bpe ({name})")
+    return BPETokenizer(set(model.get("vocab", {})), ranks=ranks, byte_level=False,
+                        add_space_prefix="Prepend" in json.dumps(data.get("normalizer")),
+                        name="tokenizer.json sentencepiece")
+
+def find_ollama_model_blob(model_name):
+    """Return the GGUF blob of a model pulled into the local Ollama store, if any."""
+    name, _, tag = model_name.partition(":")
+    parts = name.split("/")
+    if len(parts) == 1:
+        parts = ["registry.ollama.ai", "library"] + parts
+    elif len(parts) == 2:
+        parts = ["registry.ollama.ai"] + parts
+    manifest_path = os.path.join(OLLAMA_MODELS_DIR, "manifests", *parts, tag or "latest")
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    for layer in manifest.get("layers", []):
+        if layer.get("mediaType") == "application/vnd.ollama.image.model":
+            blob = os.path.join(OLLAMA_MODELS_DIR, "blobs", layer["digest"].replace(":", "-"))
+            if os.path.exists(blob):
+                return blob
+    return None
+
+class TokenCalibrator:
+    """Fit a per-model correction of the heuristic estimate from server-reported token counts.
+    
+    Keeps a decaying least-squares fit of tokens ~ words, characters and message
+    count, ridge-regularized toward the uncalibrated formula.
+    """
+
+    PRIOR = [1.0, 0.25, 0.0]
+    RIDGE = 0.001
+
+    def __init__(self, path):
+        self.path = path
+        self.models = {}
+        try:
+            with open(path, 'r') as f:
+                self.models = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Error loading token calibration: {str(e)}")
+
+    def _state(self, model):
+        return self.models.setdefault(model, {
+            "xtx": [[0.0] * 3 for _ in range(3)],
+            "xty": [0.0] * 3,
+            "samples": 0,
+            "coefficients": None
+        })
+
+    def add_sample(self, model, words, chars, message_count, actual):
+        """Record one observation; return True when the fitted correction changed."""
+        state = self._state(model)
+        x = (words, chars, message_count)
+        for i in range(3):
+            state["xty"][i] = state["xty"][i] * CALIBRATION_DECAY + x[i] * actual
+            for j in range(3):
+                state["xtx"][i][j] = state["xtx"][i][j] * CALIBRATION_DECAY + x[i] * x[j]
+        state["samples"] += 1
+        if state["samples"] < CALIBRATION_MIN_SAMPLES or state["samples"] % CALIBRATION_REFIT_EVERY:
+            return False
+        return self.refit(model)
+
+    def refit(self, model):
+        state = self._state(model)
+        # Solve (XtX + R) b = XtY + R * prior with a scale-aware diagonal ridge R
+        matrix = [row[:] for row in state["xtx"]]
+        vector = state["xty"][:]
+        for i in range(3):
+            ridge = self.RIDGE * (matrix[i][i] + 1.0)
+            matrix[i][i] += ridge
+            vector[i] += ridge * self.PRIOR[i]
+        coefficients = solve_linear_system(matrix, vector)
+        if coefficients is None:
+            return False
+        coefficients = [max(0.0, c) for c in coefficients]
+        previous = state["coefficients"] or self.PRIOR
+        state["coefficients"] = coefficients
+        self.save()
+        changed = any(abs(new - old) > 0.02 * max(abs(old), 0.05) for new, old in zip(coefficients, previous))
+        if changed:
+            logging.info(f"Token calibration for {model}: {coefficients[0]:.3f}*words + "
+                         f"{coefficients[1]:.3f}*chars + {coefficients[2]:.1f}/message "
+                         f"({state['samples']} samples)")
+        return changed
+
+    def coefficients(self, model):
+        state = self.models.get(model)
+        if not state or state["samples"] < CALIBRATION_MIN_SAMPLES:
+            return None
+        return state["coefficients"]
+
+    def apply(self, tokenizer, model):
+        """Load the fitted correction for a model into a heuristic tokenizer."""
+        coefficients = self.coefficients(model)
+        if coefficients is None or not isinstance(tokenizer, HeuristicTokenizer):
+            return False
+        tokenizer.word_weight, tokenizer.char_weight, tokenizer.message_overhead = coefficients
+        tokenizer.calibration_samples = self.models[model]["samples"]
+        return True
+
+    def save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self.models, f)
+        except OSError as e:
+            logging.error(f"Error saving token calibration: {str(e)}")
+
+def solve_linear_system(matrix, vector):
+    """Solve a small dense linear system by Gaussian elimination; None if singular."""
+    n = len(vector)
+    rows = [matrix[i][:] + [vector[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            return None
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    solution = [0.0] * n
+    for i in reversed(range(n)):
+        solution[i] = (rows[i][n] - sum(rows[i][j] * solution[j] for j in range(i + 1, n))) / rows[i][i]
+    return solution
+
+token_calibrator = TokenCalibrator(TOKEN_CALIBRATION_FILE)
+
+def load_tokenizer():
+    """Load the configured tokenizer, falling back to the heuristic estimate."""
+    path = TOKENIZER_PATH or find_ollama_model_blob(MODEL)
+    if path:
+        try:
+            if path.endswith(".json"):
+                tokenizer = load_hf_tokenizer(path)
+            else:
+                tokenizer = load_gguf_tokenizer(path)
+            logging.info(f"Loaded {tokenizer.name} tokenizer from {path}")
+            return tokenizer
+        except Exception as e:
+            logging.error(f"Error loading tokenizer from {path}: {str(e)}")
+    logging.info("No tokenizer vocabulary available, using heuristic token estimation")
+    tokenizer = HeuristicTokenizer()
+    if TOKEN_CALIBRATION:
+        token_calibrator.apply(tokenizer, MODEL)
+    return tokenizer
+
+_tokenizer = None
+_token_count_cache = {}
+_token_generation = 0  # Bumped whenever cached token counts become stale
+# Held while counting and while invalidating counts: summary and compaction
+# threads count tokens while the main thread may refit the calibration
+token_lock = threading.RLock()
+
+def get_tokenizer():
+    """Return the active tokenizer, loading it on first use."""
+    global _tokenizer
+    if _tokenizer is None:
+        with token_lock:
+            if _tokenizer is None:
+                _tokenizer = load_tokenizer()
+                reset_token_counts()
+    return _tokenizer
+
+def reset_token_counts():
+    """Invalidate every memoized token count after the tokenizer changed."""
+    global _token_generation
+    _token_count_cache.clear()
+    _token_generation += 1
+
+# ===== End Tokenizer =====
+
+# ===== Token Accounting =====
+
+def estimate_tokens(text):
+    """Estimate token count from text."""
+    if not text:
+        return 0
+    with token_lock:
+        count = _token_count_cache.get(text)
+        if count is None:
+            count = get_tokenizer().count(text)
+            if len(_token_count_cache) >= TOKEN_CACHE_SIZE:
+                _token_count_cache.pop(next(iter(_token_count_cache)), None)
+            _token_count_cache[text] = count
+    return count
+
+def count_message_tokens(msg):
+    """Estimate the token count of a single message."""
+    if isinstance(msg, Message):
+        return msg.token_count()
+    with token_lock:
+        return estimate_tokens(msg.get("content", "")) + round(get_tokenizer().message_overhead)
+
+def record_token_feedback(request_messages, response_text, final_chunk, shared_messages):
+    """Feed the server's token counts for a request into the heuristic calibration.
+    
+    The server only evaluates the prompt past the prefix it had cached, so the
+    prompt sample is the messages after the first shared_messages.
+    """
+    tokenizer = get_tokenizer()
+    if not TOKEN_CALIBRATION or not isinstance(tokenizer, HeuristicTokenizer):
+        return
+    
+    changed = False
+    eval_count = final_chunk.get("eval_count")
+    if eval_count and response_text:
+        changed |= token_calibrator.add_sample(MODEL, len(response_text.split()), len(response_text), 0, eval_count)
+    
+    prompt_eval_count = final_chunk.get("prompt_eval_count")
+    evaluated = request_messages[shared_messages:]
+    if prompt_eval_count and evaluated:
+        estimate = calculate_token_usage(evaluated)
+        # A ratio far from 1 means the server reused a different prefix than assumed
+        if estimate and 0.5 <= prompt_eval_count / estimate <= 2.0:
+            words = sum(len(msg["content"].split()) for msg in evaluated)
+            chars = sum(len(msg["content"]) for msg in evaluated)
+            changed |= token_calibrator.add_sample(MODEL, words, chars, len(evaluated), prompt_eval_count)
+    
+    if changed:
+        # Cached counts were made with the old coefficients
+        with token_lock:
+            if token_calibrator.apply(tokenizer, MODEL):
+                reset_token_counts()
+                messages.recount()
+
+def calculate_token_usage(messages_list):
+    """Calculate estimated token usage for all messages."""
+    if not messages_list:
+        return 0
+    
+    if isinstance(messages_list, MessageHistory):
+        return messages_list.token_total
+    return sum(count_message_tokens(msg) for msg in messages_list)
+
+def message_token_counts(messages_list):
+    """Return the estimated token count of each message."""
+    if isinstance(messages_list, MessageHistory):
+        return list(messages_list.tokens)
+    return [count_message_tokens(msg) for msg in messages_list]
+
+def validate_message(msg):
+    """Validate that a message has the correct format."""
+    if isinstance(msg, Message):
+        return True
+    if not isinstance(msg, dict):
+        return False
+    if 'role' not in msg or 'content' not in msg:
+        return False
+    if msg['role'] not in ['system', 'user', 'assistant']:
+        return False
+    if not isinstance(msg['content'], str):
+        return False
+    return True
+
+class Message:
+    """Immutable chat message record.
+    
+    Reads like the {"role", "content"} dict it replaces, but is never changed
+    in place: MessageHistory.set_content swaps in a new record. Roles are
+    interned, and the digest, token count and JSON fragment are computed at
+    most once per record, so copies of the history share all of it.
+    """
+    __slots__ = ("role", "content", "_digest", "_tokens", "_token_generation", "_json")
+    FIELDS = ("role", "content")
+
+    def __init__(self, role, content):
+        self.role = sys.intern(role)
+        self.content = content
+        self._digest = None
+        self._tokens = None
+        self._token_generation = -1
+        self._json = None
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return (("role", self.role), ("content", self.content))
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            return self.role == other.role and self.content == other.content
+        if isinstance(other, dict):
+            return other == self.to_dict()
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.role, self.content))
+
+    def __repr__(self):
+        return f"Message({self.role!r}, {self.content[:40]!r}{'...' if len(self.content) > 40 else ''})"
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def digest(self):
+        """MD5 of role and content, used to find duplicates."""
+        if self._digest is None:
+            self._digest = hashlib.md5(f"{self.role}:{self.content}".encode()).hexdigest()
+        return self._digest
+
+    def token_count(self):
+        """Estimated tokens, recomputed only when the tokenizer changed."""
+        with token_lock:
+            if self._token_generation != _token_generation:
+                self._tokens = estimate_tokens(self.content) + round(get_tokenizer().message_overhead)
+                self._token_generation = _token_generation
+            return self._tokens
+
+    def to_json(self):
+        """The message serialized as a JSON object."""
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), ensure_ascii=False)
+        return self._json
+
+def as_message(msg):
+    """Convert a valid message dict to a Message record; anything else is returned as is."""
+    if isinstance(msg, Message) or not validate_message(msg):
+        return msg
+    return Message(msg["role"], msg["content"])
+
+def json_default(obj):
+    """json.dump hook that writes Message records as plain objects."""
+    if isinstance(obj, Message):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def message_json(msg):
+    """JSON fragment for a message, cached when it is a Message record."""
+    return msg.to_json() if isinstance(msg, Message) else json.dumps(msg, ensure_ascii=False)
+
+def is_pinned_message(msg):
+    """Summaries, compressed exchanges and chapter markers survive trimming."""
+    return msg["role"] == "system" or CHAPTER_MARKER_TITLE in msg["content"]
+
+def token_index(messages_list):
+    """Prefix sums of message token counts plus pinned indexes and their cumulative counts."""
+    if isinstance(messages_list, MessageHistory):
+        pins, pin_sums = messages_list.pinned()
+        return messages_list.prefix_sums(), pins, pin_sums
+    tokens = message_token_counts(messages_list)
+    prefix = [0]
+    prefix.extend(accumulate(tokens))
+    pins = [i for i in range(1, len(messages_list)) if is_pinned_message(messages_list[i])]
+    pin_sums = [0]
+    pin_sums.extend(accumulate(tokens[i] for i in pins))
+    return prefix, pins, pin_sums
+
+class MessageHistory(list):
+    """Chat history that caches a token count per message and keeps a running total.
+    
+    Messages are stored as Message records; dicts are converted on the way in.
+    Use set_content() to change the text of a message.
+    """
+
+    def __init__(self, iterable=()):
+        super().__init__(as_message(msg) for msg in iterable)
+        self.tokens = [count_message_tokens(msg) for msg in self]
+        self.token_total = sum(self.tokens)
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop the prefix-sum and pin indexes; they are rebuilt on next use."""
+        self._prefix = None
+        self._pins = None
+
+    def prefix_sums(self):
+        """Cumulative token counts: prefix_sums()[i] is the total of the first i messages."""
+        if self._prefix is None:
+            self._prefix = [0]
+            self._prefix.extend(accumulate(self.tokens))
+        return self._prefix
+
+    def pinned(self):
+        """Indexes of pinned messages and the cumulative token counts of those pins."""
+        if self._pins is None:
+            pins = [i for i in range(1, len(self)) if is_pinned_message(self[i])]
+            pin_sums = [0]
+            pin_sums.extend(accumulate(self.tokens[i] for i in pins))
+            self._pins = (pins, pin_sums)
+        return self._pins
+
+    def append(self, msg):
+        msg = as_message(msg)
+        super().append(msg)
+        tokens = count_message_tokens(msg)
+        self.tokens.append(tokens)
+        self.token_total += tokens
+        # Appends are the common case, so extend the indexes instead of rebuilding them
+        if self._prefix is not None:
+            self._prefix.append(self._prefix[-1] + tokens)
+        if self._pins is not None and len(self) > 1 and is_pinned_message(msg):
+            self._pins[0].append(len(self) - 1)
+            self._pins[1].append(self._pins[1][-1] + tokens)
+
+    def extend(self, iterable):
+        new_messages = [as_message(msg) for msg in iterable]
+        super().extend(new_messages)
+        new_tokens = [count_message_tokens(msg) for msg in new_messages]
+        self.tokens.extend(new_tokens)
+        self.token_total += sum(new_tokens)
+        self.invalidate()
+
+    def __iadd__(self, iterable):
+        self.extend(iterable)
+        return self
+
+    def insert(self, index, msg):
+        msg = as_message(msg)
+        super().insert(index, msg)
+        tokens = count_message_tokens(msg)
+        self.tokens.insert(index, tokens)
+        self.token_total += tokens
+        self.invalidate()
+
+    def pop(self, index=-1):
+        msg = super().pop(index)
+        self.token_total -= self.tokens.pop(index)
+        self.invalidate()
+        return msg
+
+    def remove(self, msg):
+        del self[self.index(msg)]
+
+    def clear(self):
+        super().clear()
+        self.tokens.clear()
+        self.token_total = 0
+        self.invalidate()
+
+    def reverse(self):
+        super().reverse()
+        self.tokens.reverse()
+        self.invalidate()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [as_message(msg) for msg in value]
+            new_tokens = [count_message_tokens(msg) for msg in value]
+            old_total = sum(self.tokens[index])
+        else:
+            value = as_message(value)
+            new_tokens = count_message_tokens(value)
+            old_total = self.tokens[index]
+        super().__setitem__(index, value)
+        self.tokens[index] = new_tokens
+        self.token_total += (sum(new_tokens) if isinstance(index, slice) else new_tokens) - old_total
+        self.invalidate()
+
+    def __delitem__(self, index):
+        removed = self.tokens[index]
+        super().__delitem__(index)
+        del self.tokens[index]
+        self.token_total -= sum(removed) if isinstance(index, slice) else removed
+        self.invalidate()
+
+    def set_content(self, index, content):
+        """Replace a message with a copy holding new content and update its cached token count."""
+        list.__setitem__(self, index, Message(self[index]["role"], content))
+        tokens = count_message_tokens(self[index])
+        self.token_total += tokens - self.tokens[index]
+        self.tokens[index] = tokens
+        self.invalidate()
+
+    def recount(self):
+        """Recompute every cached token count."""
+        self.tokens = [count_message_tokens(msg) for msg in self]
+        self.token_total = sum(self.tokens)
+        self.invalidate()
+
+    def copy(self):
+        clone = MessageHistory()
+        list.extend(clone, self)
+        clone.tokens = list(self.tokens)
+        clone.token_total = self.token_total
+        return clone
+
+    def __deepcopy__(self, memo):
+        clone = MessageHistory()
+        list.extend(clone, deepcopy(list(self), memo))
+        clone.tokens = list(self.tokens)
+        clone.token_total = self.token_total
+        return clone
+
+# ===== End Token Accounting =====
+
 # Initialize chat history
-messages = [
+messages = MessageHistory([
     {
         "role": "system",
         "content": DEFAULT_SYSTEM_MESSAGE
     }
-]
+])
 
 # Session management
 current_session_name = "default"
@@ -144,6 +993,8 @@ facts_dir = "sessions/facts"  # Directory to store story facts
 backup_dir = "sessions/backups"  # Directory for backups
 current_story = None
 current_facts = []  # List to store current story facts (max 15)
+pending_system_prompt = None  # System prompt change made mid-story in stable assembly mode
+current_archive = None  # SessionArchive the session was resumed from, paged by /history
 
 # New directory for world templates (world descriptions)
 world_templates_dir = "world_templates"
@@ -166,9 +1017,98 @@ signal.signal(signal.SIGINT, signal_handler)
 
 # ===== World Template Management Functions =====
 
+class MetadataIndex:
+    """Title, summary and token size of every JSON file in a directory.
+
+    Entries are validated against each file's mtime and size, so a listing
+    only parses files that changed, and against the tokenizer's name, which
+    calibration leaves unchanged so a refit does not re-read every file. The
+    index is kept in memory and cached in <directory>/.index.json between runs.
+    """
+
+    def __init__(self, directory, describe):
+        self.directory = directory
+        self.describe = describe
+        self.cache_path = os.path.join(directory, ".index.json")
+        self.index = None
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path, 'r') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def entries(self):
+        """Return (filename, metadata) pairs sorted by filename; metadata is None for unreadable files."""
+        if self.index is None:
+            self.load_cache()
+        if not os.path.isdir(self.directory):
+            return []
+        
+        tokenizer_name = get_tokenizer().name
+        changed = False
+        current = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json') or entry.name.startswith('.') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            meta = self.index.get(entry.name)
+            if not meta or meta["mtime_ns"] != stat.st_mtime_ns or meta["size"] != stat.st_size \
+                    or meta.get("tokenizer") != tokenizer_name:
+                meta = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "tokenizer": tokenizer_name,
+                        "data": None}
+                try:
+                    with open(entry.path, 'r') as f:
+                        data = json.load(f)
+                    if isinstance(data, dict):
+                        meta["data"] = self.describe(data)
+                except Exception as e:
+                    logging.warning(f"Could not index {entry.path}: {str(e)}")
+                changed = True
+            current[entry.name] = meta
+        
+        if changed or len(current) != len(self.index):
+            self.index = current
+            try:
+                write_json_atomic(self.cache_path, current, indent=None)
+            except Exception as e:
+                logging.error(f"Error writing index cache {self.cache_path}: {str(e)}")
+        return [(name, current[name]["data"]) for name in sorted(current)]
+
+    def filenames(self):
+        return [name for name, _ in self.entries()]
+
+def summarize_text(text, length=60):
+    """First words of a text on one line."""
+    text = " ".join(str(text or "").split())
+    return text if len(text) <= length else text[:length - 3].rstrip() + "..."
+
+def describe_world_template(template):
+    description = template.get("description", "")
+    return {"title": template.get("title") or "Untitled", "summary": summarize_text(description),
+            "tokens": estimate_tokens(description)}
+
+def describe_story_setting(story):
+    return {"title": story.get("title") or "Untitled", "summary": summarize_text(story.get("world")),
+            "tokens": estimate_tokens(story.get("system_prompt", ""))}
+
+template_index = MetadataIndex(world_templates_dir, describe_world_template)
+story_setting_index = MetadataIndex(story_settings_dir, describe_story_setting)
+
+def print_index_entries(entries, current_title=None):
+    """Print a numbered menu from MetadataIndex entries, skipping unreadable files."""
+    for i, (filename, meta) in enumerate(entries, 1):
+        if not meta:
+            continue
+        marker = " (current)" if current_title and meta["title"].lower() == current_title.lower() else ""
+        print(f"{i}. {meta['title']}{marker} - {meta['tokens']} tokens")
+        if meta["summary"]:
+            print(f"   {meta['summary']}")
+
 def list_world_templates():
     """Return a list of world template filenames."""
-    return [f for f in os.listdir(world_templates_dir) if f.endswith('.json')]
+    return template_index.filenames()
 
 def load_world_template(filename):
     filepath = os.path.join(world_templates_dir, filename)
@@ -226,16 +1166,14 @@ def create_world_template():
         return None
 
 def edit_world_template(selection=None):
-    templates = list_world_templates()
+    entries = template_index.entries()
+    templates = [filename for filename, _ in entries]
     if not templates:
         print("No world templates available to edit.")
         return
     if selection is None:
         print("\nAvailable World Templates:")
-        for i, tmpl in enumerate(templates, 1):
-            t = load_world_template(tmpl)
-            if t:
-                print(f"{i}. {t.get('title', 'Untitled')}")
+        print_index_entries(entries)
         try:
             sel = input("Enter the number of the world template to edit (or press Enter to cancel): ")
             if not sel:
@@ -289,16 +1227,14 @@ def edit_world_template(selection=None):
         print(f"Error updating template: {str(e)}")
 
 def delete_world_template(selection=None):
-    templates = list_world_templates()
+    entries = template_index.entries()
+    templates = [filename for filename, _ in entries]
     if not templates:
         print("No world templates available to delete.")
         return
     if selection is None:
         print("\nAvailable World Templates:")
-        for i, tmpl in enumerate(templates, 1):
-            t = load_world_template(tmpl)
-            if t:
-                print(f"{i}. {t.get('title', 'Untitled')}")
+        print_index_entries(entries)
         try:
             sel = input("Enter the number of the world template to delete (or press Enter to cancel): ")
             if not sel:
@@ -348,15 +1284,13 @@ def choose_world_description():
             print("\nInput cancelled. Returning empty description.")
             return ""
         if choice == '1':
-            templates = list_world_templates()
+            entries = template_index.entries()
+            templates = [filename for filename, _ in entries]
             if not templates:
                 print("No world templates available.")
                 continue
             print("\nAvailable World Templates:")
-            for i, tmpl in enumerate(templates, 1):
-                t = load_world_template(tmpl)
-                if t:
-                    print(f"{i}. {t.get('title', 'Untitled')}")
+            print_index_entries(entries)
             sel = input("Enter the number of the world template to use: ").strip()
             if sel.isdigit():
                 index = int(sel) - 1
@@ -400,34 +1334,329 @@ def choose_world_description():
 
 # Helper Functions
 
+class BackupStore:
+    """Content-addressed, deduplicated backups.
+
+    Files are split into chunks (one per message for session files, the whole
+    file otherwise), each unique chunk is stored once zlib-compressed under
+    objects/ by its SHA-256, and every backup is a small manifest listing its
+    chunks. Retention prunes old manifests and unreferenced chunks are
+    garbage-collected. Backups are made from both the interactive thread and
+    the background writer, so every store operation holds the lock: otherwise
+    GC could delete chunks another backup has written but not yet listed.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.manifests_dir = os.path.join(root, "manifests")
+        self.file_chunks = {}  # (path, mtime_ns, size) -> digest of files stored whole
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def source_key(source):
+        """Directory name for a source path's manifests."""
+        return "".join(c if c.isalnum() or c in "._-" else "_" for c in source.replace(os.sep, "__"))
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:] + ".z")
+
+    def put_chunk(self, data):
+        """Store a chunk once and return its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(data, BACKUP_COMPRESSION_LEVEL))
+            os.replace(tmp_path, path)
+        return digest
+
+    def get_chunk(self, digest):
+        with open(self.object_path(digest), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Backup chunk {digest[:12]} is corrupted")
+        return data
+
+    @staticmethod
+    def split(raw):
+        """Chunk a file by message when it is a session JSON written by this script."""
+        try:
+            data = json.loads(raw)
+        except (ValueError, UnicodeDecodeError):
+            return "raw", [raw]
+        # Only chunk when restoring would reproduce the exact same bytes
+        if json.dumps(data, indent=2).encode() != raw:
+            return "raw", [raw]
+        if isinstance(data, list):
+            return "list", [json.dumps(item).encode() for item in data]
+        if isinstance(data, dict) and isinstance(data.get("messages"), list):
+            header = dict(data, messages=None)
+            return "session", [json.dumps(header).encode()] + [json.dumps(msg).encode() for msg in data["messages"]]
+        return "raw", [raw]
+
+    @staticmethod
+    def join(layout, chunks):
+        """Inverse of split; a segmented session comes back as a single-file one."""
+        if layout == "raw":
+            return b"".join(chunks)
+        if layout == "segmented":
+            data = json.loads(chunks[0])
+            for field in SEGMENTED_HEADER_FIELDS:
+                data.pop(field, None)
+            data["version"] = 1
+            data["messages"] = [msg for chunk in chunks[1:] for msg in json.loads(chunk)]
+            return json.dumps(data, indent=2).encode()
+        if layout == "list":
+            data = [json.loads(chunk) for chunk in chunks]
+        else:
+            data = json.loads(chunks[0])
+            data["messages"] = [json.loads(chunk) for chunk in chunks[1:]]
+        return json.dumps(data, indent=2).encode()
+
+    def manifests(self, source_key):
+        """Manifest paths for a source, newest first."""
+        directory = os.path.join(self.manifests_dir, source_key)
+        if not os.path.isdir(directory):
+            return []
+        names = sorted((f for f in os.listdir(directory) if f.endswith('.json')), reverse=True)
+        return [os.path.join(directory, name) for name in names]
+
+    def sources(self):
+        if not os.path.isdir(self.manifests_dir):
+            return []
+        return sorted(d for d in os.listdir(self.manifests_dir) if self.manifests(d))
+
+    @staticmethod
+    def read_manifest(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def unchanged_manifest(self, key, file_hash):
+        """The newest manifest for key when it already holds file_hash, else None."""
+        existing = self.manifests(key)
+        if existing and self.read_manifest(existing[0]).get("sha256") == file_hash:
+            return existing[0]
+        return None
+
+    def add_bytes(self, source, raw):
+        """Back up raw bytes under a source name; returns the manifest path."""
+        key = self.source_key(source)
+        file_hash = hashlib.sha256(raw).hexdigest()
+        with self.lock:
+            unchanged = self.unchanged_manifest(key, file_hash)
+            if unchanged:
+                return unchanged
+
+            layout, chunks = self.split(raw)
+            return self.write_manifest(source, key, len(raw), file_hash, layout, [self.put_chunk(chunk) for chunk in chunks])
+
+    def put_file_chunk(self, path):
+        """Store a whole file as one chunk, skipping the read when it is unchanged since last time."""
+        stat = os.stat(path)
+        cache_key = (path, stat.st_mtime_ns, stat.st_size)
+        digest = self.file_chunks.get(cache_key)
+        if digest is None or not os.path.exists(self.object_path(digest)):
+            with open(path, 'rb') as f:
+                digest = self.put_chunk(f.read())
+            self.file_chunks[cache_key] = digest
+        return digest
+
+    def add_segmented(self, filepath, header_raw, segment_paths):
+        """Back up a segmented session: its header and each segment file as chunks."""
+        key = self.source_key(filepath)
+        header_hash = hashlib.sha256(header_raw).hexdigest()
+        with self.lock:
+            # The header names every segment by content, so it identifies the whole session
+            unchanged = self.unchanged_manifest(key, header_hash)
+            if unchanged:
+                return unchanged
+            chunks = [self.put_chunk(header_raw)] + [self.put_file_chunk(path) for path in segment_paths]
+            size = len(header_raw) + sum(os.path.getsize(path) for path in segment_paths)
+            return self.write_manifest(filepath, key, size, header_hash, "segmented", chunks)
+
+    def write_manifest(self, source, key, size, file_hash, layout, chunks):
+        """Record a backup of chunks already stored; call with the lock held."""
+        now = datetime.datetime.now()
+        manifest = {
+            "source": source,
+            "created": now.isoformat(),
+            "size": size,
+            "sha256": file_hash,
+            "layout": layout,
+            "chunks": chunks
+        }
+        directory = os.path.join(self.manifests_dir, key)
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, now.strftime("%Y%m%d_%H%M%S_%f") + ".json")
+        write_json_atomic(manifest_path, manifest)
+
+        if self.apply_retention(key):
+            self.collect_garbage()
+        return manifest_path
+
+    def add_file(self, filepath):
+        """Back up a file; an unchanged one is only hashed, in BACKUP_READ_CHUNK pieces."""
+        file_hash = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(BACKUP_READ_CHUNK), b""):
+                file_hash.update(block)
+        with self.lock:
+            unchanged = self.unchanged_manifest(self.source_key(filepath), file_hash.hexdigest())
+        if unchanged:
+            return unchanged
+
+        with open(filepath, 'rb') as f:
+            raw = f.read()
+        segment_paths = session_segment_paths(filepath, raw)
+        if segment_paths is not None:
+            return self.add_segmented(filepath, raw, segment_paths)
+        return self.add_bytes(filepath, raw)
+
+    def restore(self, manifest_path):
+        """Rebuild the backed-up bytes and check them against the manifest."""
+        with self.lock:
+            manifest = self.read_manifest(manifest_path)
+            chunks = [self.get_chunk(d) for d in manifest["chunks"]]
+        raw = self.join(manifest["layout"], chunks)
+        # Chunks are verified as they are read; a segmented manifest hashes only the header
+        if manifest["layout"] != "segmented" and hashlib.sha256(raw).hexdigest() != manifest["sha256"]:
+            raise ValueError("Restored backup does not match its manifest")
+        return manifest, raw
+
+    @staticmethod
+    def select_retained(created_times):
+        """Indexes to keep from newest-first timestamps: last N plus daily and weekly copies."""
+        keep = set(range(min(BACKUP_KEEP_LAST, len(created_times))))
+        days, weeks = set(), set()
+        for i, created in enumerate(created_times):
+            day = created.date()
+            week = created.isocalendar()[:2]
+            if day not in days and len(days) < BACKUP_KEEP_DAILY:
+                days.add(day)
+                keep.add(i)
+            if week not in weeks and len(weeks) < BACKUP_KEEP_WEEKLY:
+                weeks.add(week)
+                keep.add(i)
+        return keep
+
+    def apply_retention(self, source_key):
+        """Delete manifests outside the retention policy; True if any were removed."""
+        paths = self.manifests(source_key)
+        created_times = []
+        for path in paths:
+            stamp = os.path.basename(path)[:-5]
+            created_times.append(datetime.datetime.strptime(stamp, "%Y%m%d_%H%M%S_%f"))
+        keep = self.select_retained(created_times)
+        removed = 0
+        for i, path in enumerate(paths):
+            if i not in keep:
+                os.remove(path)
+                removed += 1
+        if removed:
+            logging.info(f"Backup retention removed {removed} old backups of {source_key}")
+        return removed > 0
+
+    def collect_garbage(self):
+        """Delete chunks no manifest references."""
+        with self.lock:
+            return self.collect_unreferenced()
+
+    def collect_unreferenced(self):
+        referenced = set()
+        for key in self.sources():
+            for path in self.manifests(key):
+                try:
+                    referenced.update(self.read_manifest(path)["chunks"])
+                except Exception as e:
+                    # Keep everything if a manifest cannot be read
+                    logging.error(f"Backup GC skipped, unreadable manifest {path}: {str(e)}")
+                    return 0
+        removed = 0
+        if not os.path.isdir(self.objects_dir):
+            return 0
+        for prefix in os.listdir(self.objects_dir):
+            directory = os.path.join(self.objects_dir, prefix)
+            for name in os.listdir(directory):
+                if name.endswith(".z") and prefix + name[:-2] not in referenced:
+                    os.remove(os.path.join(directory, name))
+                    removed += 1
+        if removed:
+            logging.info(f"Backup GC removed {removed} unreferenced chunks")
+        return removed
+
+backup_store = BackupStore(BACKUP_STORE_DIR)
+
 def create_backup(filepath):
     """Create a backup of the specified file."""
     if not os.path.exists(filepath):
         return
     
-    filename = os.path.basename(filepath)
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_filename = f"{filename}_{timestamp}.bak"
-    backup_filepath = os.path.join(backup_dir, backup_filename)
-    
     try:
-        with open(filepath, 'r') as src, open(backup_filepath, 'w') as dst:
-            dst.write(src.read())
-        logging.info(f"Created backup: {backup_filepath}")
+        manifest_path = backup_store.add_file(filepath)
+        logging.info(f"Created backup: {manifest_path}")
     except Exception as e:
         logging.error(f"Error creating backup for {filepath}: {str(e)}")
 
-def validate_message(msg):
-    """Validate that a message has the correct format."""
-    if not isinstance(msg, dict):
-        return False
-    if 'role' not in msg or 'content' not in msg:
-        return False
-    if msg['role'] not in ['system', 'user', 'assistant']:
-        return False
-    if not isinstance(msg['content'], str):
-        return False
-    return True
+def manage_backups():
+    """List backed-up files and restore a chosen version."""
+    sources = backup_store.sources()
+    if not sources:
+        print("No backups found.")
+        return
+    
+    print("\nBacked-up files:")
+    for i, key in enumerate(sources, 1):
+        versions = backup_store.manifests(key)
+        latest = backup_store.read_manifest(versions[0])
+        print(f"{i}. {latest['source']} ({len(versions)} versions)")
+    
+    try:
+        choice = input("\nEnter file number (or press Enter to cancel): ")
+        if not choice:
+            return
+        choice = int(choice)
+        if choice < 1 or choice > len(sources):
+            print("Invalid selection.")
+            return
+        
+        versions = backup_store.manifests(sources[choice-1])
+        print("\nVersions:")
+        for i, path in enumerate(versions, 1):
+            manifest = backup_store.read_manifest(path)
+            created = manifest["created"][:19].replace("T", " ")
+            print(f"{i}. {created} - {manifest['size']} bytes, {len(manifest['chunks'])} chunks")
+        
+        choice = input("\nEnter version number to restore (or press Enter to cancel): ")
+        if not choice:
+            return
+        choice = int(choice)
+        if choice < 1 or choice > len(versions):
+            print("Invalid selection.")
+            return
+        
+        manifest, raw = backup_store.restore(versions[choice-1])
+        target = manifest["source"]
+        if os.path.sep not in target:
+            target = os.path.join(backup_dir, f"restored_{target}.json")
+        
+        confirm = input(f"Restore to {target}? The current file is backed up first. (y/n): ").lower()
+        if confirm != 'y':
+            print("Restore cancelled.")
+            return
+        
+        create_backup(target)
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(raw)
+        print(f"Restored {target}")
+    except ValueError as e:
+        print(f"Could not restore backup: {str(e)}")
+    except Exception as e:
+        logging.error(f"Error restoring backup: {str(e)}")
+        print(f"Error restoring backup: {str(e)}")
 
 def validate_messages(messages_list):
     """Validate all messages in the list and return valid ones."""
@@ -445,6 +1674,8 @@ def validate_messages(messages_list):
 
 def get_message_hash(msg):
     """Generate a hash for a message to detect duplicates."""
+    if isinstance(msg, Message):
+        return msg.digest()
     if not validate_message(msg):
         return None
     
@@ -469,6 +1700,790 @@ def remove_duplicate_messages(messages_list):
     
     return unique_messages
 
+class SessionCatalog:
+    """SQLite index of saved sessions so menus never parse session files.
+
+    save_session and save_temp_session write rows directly; files changed
+    outside the script are re-indexed lazily when their mtime or size differs.
+    """
+    SORT_COLUMNS = {
+        "modified": "mtime_ns DESC",
+        "name": "name COLLATE NOCASE",
+        "story": "story_title COLLATE NOCASE, mtime_ns DESC",
+        "messages": "message_count DESC",
+        "tokens": "token_count DESC"
+    }
+
+    def __init__(self, path, directory):
+        self.path = path
+        self.directory = directory
+        self.unsaved_path = None  # Session already flagged as having unsaved changes
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            path TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            story_title TEXT,
+            message_count INTEGER,
+            token_count INTEGER,
+            facts_count INTEGER,
+            saved_at TEXT,
+            preview TEXT,
+            unsaved_at TEXT,
+            unsaved_messages INTEGER
+        )""")
+        connection.execute("CREATE INDEX IF NOT EXISTS sessions_mtime ON sessions (mtime_ns)")
+        return connection
+
+    @staticmethod
+    def describe(session_data):
+        """Catalog fields for parsed session data (modern or legacy format)."""
+        if isinstance(session_data, dict) and "segments" in session_data:
+            # A segmented session header carries its counts, so segments are never read
+            story = session_data.get("story_setting") or {}
+            return {
+                "story_title": story.get("title") if isinstance(story, dict) else None,
+                "message_count": session_data.get("message_count"),
+                "token_count": session_data.get("token_count"),
+                "facts_count": len(session_data.get("facts") or []),
+                "saved_at": session_data.get("timestamp"),
+                "preview": session_data.get("preview") or ""
+            }
+        if isinstance(session_data, dict):
+            session_messages = validate_messages(session_data.get("messages", []))
+            story = session_data.get("story_setting") or {}
+            facts = session_data.get("facts") or []
+            saved_at = session_data.get("timestamp")
+        else:
+            session_messages = validate_messages(session_data)
+            story, facts, saved_at = {}, [], None
+        preview = ""
+        for msg in reversed(session_messages):
+            if msg["role"] == "assistant":
+                preview = " ".join(msg["content"].split())[:80]
+                break
+        return {
+            "story_title": story.get("title") if isinstance(story, dict) else None,
+            "message_count": len(session_messages),
+            "token_count": calculate_token_usage(session_messages),
+            "facts_count": len(facts),
+            "saved_at": saved_at,
+            "preview": preview
+        }
+
+    def row_for(self, filepath, fields, stat=None):
+        stat = stat or os.stat(filepath)
+        return dict(fields, path=filepath, name=os.path.basename(filepath)[:-5],
+                    mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+    @staticmethod
+    def upsert(connection, rows):
+        connection.executemany(
+            "INSERT OR REPLACE INTO sessions (path, name, mtime_ns, size, story_title, message_count, "
+            "token_count, facts_count, saved_at, preview, unsaved_at, unsaved_messages) VALUES "
+            "(:path, :name, :mtime_ns, :size, :story_title, :message_count, :token_count, "
+            ":facts_count, :saved_at, :preview, NULL, NULL)", rows)
+
+    def record(self, filepath, fields):
+        """Insert or replace the row for a session file."""
+        if filepath == self.unsaved_path:
+            self.unsaved_path = None
+        connection = self.connect()
+        try:
+            with connection:
+                self.upsert(connection, [self.row_for(filepath, fields)])
+        finally:
+            connection.close()
+
+    def note_unsaved(self, filepath, message_count):
+        """Flag a cataloged session as having newer unsaved changes in the temp session."""
+        if not filepath or filepath == self.unsaved_path:
+            return
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("UPDATE sessions SET unsaved_at = ?, unsaved_messages = ? WHERE path = ?",
+                                   (datetime.datetime.now().isoformat(), message_count, filepath))
+        finally:
+            connection.close()
+        self.unsaved_path = filepath
+
+    def clear_unsaved(self):
+        """Drop the unsaved-changes flag once the temp session is saved or discarded.
+        
+        There is only one temp session, so every flagged row belongs to it.
+        """
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("UPDATE sessions SET unsaved_at = NULL, unsaved_messages = NULL "
+                                   "WHERE unsaved_at IS NOT NULL")
+        finally:
+            connection.close()
+        self.unsaved_path = None
+
+    def refresh(self):
+        """Re-index new or changed session files and drop deleted ones."""
+        connection = self.connect()
+        try:
+            known = {path: (mtime_ns, size) for path, mtime_ns, size in
+                     connection.execute("SELECT path, mtime_ns, size FROM sessions")}
+            seen = set()
+            changed = []
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith('.json') or entry.name.startswith('.') or not entry.is_file():
+                    continue
+                filepath = os.path.join(self.directory, entry.name)
+                seen.add(filepath)
+                stat = entry.stat()
+                if known.get(filepath) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                try:
+                    with open(filepath, 'r') as f:
+                        fields = self.describe(json.load(f))
+                except Exception as e:
+                    logging.warning(f"Catalog could not index {filepath}: {str(e)}")
+                    fields = {"story_title": None, "message_count": None, "token_count": None,
+                              "facts_count": None, "saved_at": None, "preview": "(unreadable)"}
+                changed.append(self.row_for(filepath, fields, stat))
+            stale = [(path,) for path in known if path not in seen]
+            if changed or stale:
+                with connection:
+                    self.upsert(connection, changed)
+                    connection.executemany("DELETE FROM sessions WHERE path = ?", stale)
+        finally:
+            connection.close()
+
+    def query(self, sort="modified", text=None):
+        """Return catalog rows as dicts, optionally filtered by name, story or preview text."""
+        self.refresh()
+        connection = self.connect()
+        connection.row_factory = sqlite3.Row
+        try:
+            sql = "SELECT * FROM sessions"
+            params = ()
+            if text:
+                sql += " WHERE name LIKE ? OR story_title LIKE ? OR preview LIKE ?"
+                params = (f"%{text}%",) * 3
+            sql += " ORDER BY " + self.SORT_COLUMNS.get(sort, self.SORT_COLUMNS["modified"])
+            return [dict(row) for row in connection.execute(sql, params)]
+        finally:
+            connection.close()
+
+session_catalog = SessionCatalog(SESSION_CATALOG_FILE, sessions_dir)
+
+def print_session_catalog(rows):
+    """Print catalog rows as a numbered table."""
+    print(f"\n{'#':>4}  {'Session':<30} {'Story':<20} {'Msgs':>5} {'Tokens':>8}  Modified")
+    for i, row in enumerate(rows, 1):
+        modified = datetime.datetime.fromtimestamp(row["mtime_ns"] / 1e9).strftime("%Y-%m-%d %H:%M")
+        story = (row["story_title"] or "-")[:20]
+        msgs = "?" if row["message_count"] is None else row["message_count"]
+        tokens = "?" if row["token_count"] is None else row["token_count"]
+        unsaved = " *unsaved changes" if row["unsaved_at"] else ""
+        print(f"{i:>4}. {row['name'][:30]:<30} {story:<20} {msgs:>5} {tokens:>8}  {modified}{unsaved}")
+        if row["preview"]:
+            print(f"      {row['preview']}")
+
+# ===== Session Files =====
+
+# Fields a segmented header adds to the single-file session layout
+SEGMENTED_HEADER_FIELDS = ("segments", "segment_size", "message_count", "token_count", "preview")
+
+def segments_dir_for(filepath):
+    """Directory holding the message segments of a session file."""
+    return os.path.splitext(filepath)[0] + ".segments"
+
+def segment_fingerprint(segment_messages):
+    digest = hashlib.sha256()
+    for msg in segment_messages:
+        digest.update(get_message_hash(msg).encode())
+    return digest.hexdigest()[:16]
+
+def session_segment_paths(filepath, raw):
+    """Segment file paths when raw is a segmented session header, else None."""
+    try:
+        header = json.loads(raw)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(header, dict) or not isinstance(header.get("segments"), list):
+        return None
+    directory = segments_dir_for(filepath)
+    return [os.path.join(directory, segment["file"]) for segment in header["segments"]]
+
+def write_session_file(filepath, session_data, token_count=None):
+    """Save session_data in the segmented format, rewriting only segments that changed.
+    
+    Messages are stored in <name>.segments/ in runs of SESSION_SEGMENT_MESSAGES,
+    each file named by its position and a fingerprint of its messages, so an
+    unchanged segment is never written again and a changed one never replaces
+    a file the current header still points at. The small header (<name>.json)
+    is replaced last, which commits the save; segments it no longer names are
+    deleted afterwards. Returns the number of segment files written.
+    """
+    directory = segments_dir_for(filepath)
+    os.makedirs(directory, exist_ok=True)
+    session_messages = session_data["messages"]
+    segments = []
+    written = 0
+    for index, start in enumerate(range(0, len(session_messages), SESSION_SEGMENT_MESSAGES)):
+        segment_messages = session_messages[start:start + SESSION_SEGMENT_MESSAGES]
+        name = f"{index:06d}-{segment_fingerprint(segment_messages)}.json"
+        if not os.path.exists(os.path.join(directory, name)):
+            write_json_atomic(os.path.join(directory, name), list(segment_messages))
+            written += 1
+        segments.append({"file": name, "count": len(segment_messages)})
+    
+    header = {key: value for key, value in session_data.items() if key != "messages"}
+    header.update(version=SESSION_FORMAT_VERSION, segment_size=SESSION_SEGMENT_MESSAGES,
+                  segments=segments, message_count=len(session_messages), token_count=token_count,
+                  preview=next((" ".join(msg["content"].split())[:80] for msg in reversed(session_messages)
+                                if msg["role"] == "assistant"), ""))
+    write_json_atomic(filepath, header)
+    
+    referenced = {segment["file"] for segment in segments}
+    for entry in os.scandir(directory):
+        if entry.name not in referenced:
+            os.remove(entry.path)
+    return written
+
+def read_session_file(filepath):
+    """Parse a session file in any format; segmented sessions get their messages joined in."""
+    with open(filepath, 'r') as f:
+        session_data = json.load(f)
+    if isinstance(session_data, dict) and isinstance(session_data.get("segments"), list):
+        directory = segments_dir_for(filepath)
+        session_messages = []
+        for segment in session_data["segments"]:
+            with open(os.path.join(directory, segment["file"]), 'r') as f:
+                segment_messages = json.load(f)
+            if len(segment_messages) != segment["count"]:
+                raise ValueError(f"Session segment {segment['file']} is incomplete")
+            session_messages.extend(segment_messages)
+        session_data["messages"] = session_messages
+    return session_data
+
+def stream_json_session(f, on_message):
+    """Walk a single-file session (v1 dict or legacy list) without parsing it whole.
+    
+    Each element of the messages array is decoded on its own and passed to
+    on_message; the other fields are small and returned as a dict (None for
+    the legacy list layout). Raises json.JSONDecodeError on malformed input.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = f.read(SESSION_READ_CHUNK)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def peek():
+        # The next significant character, or "" at the end of the file
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer) or eof:
+                return buffer[pos:pos + 1]
+            fill()
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise json.JSONDecodeError(f"Expecting {char!r}", buffer, pos)
+        pos += 1
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+                # A number cut by the chunk boundary decodes short, so the
+                # value must be followed by a delimiter already in the buffer
+                if eof or (end < len(buffer) and buffer[end] in " \t\r\n,:]}"):
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+
+    def array(callback):
+        nonlocal pos
+        expect("[")
+        if peek() == "]":
+            pos += 1
+            return
+        while True:
+            callback(value())
+            if peek() == "]":
+                pos += 1
+                return
+            expect(",")
+
+    if peek() == "[":
+        array(on_message)
+        return None
+    header = {}
+    expect("{")
+    if peek() == "}":
+        return header
+    while True:
+        key = value()
+        expect(":")
+        if key == "messages" and peek() == "[":
+            array(on_message)
+        else:
+            header[key] = value()
+        if peek() == "}":
+            return header
+        expect(",")
+
+def stream_session_file(filepath, on_message):
+    """Pass each stored message of a session file in any format to on_message.
+    
+    Returns the session fields without messages, or None for a legacy file.
+    Segmented sessions are read one segment at a time.
+    """
+    with open(filepath, 'r') as f:
+        header = stream_json_session(f, on_message)
+    if isinstance(header, dict) and isinstance(header.get("segments"), list):
+        directory = segments_dir_for(filepath)
+        for segment in header["segments"]:
+            with open(os.path.join(directory, segment["file"]), 'r') as f:
+                segment_messages = json.load(f)
+            if len(segment_messages) != segment["count"]:
+                raise ValueError(f"Session segment {segment['file']} is incomplete")
+            for msg in segment_messages:
+                on_message(msg)
+    return header
+
+class ContextWindowLoader:
+    """Keep only the messages trim_messages_to_fit would keep, fed one at a time.
+    
+    Messages are validated and de-duplicated as they arrive. The newest ones
+    within max_tokens and max_messages are held in a deque; pinned messages
+    that fall out of it are set aside, since trimming keeps them. Memory is
+    bounded by the window plus one 64-bit hash per message seen.
+    """
+
+    def __init__(self, max_tokens=None, max_messages=None, on_message=None):
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.on_message = on_message  # Called with each valid, unique message
+        self.reset()
+
+    def reset(self):
+        """Forget every message fed so far."""
+        self.system = None
+        self.window = deque()  # (message, tokens), oldest first
+        self.window_tokens = 0
+        self.pins = []
+        self.seen = set()
+        self.accepted = 0
+        self.invalid = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def key(msg):
+        return int(msg.digest()[:16], 16)
+
+    def add(self, msg):
+        if not validate_message(msg):
+            logging.warning(f"Invalid message format found and skipped: {msg}")
+            self.invalid += 1
+            return
+        msg = as_message(msg)
+        key = self.key(msg)
+        if key in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(key)
+        self.accepted += 1
+        if self.on_message is not None:
+            self.on_message(msg)
+        if self.accepted == 1 and msg["role"] == "system":
+            self.system = msg
+            return
+        
+        tokens = count_message_tokens(msg)
+        self.window.append((msg, tokens))
+        self.window_tokens += tokens
+        budget = float("inf")
+        if self.max_tokens:
+            budget = self.max_tokens - (count_message_tokens(self.system) if self.system else 0)
+        while self.window and (self.window_tokens > budget or
+                               (self.max_messages is not None and len(self.window) > self.max_messages)):
+            old, old_tokens = self.window.popleft()
+            self.window_tokens -= old_tokens
+            if is_pinned_message(old):
+                self.pins.append(old)
+
+    def extend(self, msgs):
+        for msg in msgs:
+            self.add(msg)
+
+    def result(self):
+        """The kept messages, trimmed exactly as the full list would have been."""
+        candidates = [self.system] if self.system else []
+        candidates.extend(self.pins)
+        candidates.extend(msg for msg, _ in self.window)
+        if self.max_tokens is None and self.max_messages is None:
+            return candidates
+        return trim_messages_to_fit(candidates, self.max_tokens, self.max_messages)
+
+def migrate_sessions():
+    """Convert single-file (v1 and legacy) sessions in sessions/ to the segmented format."""
+    confirm = input(f"Convert all single-file sessions in {sessions_dir}/ to format v{SESSION_FORMAT_VERSION}? "
+                    "Each is backed up first. (y/n): ").lower()
+    if confirm != 'y':
+        print("Migration cancelled.")
+        return
+    persistence.flush()
+    
+    converted = 0
+    for name in sorted(os.listdir(sessions_dir)):
+        filepath = os.path.join(sessions_dir, name)
+        if not name.endswith('.json') or name.startswith('.') or not os.path.isfile(filepath):
+            continue
+        try:
+            with open(filepath, 'rb') as f:
+                raw = f.read()
+            if session_segment_paths(filepath, raw) is not None:
+                continue
+            session_data = json.loads(raw)
+            if not isinstance(session_data, dict):
+                session_data = {"messages": session_data, "story_setting": None, "facts": [],
+                                "pending_system_prompt": None, "summary_state": None}
+            session_messages = validate_messages(session_data.get("messages", []))
+            dropped = len(session_data.get("messages", [])) - len(session_messages)
+            session_data["messages"] = session_messages
+            
+            create_backup(filepath)
+            written = write_session_file(filepath, session_data, calculate_token_usage(session_messages))
+            converted += 1
+            note = f", {dropped} invalid messages dropped" if dropped else ""
+            print(f"  {name}: {len(session_messages)} messages in {written} segments{note}")
+        except Exception as e:
+            logging.error(f"Error migrating session {name}: {str(e)}")
+            print(f"  {name}: not converted ({str(e)})")
+    print(f"Converted {converted} sessions.")
+
+# ===== End Session Files =====
+
+# ===== Session Archive =====
+
+class SessionArchive:
+    """Read-only, memory-mapped binary session archive.
+    
+    Layout (little-endian): MAGIC, then one blob per message (u32 length +
+    UTF-8 JSON object), then the index of one (u64 blob offset, u64 tokens
+    so far) entry per message, then the metadata JSON (session fields without
+    messages, plus the pinned message indexes), then FOOTER. Only the pages
+    holding the footer, the index entries probed and the messages returned
+    are ever read.
+    """
+
+    MAGIC = b"RSARCHV1"
+    LENGTH = struct.Struct("<I")
+    ENTRY = struct.Struct("<QQ")
+    FOOTER = struct.Struct("<QQQQ8s")  # index offset, count, metadata offset, metadata length, MAGIC
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < len(self.MAGIC) + self.FOOTER.size or self.map[:len(self.MAGIC)] != self.MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a session archive")
+        self.index_offset, self.count, metadata_offset, metadata_length, magic = \
+            self.FOOTER.unpack_from(self.map, len(self.map) - self.FOOTER.size)
+        if magic != self.MAGIC or self.index_offset + self.count * self.ENTRY.size != metadata_offset:
+            self.map.close()
+            raise ValueError(f"Session archive {path} is incomplete")
+        self.metadata = json.loads(self.map[metadata_offset:metadata_offset + metadata_length])
+        self.pins = self.metadata.pop("pins")
+        self.pin_sums = [0]
+        self.pin_sums.extend(accumulate(self.tokens_before(i + 1) - self.tokens_before(i) for i in self.pins))
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def tokens_before(self, i):
+        """Tokens of messages [0, i), as stored when the archive was written."""
+        if i <= 0:
+            return 0
+        return self.ENTRY.unpack_from(self.map, self.index_offset + (i - 1) * self.ENTRY.size)[1]
+
+    def message(self, i):
+        offset = self.ENTRY.unpack_from(self.map, self.index_offset + i * self.ENTRY.size)[0]
+        length, = self.LENGTH.unpack_from(self.map, offset)
+        start = offset + self.LENGTH.size
+        data = json.loads(self.map[start:start + length])
+        return Message(data["role"], data["content"])
+
+    def messages(self, start=0, stop=None):
+        return [self.message(i) for i in range(start, self.count if stop is None else min(stop, self.count))]
+
+    def tail(self, max_tokens=None, max_messages=MAX_MESSAGES):
+        """The messages trim_messages_to_fit would keep, read without touching the rest.
+        
+        Returns (kept messages, index where the kept window begins).
+        """
+        archive = self
+
+        class Prefix:
+            # The lazy prefix-sum sequence find_context_cut bisects over
+            def __len__(self):
+                return archive.count + 1
+
+            def __getitem__(self, i):
+                return archive.tokens_before(archive.count + 1 + i if i < 0 else i)
+
+        if not self.count:
+            return [], 0
+        start = 1 if self.metadata.get("leading_system") else 0
+        lower = start
+        if max_messages is not None:
+            lower = max(start, self.count - max_messages)
+        budget = max_tokens - self.tokens_before(start) if max_tokens else float("inf")
+        cut, first_pin = find_context_cut(Prefix(), self.pins, self.pin_sums, start, lower, budget)
+        kept = self.messages(0, start)
+        kept.extend(self.message(i) for i in self.pins[first_pin:bisect_left(self.pins, cut)])
+        kept.extend(self.messages(cut))
+        return kept, cut
+
+class SessionArchiveWriter:
+    """Writes a binary archive one message at a time, validating and de-duplicating on the way.
+    
+    Messages go straight to <path>.tmp; finish() appends the index and the
+    metadata and renames the file into place, so neither the session nor the
+    archive is ever held in memory whole.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(SessionArchive.MAGIC)
+        self.position = len(SessionArchive.MAGIC)
+        self.offsets = []
+        self.totals = []
+        self.pins = []
+        self.seen = set()
+        self.skipped = 0
+        self.total = 0
+        self.leading_system = False
+
+    def add(self, msg):
+        msg = as_message(msg)
+        if not isinstance(msg, Message) or msg.digest() in self.seen:
+            self.skipped += 1
+            return
+        self.seen.add(msg.digest())
+        if not self.offsets:
+            self.leading_system = msg["role"] == "system"
+        elif is_pinned_message(msg):
+            self.pins.append(len(self.offsets))
+        blob = msg.to_json().encode()
+        self.file.write(SessionArchive.LENGTH.pack(len(blob)))
+        self.file.write(blob)
+        self.offsets.append(self.position)
+        self.position += SessionArchive.LENGTH.size + len(blob)
+        self.total += count_message_tokens(msg)
+        self.totals.append(self.total)
+
+    def finish(self, fields):
+        """Write the index and the session fields, then commit; returns (written, skipped)."""
+        f = self.file
+        index_offset = self.position
+        for entry in zip(self.offsets, self.totals):
+            f.write(SessionArchive.ENTRY.pack(*entry))
+        metadata = {key: value for key, value in (fields or {}).items()
+                    if key != "messages" and key not in SEGMENTED_HEADER_FIELDS}
+        metadata.update(leading_system=self.leading_system, pins=self.pins, token_count=self.total)
+        metadata = json.dumps(metadata, ensure_ascii=False).encode()
+        metadata_offset = index_offset + len(self.offsets) * SessionArchive.ENTRY.size
+        f.write(metadata)
+        f.write(SessionArchive.FOOTER.pack(index_offset, len(self.offsets), metadata_offset, len(metadata),
+                                           SessionArchive.MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(self.tmp_path, self.path)
+        return len(self.offsets), self.skipped
+
+    def abort(self):
+        """Drop the partly written archive."""
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+def write_session_archive(path, session_data):
+    """Write session_data to a binary archive; session_data["messages"] may be any iterable.
+    
+    Returns (messages written, messages skipped).
+    """
+    writer = SessionArchiveWriter(path)
+    try:
+        for msg in session_data.get("messages", []):
+            writer.add(msg)
+        return writer.finish(session_data)
+    except BaseException:
+        writer.abort()
+        raise
+
+def export_session_archive(filepath, path):
+    """Stream a saved session of any format into a binary archive; returns (written, skipped)."""
+    writer = SessionArchiveWriter(path)
+    try:
+        header = stream_session_file(filepath, writer.add)
+        return writer.finish(header)
+    except BaseException:
+        writer.abort()
+        raise
+
+def choose_file(directory, extension, what):
+    """List files with extension in directory and return the chosen path, or None."""
+    names = sorted(name for name in os.listdir(directory) if name.endswith(extension) and not name.startswith('.'))
+    if not names:
+        print(f"No {what} found.")
+        return None
+    print(f"\nAvailable {what}:")
+    for i, name in enumerate(names, 1):
+        print(f"{i}. {name[:-len(extension)]}")
+    choice = input(f"Enter number (or press Enter to cancel): ").strip()
+    if not choice:
+        return None
+    choice = int(choice)
+    if choice < 1 or choice > len(names):
+        print("Invalid selection.")
+        return None
+    return os.path.join(directory, names[choice-1])
+
+def resume_archive(filepath):
+    """Continue a story from the newest messages of an archive that fit the context."""
+    global messages, current_session_name, current_session_file, current_story, current_facts, \
+        pending_system_prompt, summary_state, current_archive
+    
+    archive = SessionArchive(filepath)
+    kept, cut = archive.tail(NUM_CTX, MAX_MESSAGES)
+    metadata = archive.metadata
+    
+    story_memory.load(StoryMemory.path_for(filepath))
+    story_memory.sync(kept)
+    # Stored counts may come from another tokenizer; the usual trim settles the difference
+    messages[:] = trim_messages_to_fit(kept, NUM_CTX, MAX_MESSAGES)
+    if current_archive is not None:
+        current_archive.close()
+    current_archive = archive
+    
+    current_session_name = os.path.splitext(os.path.basename(filepath))[0]
+    # Saving asks for a name, so a trimmed resume never replaces a full session file
+    current_session_file = None
+    if metadata.get("story_setting"):
+        current_story = metadata["story_setting"]
+    current_facts = metadata.get("facts") or []
+    if messages and messages[0]["role"] == "system":
+        messages.set_content(0, compose_system_prompt(messages[0]["content"]))
+    pending_system_prompt = metadata.get("pending_system_prompt")
+    summary_state = metadata.get("summary_state") or new_summary_state()
+    save_temp_session()
+    
+    print(f"Resumed {current_session_name}: {len(messages)} of {len(archive)} messages in context "
+          f"({calculate_token_usage(messages)}/{NUM_CTX} tokens).")
+    if cut > 1:
+        print(f"Use /history to page back through the {cut} earlier messages.")
+
+def manage_archives():
+    """Export sessions to binary archives, import them back, or resume from one."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    print("\nSession archives:")
+    print("1. Export a saved session to an archive")
+    print("2. Import an archive as a saved session")
+    print("3. Resume a story from an archive")
+    try:
+        choice = input("Choose an option (or press Enter to cancel): ").strip()
+        if choice == "1":
+            filepath = choose_file(sessions_dir, ".json", "saved sessions")
+            if filepath is None:
+                return
+            persistence.flush()
+            target = os.path.join(ARCHIVE_DIR, os.path.splitext(os.path.basename(filepath))[0] + ".rsa")
+            written, skipped = export_session_archive(filepath, target)
+            memory_path = StoryMemory.path_for(filepath)
+            if os.path.exists(memory_path):
+                move_or_copy_file(memory_path, StoryMemory.path_for(target), move=False)
+            print(f"Exported {written} messages to {target}" + (f" ({skipped} invalid or duplicate skipped)" if skipped else ""))
+        elif choice == "2":
+            filepath = choose_file(ARCHIVE_DIR, ".rsa", "archives")
+            if filepath is None:
+                return
+            name = os.path.splitext(os.path.basename(filepath))[0]
+            target = os.path.join(sessions_dir, name + ".json")
+            if os.path.exists(target) and input(f"Replace {target}? It is backed up first. (y/n): ").lower() != 'y':
+                print("Import cancelled.")
+                return
+            archive = SessionArchive(filepath)
+            try:
+                session_data = dict(archive.metadata, version=SESSION_FORMAT_VERSION, messages=archive.messages())
+            finally:
+                archive.close()
+            for field in ("leading_system", "token_count"):
+                session_data.pop(field, None)
+            persistence.flush()
+            create_backup(target)
+            write_session_file(target, session_data, calculate_token_usage(session_data["messages"]))
+            memory_path = StoryMemory.path_for(filepath)
+            if os.path.exists(memory_path):
+                move_or_copy_file(memory_path, StoryMemory.path_for(target), move=False)
+            print(f"Imported {len(session_data['messages'])} messages to {target}")
+        elif choice == "3":
+            filepath = choose_file(ARCHIVE_DIR, ".rsa", "archives")
+            if filepath is not None:
+                resume_archive(filepath)
+        elif choice:
+            print("Invalid option.")
+    except ValueError as e:
+        print(f"Archive error: {str(e)}")
+    except Exception as e:
+        logging.error(f"Error managing archives: {str(e)}")
+        print(f"Error managing archives: {str(e)}")
+
+def show_history_page(page=1):
+    """Print one page of the archived history, counting back from the resumed window."""
+    if current_archive is None:
+        print("Paging is available after resuming a story from an archive (see /archive).")
+        return
+    # Page 1 ends just before the oldest archived message still in context
+    end = len(current_archive)
+    in_context = {get_message_hash(msg) for msg in messages}
+    while end > 0 and current_archive.message(end - 1).digest() in in_context:
+        end -= 1
+    pages = max(1, -(-end // ARCHIVE_PAGE_SIZE))
+    if page < 1 or page > pages:
+        print(f"Page must be between 1 and {pages}.")
+        return
+    stop = end - (page - 1) * ARCHIVE_PAGE_SIZE
+    start = max(0, stop - ARCHIVE_PAGE_SIZE)
+    print(f"\nMessages {start + 1}-{stop} of {len(current_archive)} (page {page} of {pages}, older pages have higher numbers):")
+    for i, msg in enumerate(current_archive.messages(start, stop), start + 1):
+        print(f"\n[{i}] {msg['role']}: {msg['content']}")
+
+# ===== End Session Archive =====
+
 def save_session(new_session=False):
     """Save the current chat history to a file."""
     global current_session_name, current_session_file
@@ -492,10 +2507,6 @@ def save_session(new_session=False):
     else:
         filepath = current_session_file
     
-    # Create backup if file exists
-    if os.path.exists(filepath):
-        create_backup(filepath)
-    
     # Validate messages before saving
     valid_messages = validate_messages(messages)
     if len(valid_messages) != len(messages):
@@ -506,63 +2517,87 @@ def save_session(new_session=False):
     if len(unique_messages) != len(valid_messages):
         print(f"Note: {len(valid_messages) - len(unique_messages)} duplicate messages were removed.")
 
-    # Include version information for future compatibility
+    # Include version information for future compatibility; copies, since
+    # the file is written on the background writer
     session_data = {
         "version": SESSION_FORMAT_VERSION,
         "timestamp": datetime.datetime.now().isoformat(),
         "messages": unique_messages,
-        "story_setting": current_story,
-        "facts": current_facts
+        "story_setting": deepcopy(current_story),
+        "facts": list(current_facts),
+        "pending_system_prompt": pending_system_prompt,
+        "summary_state": deepcopy(summary_state)
     }
+    token_count = calculate_token_usage(unique_messages)
+    outcome = {}
 
-    success = False
-    try:
-        with open(filepath, 'w') as f:
-            json.dump(session_data, f, indent=2)
-        
-        save_facts()
-        print(f"Story session saved to {filepath}")
-        
-        # Calculate and show context stats
-        token_count = calculate_token_usage(unique_messages)
-        print(f"Context size: {token_count} tokens, {len(unique_messages)} messages")
+    def write():
+        try:
+            # Keep the previous version before replacing it
+            create_backup(filepath)
+            write_session_file(filepath, session_data, token_count)
+        except Exception as e:
+            outcome["error"] = e
+            return
+        outcome["saved"] = True
+        try:
+            fields = SessionCatalog.describe({**session_data, "messages": []})
+            fields.update(message_count=len(unique_messages), token_count=token_count)
+            for msg in reversed(unique_messages):
+                if msg["role"] == "assistant":
+                    fields["preview"] = " ".join(msg["content"].split())[:80]
+                    break
+            session_catalog.record(filepath, fields)
+        except Exception as e:
+            logging.error(f"Error updating session catalog: {str(e)}")
         
-        success = True
+        # Delete temporary session after successful save
+        try:
+            discard_temp_session()
+            logging.info("Temporary session deleted after successful save.")
+        except Exception as e:
+            logging.error(f"Error deleting temporary session: {str(e)}")
+            outcome["warning"] = f"Could not delete temporary session: {str(e)}"
+
+    persistence.submit(f"session {filepath}", write)
+    save_facts()
+    # An explicit save waits for its write (and any queued before it)
+    persistence.flush()
+    persistence.report_errors()
+    
+    if "error" in outcome:
+        logging.error(f"Error saving session: {str(outcome['error'])}")
+        print(f"Error saving session: {str(outcome['error'])}")
+        return False
+    if "warning" in outcome:
+        print(f"Warning: {outcome['warning']}")
+    
+    print(f"Story session saved to {filepath}")
+    try:
+        story_memory.save_as(StoryMemory.path_for(filepath))
+        story_memory.sync(unique_messages)
     except Exception as e:
-        logging.error(f"Error saving session: {str(e)}")
-        print(f"Error saving session: {str(e)}")
+        logging.error(f"Error saving story memory: {str(e)}")
     
-    # Delete temporary session after successful save
-    if success:
-        temp_filepath = os.path.join(sessions_dir, ".temp_session.json")
-        if os.path.exists(temp_filepath):
-            try:
-                os.remove(temp_filepath)
-                logging.info("Temporary session deleted after successful save.")
-            except Exception as e:
-                logging.error(f"Error deleting temporary session: {str(e)}")
-                print(f"Warning: Could not delete temporary session: {str(e)}")
+    # Show context stats
+    print(f"Context size: {token_count} tokens, {len(unique_messages)} messages")
+    return True
 
-    return success
+def write_facts(filepath, facts):
+    """Back up and atomically replace a facts file."""
+    create_backup(filepath)
+    write_json_atomic(filepath, facts)
+    logging.info(f"Saved {len(facts)} facts to {filepath}")
 
 def save_facts():
+    """Queue the current facts for writing next to the session."""
     if not current_session_name or not current_facts:
         return
     
     facts_filename = f"{current_session_name}_facts.json"
     facts_filepath = os.path.join(facts_dir, facts_filename)
-    
-    # Create backup if file exists
-    if os.path.exists(facts_filepath):
-        create_backup(facts_filepath)
-    
-    try:
-        with open(facts_filepath, 'w') as f:
-            json.dump(current_facts, f, indent=2)
-        logging.info(f"Saved {len(current_facts)} facts to {facts_filepath}")
-    except Exception as e:
-        logging.error(f"Error saving facts: {str(e)}")
-        print(f"Error saving facts: {str(e)}")
+    facts = list(current_facts)
+    persistence.submit(f"facts {facts_filepath}", lambda: write_facts(facts_filepath, facts))
 
 def load_facts():
     if not current_session_name:
@@ -591,30 +2626,33 @@ def load_facts():
     return []
 
 def clear_context():
-    global messages, current_session_file
+    global messages, current_session_file, summary_state, current_archive
     
     # Save backup of current context before clearing
     if messages and len(messages) > 1:
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_filename = f"context_backup_{timestamp}.json"
-        backup_filepath = os.path.join(backup_dir, backup_filename)
         try:
-            with open(backup_filepath, 'w') as f:
-                json.dump(messages, f, indent=2)
-            print(f"Current context backed up to {backup_filepath}")
+            backup_store.add_bytes("context", json.dumps(messages, indent=2, default=json_default).encode())
+            print("Current context backed up (see /backups)")
         except Exception as e:
             logging.error(f"Error creating context backup: {str(e)}")
     
+    # The prefix is reset anyway, so fold in any pending prompt change
+    fold_pending_system_prompt()
+    
     system_message = messages[0] if messages and messages[0]["role"] == "system" else {
         "role": "system", "content": DEFAULT_SYSTEM_MESSAGE
     }
     
     # Ensure system message has facts but no duplicates
-    if current_facts:
-        system_message["content"] = append_facts_to_prompt(system_message["content"])
+    system_message = Message("system", compose_system_prompt(system_message["content"]))
     
     messages[:] = [system_message]
     current_session_file = None
+    if current_archive is not None:
+        current_archive.close()
+    current_archive = None
+    summary_state = new_summary_state()
+    story_memory.reset()
     print("Context cleared. Only system message remains.")
     save_temp_session()
 
@@ -715,20 +2753,14 @@ Themes:
         return None
 
 def apply_story_setting(story):
-    global messages, current_story
+    global messages, current_story, current_session_file, pending_system_prompt, summary_state
     
     if not story:
         print("Invalid story setting.")
         return
     
-    system_prompt = story.get("system_prompt", "")
-    system_prompt = clean_system_prompt(system_prompt)
-    system_prompt = append_facts_to_prompt(system_prompt)
-    
-    if messages and messages[0]["role"] == "system":
-        messages[0]["content"] = system_prompt
-    else:
-        messages.insert(0, {"role": "system", "content": system_prompt})
+    system_prompt = compose_system_prompt(story.get("system_prompt", ""))
+    install_system_prompt(system_prompt)
     
     current_story = story
     print(f"Story setting '{story.get('title')}' loaded. System prompt updated.")
@@ -736,7 +2768,10 @@ def apply_story_setting(story):
     new_story = input("Start a new story with this setting? (y/n): ").lower()
     if new_story == 'y':
         messages[:] = [{"role": "system", "content": system_prompt}]
+        pending_system_prompt = None
         current_session_file = None
+        summary_state = new_summary_state()
+        story_memory.reset()
     
     save_temp_session()
 
@@ -760,101 +2795,330 @@ def clean_system_prompt(prompt):
     
     return prompt
 
+def strip_facts_section(prompt):
+    """Remove an existing facts section from a prompt."""
+    if "Established Story Facts:" in prompt:
+        prompt = prompt.split("Established Story Facts:")[0].strip()
+    return prompt
+
+def format_facts_section():
+    """Format the current facts as a prompt section."""
+    facts_text = "Established Story Facts:\n"
+    for i, fact in enumerate(current_facts, 1):
+        facts_text += f"{i}. {fact}\n"
+    facts_text += "\nRemember to maintain consistency with these established facts."
+    return facts_text
+
 def append_facts_to_prompt(prompt):
     if not current_facts:
         return prompt
     
     # Remove any existing facts section to avoid duplication
-    if "Established Story Facts:" in prompt:
-        prompt = prompt.split("Established Story Facts:")[0].strip()
+    prompt = strip_facts_section(prompt)
     
-    facts_text = "\n\nEstablished Story Facts:\n"
-    for i, fact in enumerate(current_facts, 1):
-        facts_text += f"{i}. {fact}\n"
-    facts_text += "\nRemember to maintain consistency with these established facts."
+    return prompt + "\n\n" + format_facts_section()
+
+def compose_system_prompt(prompt):
+    """Clean a system prompt and place the facts according to PROMPT_ASSEMBLY_MODE."""
+    prompt = clean_system_prompt(prompt)
+    if PROMPT_ASSEMBLY_MODE == "stable":
+        # Facts travel in the late context block instead
+        return strip_facts_section(prompt)
+    return append_facts_to_prompt(prompt)
+
+def install_system_prompt(system_prompt):
+    """Set the system prompt, keeping an already-sent prefix intact in stable mode."""
+    global pending_system_prompt
     
-    return prompt + facts_text
+    if messages and messages[0]["role"] == "system":
+        if PROMPT_ASSEMBLY_MODE == "stable" and len(messages) > 1 and messages[0]["content"] != system_prompt:
+            # Mid-story: deliver the change in the context block instead of rewriting the prefix
+            pending_system_prompt = system_prompt
+            return
+        messages.set_content(0, system_prompt)
+    else:
+        messages.insert(0, {"role": "system", "content": system_prompt})
+    pending_system_prompt = None
 
-def estimate_tokens(text):
-    """Estimate token count from text."""
-    if not text:
-        return 0
-    # More accurate token estimation (approximate)
-    words = len(text.split())
-    chars = len(text)
-    # Improved estimation formula considering both word and character counts
-    return int(words + (chars / 4))
+def fold_pending_system_prompt():
+    """Move a pending prompt change into the system message once the prefix is reset."""
+    global pending_system_prompt
+    
+    if pending_system_prompt and messages and messages[0]["role"] == "system":
+        messages.set_content(0, pending_system_prompt)
+    pending_system_prompt = None
 
-def calculate_token_usage(messages_list):
-    """Calculate estimated token usage for all messages."""
-    if not messages_list:
-        return 0
+def build_context_block():
+    """Collect volatile context (prompt changes, facts) for the late prompt slot."""
+    sections = []
+    if pending_system_prompt:
+        sections.append(f"Story Setting Update (replaces the earlier instructions):\n{pending_system_prompt}")
+    if current_facts:
+        sections.append(format_facts_section())
+    return "\n\n".join(sections)
+
+def assemble_request_messages(history):
+    """Build the message list sent to the model from the chat history."""
+    context_block = build_context_block() if PROMPT_ASSEMBLY_MODE == "stable" else ""
     
-    return sum(estimate_tokens(msg.get("content", "")) for msg in messages_list)
+    if CONVERSATION_LIMIT:
+        budget = NUM_CTX - CONTEXT_RESPONSE_RESERVE - estimate_tokens(context_block)
+        if RETRIEVAL_MEMORY:
+            budget -= RETRIEVAL_SLOT_TOKENS
+        history = context_window.select(history, budget)
+    
+    if RETRIEVAL_MEMORY:
+        try:
+            recalled = build_recall_block(history)
+        except Exception as e:
+            logging.error(f"Error recalling story memory: {str(e)}")
+            recalled = ""
+        context_block = "\n\n".join(block for block in (context_block, recalled) if block)
+    
+    if not context_block:
+        return history
+    
+    # Put the block right before the newest user message, so everything sent
+    # on earlier turns stays a byte-identical prefix.
+    request = history.copy()
+    position = len(request)
+    if request and request[-1]["role"] == "user":
+        position -= 1
+    request.insert(position, {"role": "system", "content": context_block})
+    return request
+
+def find_context_cut(prefix, pins, pin_sums, start, lower, budget):
+    """Binary-search where the kept window begins.
+    
+    Returns (cut, first_pin): messages from cut onward are kept along with the
+    pinned messages pins[first_pin:] that lie before cut. The cost of a cut is
+    the window's tokens plus those pins, which never increases as the cut
+    moves forward, so the smallest cut within budget can be bisected.
+    """
+    total = prefix[-1]
+    end = len(prefix) - 1
+    first_pin = bisect_left(pins, start)
+    
+    def cost(cut):
+        return total - prefix[cut] + pin_sums[bisect_left(pins, cut)] - pin_sums[first_pin]
+    
+    lo, hi = lower, end
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if cost(mid) <= budget:
+            hi = mid
+        else:
+            lo = mid + 1
+    cut = lo
+    
+    if cost(cut) > budget:
+        # The pins alone overflow the budget: keep only the newest ones that fit
+        last_pin = bisect_left(pins, cut)
+        first_pin = bisect_left(pin_sums, pin_sums[last_pin] - budget, first_pin, last_pin)
+    return cut, first_pin
 
 def trim_messages_to_fit(messages_list, max_tokens=None, max_messages=MAX_MESSAGES):
-    """Trim messages to fit within token and message count limits while preserving important context."""
+    """Trim messages to fit within token and message count limits while preserving important context.
+    
+    Pinned messages (summaries, chapter markers) are kept inside the budget.
+    The result shares the message dicts with messages_list.
+    """
     if not messages_list:
         return []
     
-    # Make a copy to avoid modifying the original
-    messages_copy = deepcopy(messages_list)
+    prefix, pins, pin_sums = token_index(messages_list)
     
     # Extract system message
     system_message = None
-    if messages_copy and messages_copy[0]["role"] == "system":
-        system_message = messages_copy.pop(0)
-    
-    # If we have more messages than allowed, trim to fit
-    if len(messages_copy) > max_messages:
-        # Keep the most recent messages up to the max
-        messages_copy = messages_copy[-max_messages:]
-    
-    # If we need to further trim based on tokens
-    if max_tokens and system_message:
-        system_tokens = estimate_tokens(system_message["content"])
-        token_budget = max_tokens - system_tokens
+    start = 0
+    if messages_list[0]["role"] == "system":
+        system_message = messages_list[0]
+        start = 1
+    
+    # Keep the most recent messages up to the max
+    lower = start
+    if max_messages is not None:
+        lower = max(start, len(messages_list) - max_messages)
+    
+    budget = float("inf")
+    if max_tokens:
+        system_tokens = prefix[start]
+        budget = max_tokens - system_tokens
         
         # If system message alone exceeds token budget
-        if system_tokens >= max_tokens:
+        if system_message and system_tokens >= max_tokens:
             logging.warning("System message exceeds token budget")
             # Keep system message but truncate its content if needed
             truncated_content = system_message["content"][:int(max_tokens * 4)]  # Approximate truncation
-            system_message["content"] = truncated_content
-            return [system_message]
+            return [{"role": "system", "content": truncated_content}]
+    
+    cut, first_pin = find_context_cut(prefix, pins, pin_sums, start, lower, budget)
+    
+    trimmed = [system_message] if system_message else []
+    trimmed.extend(messages_list[i] for i in pins[first_pin:bisect_left(pins, cut)])
+    trimmed.extend(messages_list[cut:])
+    return trimmed
+
+class ContextWindow:
+    """Chooses which part of the history is sent with each request.
+    
+    The window start is kept on the same message until the window overflows
+    the budget, then moved forward with some headroom, so the sent prefix
+    stays identical across turns and the backend can reuse its cache.
+    """
+
+    def __init__(self):
+        self.anchor = None
+        self.anchor_index = None
+
+    def select(self, history, budget):
+        """Return history, or a trimmed copy of the list that fits budget."""
+        if not history or calculate_token_usage(history) <= budget:
+            self.anchor = None
+            return history
         
-        # Prioritize keeping recent messages
-        trimmed_messages = []
-        total_tokens = 0
+        prefix, pins, pin_sums = token_index(history)
+        start = 1 if history[0]["role"] == "system" else 0
+        budget -= prefix[start]
         
-        # Process messages from newest to oldest
-        for msg in reversed(messages_copy):
-            msg_tokens = estimate_tokens(msg["content"])
-            
-            if total_tokens + msg_tokens <= token_budget:
-                trimmed_messages.insert(0, msg)
-                total_tokens += msg_tokens
-            else:
-                # If we can't fit the whole message, we stop
-                # (alternatively, could truncate the message to fit)
-                break
+        index = self.anchor_index
+        if index is None or index >= len(history) or history[index] is not self.anchor:
+            index = None
+        if index is not None:
+            cut, first_pin = find_context_cut(prefix, pins, pin_sums, start, index, budget)
+            if cut != index:
+                index = None
+        if index is None:
+            cut, first_pin = find_context_cut(prefix, pins, pin_sums, start, start, budget * CONTEXT_TRIM_TARGET)
+            if cut < len(history):
+                self.anchor, self.anchor_index = history[cut], cut
+                logging.info(f"Context window moved to message {cut} of {len(history)}")
         
-        messages_copy = trimmed_messages
-    
-    # Reattach system message if it exists
-    if system_message:
-        return [system_message] + messages_copy
-    else:
-        return messages_copy
+        window = list(history[:start])
+        window.extend(history[i] for i in pins[first_pin:bisect_left(pins, cut)])
+        window.extend(history[cut:])
+        return window
+
+context_window = ContextWindow()
+
+# ===== Extractive Compression =====
+
+SENTENCE_RE = re.compile(r'\S[^.!?\n]*(?:[.!?\u2026]+["\'\u201d\u2019*)\]]*|$)', re.M)
+TERM_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset("""a an and are as at be but by for from had has have he her him his i if in into is it its
+me my no not of on or our she so than that the their them then there they this to up was we were what when
+which who will with you your""".split())
+
+def split_sentences(text):
+    return SENTENCE_RE.findall(text)
+
+def sentence_terms(sentence):
+    return [term for term in TERM_RE.findall(sentence.lower()) if term not in STOPWORDS]
+
+def score_sentences(sentence_term_lists, document_ids, document_count):
+    """TF-IDF score of each sentence, with document frequency counted per message.
+    
+    A sentence scores the summed IDF of its terms divided by the square root of
+    its length, so rare names and events outrank filler without simply
+    favouring long sentences. Uses numpy when available.
+    """
+    if numpy is not None and sentence_term_lists:
+        vocabulary = {}
+        term_ids = [vocabulary.setdefault(term, len(vocabulary)) for terms in sentence_term_lists for term in terms]
+        if not term_ids:
+            return [0.0] * len(sentence_term_lists)
+        lengths = numpy.fromiter(map(len, sentence_term_lists), dtype=numpy.int64, count=len(sentence_term_lists))
+        term_ids = numpy.array(term_ids)
+        owners = numpy.repeat(numpy.arange(len(sentence_term_lists)), lengths)
+        documents = numpy.array(document_ids)[owners]
+        # Each (document, term) pair counts once towards document frequency
+        pairs = numpy.unique(documents * len(vocabulary) + term_ids)
+        df = numpy.bincount(pairs % len(vocabulary), minlength=len(vocabulary))
+        idf = numpy.log((document_count + 1) / (df + 1)) + 1
+        totals = numpy.bincount(owners, weights=idf[term_ids], minlength=len(sentence_term_lists))
+        return (totals / numpy.sqrt(numpy.maximum(lengths, 1))).tolist()
+    
+    df = {}
+    seen = set()
+    for terms, document in zip(sentence_term_lists, document_ids):
+        for term in terms:
+            if (document, term) not in seen:
+                seen.add((document, term))
+                df[term] = df.get(term, 0) + 1
+    idf = {term: math.log((document_count + 1) / (count + 1)) + 1 for term, count in df.items()}
+    return [sum(idf[term] for term in terms) / math.sqrt(max(len(terms), 1)) for terms in sentence_term_lists]
+
+def extract_exchanges(exchanges, context_messages, token_budget):
+    """Keep the highest-scoring sentences of exchanges within token_budget.
+    
+    exchanges is a list of (user_text, assistant_text) pairs, either of which
+    may be None; context_messages (the messages kept verbatim) only add to
+    the document frequencies.
+    Returns one (user_text, assistant_text) pair per exchange holding the kept
+    sentences in their original order, or None for exchanges that lost all.
+    """
+    tokenizer = get_tokenizer()
+    sentences = []  # (exchange, side, position, text)
+    sentence_term_lists = []
+    document_ids = []
+    exchange_documents = {}
+    for number, exchange in enumerate(exchanges):
+        for side, text in enumerate(exchange):
+            if not text:
+                continue
+            exchange_documents[(number, side)] = len(exchange_documents)
+            for position, sentence in enumerate(split_sentences(text)):
+                sentences.append((number, side, position, sentence))
+                sentence_term_lists.append(sentence_terms(sentence))
+                document_ids.append(exchange_documents[(number, side)])
+    
+    # The rest of the session only adds to document frequencies
+    document_count = len(exchange_documents)
+    context_term_lists = []
+    context_ids = []
+    for msg in context_messages:
+        context_term_lists.append(sentence_terms(msg["content"]))
+        context_ids.append(document_count)
+        document_count += 1
+    scores = score_sentences(sentence_term_lists + context_term_lists, document_ids + context_ids, document_count)
+    
+    # The tokenizer's word cache is shared with the background compactor
+    with token_lock:
+        overhead = tokenizer.count("[COMPRESSED EXCHANGE] User: \nAssistant: ")
+        sentence_tokens = [tokenizer.count(sentence) for _, _, _, sentence in sentences]
+    opened = set()
+    kept = set()
+    used = 0
+    for index in sorted(range(len(sentences)), key=lambda i: -scores[i]):
+        number = sentences[index][0]
+        cost = sentence_tokens[index] + (0 if number in opened else overhead)
+        if used + cost > token_budget:
+            continue
+        used += cost
+        opened.add(number)
+        kept.add(index)
+    
+    result = [[[], []] for _ in exchanges]
+    for index in sorted(kept):
+        number, side, position, sentence = sentences[index]
+        result[number][side].append(sentence)
+    return [(" ".join(user) or None, " ".join(assistant) or None) if number in opened else None
+            for number, (user, assistant) in enumerate(result)]
 
 # New function to compress older messages to save tokens
-def compress_older_messages(messages_list, threshold=20):
-    """Compress older messages to save on tokens while preserving context."""
+def compress_older_messages(messages_list, threshold=20, token_budget=None):
+    """Compress older messages to save on tokens while preserving context.
+    
+    Older user/assistant exchanges are reduced to their highest-value
+    sentences (extractive TF-IDF scoring, no model call) until token_budget is
+    met; by default COMPRESSION_RATIO of their current size. Pinned messages
+    such as summaries and chapter markers are kept as they are.
+    """
     if not messages_list or len(messages_list) <= threshold:
         return messages_list
     
-    # Make a copy to avoid modifying the original
-    messages_copy = deepcopy(messages_list)
+    # Copy the list; the message records themselves are shared
+    messages_copy = list(messages_list)
     
     # Extract system message
     system_message = None
@@ -871,29 +3135,48 @@ def compress_older_messages(messages_list, threshold=20):
             return [system_message] + recent_messages
         return recent_messages
     
-    # Compress older messages by summarizing user-assistant exchanges
-    compressed_messages = []
+    # Group older messages into exchanges; pinned messages stay in place
+    layout = []  # ("pinned", msg) or ("exchange", index)
+    exchanges = []
     i = 0
-    
     while i < len(older_messages):
-        if i+1 < len(older_messages) and older_messages[i]["role"] == "user" and older_messages[i+1]["role"] == "assistant":
-            # Compress user-assistant pair
-            user_content = older_messages[i]["content"]
-            assistant_content = older_messages[i+1]["content"]
-            
-            # Create a compressed summary
-            compressed_content = f"[COMPRESSED EXCHANGE] User: {user_content[:100]}{'...' if len(user_content) > 100 else ''}\nAssistant: {assistant_content[:150]}{'...' if len(assistant_content) > 150 else ''}"
-            
-            compressed_messages.append({
-                "role": "system",  # Use system role for compressed content
-                "content": compressed_content
-            })
+        msg = older_messages[i]
+        if is_pinned_message(msg):
+            layout.append(("pinned", msg))
+            i += 1
+        elif msg["role"] == "user" and i + 1 < len(older_messages) and older_messages[i+1]["role"] == "assistant":
+            layout.append(("exchange", len(exchanges)))
+            exchanges.append((msg["content"], older_messages[i+1]["content"]))
             i += 2  # Skip both messages
         else:
-            # Keep single messages (should be rare due to alternating nature)
-            compressed_messages.append(older_messages[i])
+            # Single messages (should be rare due to alternating nature)
+            layout.append(("exchange", len(exchanges)))
+            exchanges.append((msg["content"], None) if msg["role"] == "user" else (None, msg["content"]))
             i += 1
     
+    if token_budget is None:
+        exchange_tokens = sum(estimate_tokens(text) for exchange in exchanges for text in exchange if text)
+        token_budget = int(exchange_tokens * COMPRESSION_RATIO)
+    extracted = extract_exchanges(exchanges, recent_messages, token_budget)
+    
+    compressed_messages = []
+    for kind, item in layout:
+        if kind == "pinned":
+            compressed_messages.append(item)
+            continue
+        if extracted[item] is None:
+            continue
+        user_text, assistant_text = extracted[item]
+        lines = ["[COMPRESSED EXCHANGE]"]
+        if user_text:
+            lines[0] += f" User: {user_text}"
+        if assistant_text:
+            lines.append(f"Assistant: {assistant_text}")
+        compressed_messages.append({
+            "role": "system",  # Use system role for compressed content
+            "content": "\n".join(lines)
+        })
+    
     # Combine everything
     result = []
     if system_message:
@@ -903,40 +3186,586 @@ def compress_older_messages(messages_list, threshold=20):
     
     return result
 
+# ===== End Extractive Compression =====
+
+# ===== Retrieval Memory =====
+
+RECALL_HEADER = "Recalled from earlier in the story (for consistency; these events already happened):"
+
+class StoryMemory:
+    """BM25 index over every message written in a session, trimmed ones included.
+    
+    Messages are appended to a JSONL file next to the session the first time
+    they are seen, so the index outlives trimming, compression and restarts.
+    Each message is indexed as passages of a few sentences; recall() returns
+    the passages that best match a query, skipping messages still in the
+    prompt.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.semantic = None  # SemanticIndex over the same passages, when enabled
+        self.clear()
+
+    def clear(self):
+        self.digests = set()
+        self.forgotten = set()
+        self.passages = []  # (digest, role, text)
+        self.lengths = []
+        self.total_length = 0
+        self.postings = {}  # term -> {passage id: term frequency}
+
+    @staticmethod
+    def path_for(session_file):
+        """The memory file belonging to a session file, or to the unsaved session."""
+        if not session_file:
+            return os.path.join(sessions_dir, ".temp_session.memory.jsonl")
+        return os.path.splitext(session_file)[0] + ".memory.jsonl"
+
+    @staticmethod
+    def split_passages(text):
+        """Group sentences into passages of up to RETRIEVAL_PASSAGE_CHARS."""
+        passages = []
+        current = ""
+        for sentence in split_sentences(text):
+            if current and len(current) + len(sentence) >= RETRIEVAL_PASSAGE_CHARS:
+                passages.append(current)
+                current = ""
+            current = f"{current} {sentence}" if current else sentence
+        if current:
+            passages.append(current)
+        return passages
+
+    def index(self, digest, role, content):
+        self.digests.add(digest)
+        for text in self.split_passages(content):
+            passage_id = len(self.passages)
+            terms = sentence_terms(text)
+            self.passages.append((digest, role, text))
+            self.lengths.append(len(terms))
+            self.total_length += len(terms)
+            for term in terms:
+                postings = self.postings.setdefault(term, {})
+                postings[passage_id] = postings.get(passage_id, 0) + 1
+
+    def load(self, path):
+        """Switch to the memory file at path and index what it holds."""
+        self.path = path
+        self.clear()
+        if not os.path.exists(path):
+            if self.semantic is not None:
+                self.semantic.open(self.path, self.passages)
+            return
+        with open(path, 'r') as f:
+            for line_number, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping unreadable line {line_number + 1} of {path}")
+                    continue
+                if "forget" in entry:
+                    self.forgotten.add(entry["forget"])
+                    continue
+                self.forgotten.discard(entry["digest"])
+                if entry["digest"] not in self.digests:
+                    self.index(entry["digest"], entry["role"], entry["content"])
+        logging.info(f"Story memory loaded: {len(self.digests)} messages, {len(self.passages)} passages")
+        if self.semantic is not None:
+            self.semantic.open(self.path, self.passages)
+
+    def append(self, entries):
+        if entries:
+            with open(self.path, 'a') as f:
+                f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+
+    def sync(self, history):
+        """Index and store the messages of history not seen before."""
+        first_passage = len(self.passages)
+        entries = []
+        for msg in history:
+            if msg["role"] not in ("user", "assistant") or is_pinned_message(msg):
+                continue
+            digest = get_message_hash(msg)
+            if digest in self.digests and digest not in self.forgotten:
+                continue
+            if digest in self.forgotten:
+                self.forgotten.discard(digest)
+            else:
+                self.index(digest, msg["role"], msg["content"])
+            entries.append({"digest": digest, "role": msg["role"], "content": msg["content"]})
+        self.append(entries)
+        if self.semantic is not None:
+            self.semantic.enqueue(first_passage, self.passages[first_passage:])
+
+    def forget(self, msgs):
+        """Stop recalling messages that were taken back (undo)."""
+        entries = []
+        for msg in msgs:
+            digest = get_message_hash(msg)
+            if digest in self.digests and digest not in self.forgotten:
+                self.forgotten.add(digest)
+                entries.append({"forget": digest})
+        self.append(entries)
+
+    def save_as(self, path):
+        """Continue in the memory file of a session saved under a new name."""
+        if path == self.path:
+            return
+        if self.semantic is not None:
+            self.semantic.save_as(self.path, path)
+        move_or_copy_file(self.path, path, move=self.path == self.path_for(None))
+        self.path = path
+
+    def reset(self):
+        """Start an empty memory for a new unsaved story."""
+        self.path = self.path_for(None)
+        self.clear()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.semantic is not None:
+            self.semantic.reset(self.path)
+
+    def rank(self, query):
+        """Passage ids matching query by BM25 score, best first."""
+        if not self.passages:
+            return []
+        count = len(self.passages)
+        average_length = self.total_length / count or 1
+        scores = {}
+        for term in set(sentence_terms(query)):
+            postings = self.postings.get(term)
+            # Terms in most passages barely change the ranking but dominate the cost
+            if not postings or len(postings) * 2 > count:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for passage_id, frequency in postings.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[passage_id] / average_length)
+                scores[passage_id] = scores.get(passage_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return sorted(scores, key=scores.get, reverse=True)
+
+    def select(self, rankings, exclude, budget):
+        """Take up to limit passages from each (ranked ids, limit) pair within budget tokens.
+        
+        exclude holds digests of messages that are already in the prompt.
+        Returns (digest, role, text) passages, oldest first.
+        """
+        chosen = set()
+        used = 0
+        for ranked, limit in rankings:
+            taken = 0
+            for passage_id in ranked:
+                if taken >= limit:
+                    break
+                digest, role, text = self.passages[passage_id]
+                if passage_id in chosen or digest in exclude or digest in self.forgotten:
+                    continue
+                cost = estimate_tokens(text) + 4  # Speaker label and separator
+                if used + cost > budget:
+                    continue
+                chosen.add(passage_id)
+                used += cost
+                taken += 1
+        return [self.passages[i] for i in sorted(chosen)]
+
+story_memory = StoryMemory(StoryMemory.path_for(None))
+
+def move_or_copy_file(source, destination, move=False):
+    """Move or atomically copy source to destination if it exists."""
+    if not os.path.exists(source):
+        return
+    if move:
+        os.replace(source, destination)
+        return
+    with open(source, 'rb') as src, open(destination + ".tmp", 'wb') as dst:
+        while True:
+            block = src.read(1 << 20)
+            if not block:
+                break
+            dst.write(block)
+    os.replace(destination + ".tmp", destination)
+
+def build_recall_block(window):
+    """Passages from outside window that relate to the newest narration."""
+    query = next((msg["content"] for msg in reversed(window) if msg["role"] == "user"), None)
+    if not query:
+        return ""
+    exclude = {get_message_hash(msg) for msg in window}
+    rankings = [(story_memory.rank(query), RETRIEVAL_TOP_K)]
+    if story_memory.semantic is not None:
+        # Most of the closest passages are usually still in the window
+        rankings.append((story_memory.semantic.rank(query, SEMANTIC_TOP_K + 3 * len(window)), SEMANTIC_TOP_K))
+    passages = story_memory.select(rankings, exclude, RETRIEVAL_SLOT_TOKENS - estimate_tokens(RECALL_HEADER))
+    if not passages:
+        return ""
+    return RECALL_HEADER + "\n\n" + format_transcript({"role": role, "content": text} for digest, role, text in passages)
+
+# ===== End Retrieval Memory =====
+
+# ===== Semantic Memory =====
+
+def request_embeddings(http, texts):
+    """Embed texts with EMBED_MODEL; returns unit-length float32 rows."""
+    response = http.post(EMBED_URL, json={"model": EMBED_MODEL, "input": texts},
+                         timeout=(HTTP_CONNECT_TIMEOUT, EMBED_TIMEOUT))
+    if response.status_code != 200:
+        raise APIError(response.status_code, response.text)
+    vectors = numpy.asarray(response.json()["embeddings"], dtype=numpy.float32)
+    if vectors.shape[0] != len(texts):
+        raise ValueError(f"Expected {len(texts)} embeddings, got {vectors.shape[0]}")
+    return vectors / numpy.maximum(numpy.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+class EmbeddingCache:
+    """SQLite store of embedding vectors by model and text hash; least recently used go first."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            vector BLOB NOT NULL,
+            used REAL NOT NULL
+        )""")
+        connection.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        return connection
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(f"{EMBED_MODEL}\n{text}".encode()).hexdigest()
+
+    def get_many(self, keys):
+        """Cached vectors for keys, as {key: vector}; marks them as used."""
+        found = {}
+        connection = self.connect()
+        try:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                found.update((key, numpy.frombuffer(vector, dtype=numpy.float32)) for key, vector in rows)
+            if found:
+                now = datetime.datetime.now().timestamp()
+                with connection:
+                    connection.executemany("UPDATE embeddings SET used = ? WHERE key = ?", [(now, key) for key in found])
+        finally:
+            connection.close()
+        return found
+
+    def put_many(self, items, limit=EMBEDDING_CACHE_MAX_ENTRIES):
+        """Store (key, vector) pairs and evict the least recently used beyond limit."""
+        now = datetime.datetime.now().timestamp()
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector, used) VALUES (?, ?, ?)",
+                                       [(key, vector.astype(numpy.float32).tobytes(), now) for key, vector in items])
+                excess = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - limit
+                if excess > 0:
+                    connection.execute("DELETE FROM embeddings WHERE key IN "
+                                       "(SELECT key FROM embeddings ORDER BY used LIMIT ?)", (excess,))
+        finally:
+            connection.close()
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_FILE)
+
+class SemanticIndex:
+    """Embedding vectors of the story memory's passages, for similarity recall.
+    
+    Vectors are unit-length float32 rows appended to <session>.vectors.f32,
+    which is memory-mapped for search; <session>.vectors.keys names the model
+    and dimension, then the text hash of each row. New passages are embedded
+    in batches on a worker thread, through embedding_cache first, so content
+    seen before in any session is never sent to the backend again. After an
+    embedding error, similarity recall is skipped for SEMANTIC_RETRY_SECONDS;
+    the next recall after that retries, and the failed batch stays queued.
+    """
+
+    def __init__(self, memory_path):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.http = requests.Session()  # For query embeddings on the caller's thread
+        self.generation = 0
+        self.error = None
+        self.error_reported = False
+        self.retry_at = 0  # Timestamp before which the backend is not tried again
+        self.base = memory_path
+        self.pending = {}  # key -> text still to embed
+        self.key_passage = {}  # key -> first story memory passage id with that text
+        self.keys = []
+        self.rows = {}
+        self.dim = None
+        self.matrix = None
+
+    @staticmethod
+    def paths_for(memory_path):
+        base = memory_path[:-len(".memory.jsonl")] if memory_path.endswith(".memory.jsonl") else memory_path
+        return base + ".vectors.f32", base + ".vectors.keys"
+
+    def open(self, memory_path, passages):
+        """Switch to the vector files next to memory_path and queue passages missing from them."""
+        with self.lock:
+            self.generation += 1
+            self.error = None
+            self.error_reported = False
+            self.retry_at = 0
+            self.base = memory_path
+            self.pending = {}
+            self.key_passage = {}
+            self.keys, self.rows, self.dim, self.matrix = [], {}, None, None
+            self.read()
+        self.enqueue(0, passages)
+
+    def read(self):
+        vectors_path, keys_path = self.paths_for(self.base)
+        if not os.path.exists(keys_path) or not os.path.exists(vectors_path):
+            return
+        with open(keys_path, 'r') as f:
+            lines = f.read().split("\n")
+        header = lines[0].split(" ", 1)
+        if len(header) != 2 or header[1] != EMBED_MODEL:
+            logging.info(f"Discarding vectors of another embedding model in {vectors_path}")
+            self.remove_files()
+            return
+        dim = int(header[0])
+        keys = [line for line in lines[1:] if line]
+        count = min(len(keys), os.path.getsize(vectors_path) // (4 * dim))
+        if count < len(keys) or os.path.getsize(vectors_path) > count * 4 * dim:
+            # A torn append from a crash: drop the incomplete tail
+            logging.warning(f"Truncating {vectors_path} to {count} complete rows")
+            with open(vectors_path, 'r+b') as f:
+                f.truncate(count * 4 * dim)
+            with open(keys_path, 'w') as f:
+                f.write("".join(line + "\n" for line in [lines[0]] + keys[:count]))
+        self.dim = dim
+        self.keys = keys[:count]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.remap()
+
+    def remap(self):
+        vectors_path, _ = self.paths_for(self.base)
+        if self.keys:
+            self.matrix = numpy.memmap(vectors_path, dtype=numpy.float32, mode='r', shape=(len(self.keys), self.dim))
+
+    def remove_files(self):
+        for path in self.paths_for(self.base):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def reset(self, memory_path):
+        """Start empty vector files for a new unsaved story."""
+        with self.lock:
+            self.base = memory_path
+            self.remove_files()
+        self.open(memory_path, [])
+
+    def save_as(self, memory_path, new_memory_path):
+        """Carry the vectors over to a session saved under a new name."""
+        with self.lock:
+            for source, destination in zip(self.paths_for(memory_path), self.paths_for(new_memory_path)):
+                move_or_copy_file(source, destination, move=memory_path == StoryMemory.path_for(None))
+            self.base = new_memory_path
+            self.remap()
+
+    def enqueue(self, first_id, passages):
+        """Queue new story memory passages for embedding in the background."""
+        with self.lock:
+            for passage_id, (digest, role, text) in enumerate(passages, first_id):
+                key = EmbeddingCache.key(text)
+                self.key_passage.setdefault(key, passage_id)
+                if key not in self.rows:
+                    self.pending[key] = text
+            self.start_worker()
+
+    def start_worker(self):
+        """Embed pending passages unless already running or backing off; the caller holds the lock."""
+        if not self.pending or self.thread is not None:
+            return
+        if self.error is not None:
+            if datetime.datetime.now().timestamp() < self.retry_at:
+                return
+            self.error = None
+        self.thread = threading.Thread(target=self.run, name="embedder", daemon=True)
+        self.thread.start()
+
+    def fail(self, error):
+        """Record an embedding error and back off; the caller holds the lock."""
+        self.error = error
+        self.retry_at = datetime.datetime.now().timestamp() + SEMANTIC_RETRY_SECONDS
+
+    def run(self):
+        http = requests.Session()
+        while True:
+            with self.lock:
+                batch = list(islice(self.pending.items(), EMBED_BATCH_SIZE))
+                generation = self.generation
+                if not batch:
+                    self.thread = None
+                    return
+            try:
+                keys = [key for key, text in batch]
+                vectors = embedding_cache.get_many(keys)
+                missing = [(key, text) for key, text in batch if key not in vectors]
+                if missing:
+                    fresh = request_embeddings(http, [text for key, text in missing])
+                    embedding_cache.put_many(list(zip([key for key, text in missing], fresh)))
+                    vectors.update(zip([key for key, text in missing], fresh))
+            except Exception as e:
+                # The batch is still pending, so it is retried once the backoff ends
+                logging.error(f"Embedding failed: {str(e)}; retrying in {SEMANTIC_RETRY_SECONDS}s")
+                with self.lock:
+                    self.fail(str(e))
+                    self.thread = None
+                return
+            with self.lock:
+                # Vectors for a session that was switched away from stay in the cache
+                if generation == self.generation:
+                    self.append([(key, vectors[key]) for key in keys])
+
+    def append(self, items):
+        """Append rows for (key, vector) pairs; the caller holds the lock."""
+        items = [(key, vector) for key, vector in items if key not in self.rows]
+        for key, vector in items:
+            self.pending.pop(key, None)
+        if not items:
+            return
+        if self.dim is None:
+            self.dim = len(items[0][1])
+        vectors_path, keys_path = self.paths_for(self.base)
+        if not self.keys:
+            with open(keys_path, 'w') as f:
+                f.write(f"{self.dim} {EMBED_MODEL}\n")
+            open(vectors_path, 'wb').close()
+        with open(vectors_path, 'ab') as f:
+            f.write(numpy.stack([vector for key, vector in items]).astype(numpy.float32).tobytes())
+        with open(keys_path, 'a') as f:
+            f.write("".join(key + "\n" for key, vector in items))
+        for key, vector in items:
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+        self.remap()
+
+    def rank(self, query, limit):
+        """Up to limit story memory passage ids by cosine similarity to query, best first."""
+        with self.lock:
+            if self.error is not None and datetime.datetime.now().timestamp() >= self.retry_at:
+                self.error = None
+            self.start_worker()
+            matrix, keys, key_passage, error = self.matrix, self.keys, self.key_passage, self.error
+        if matrix is not None and error is None:
+            try:
+                vector = request_embeddings(self.http, [query])[0]
+            except Exception as e:
+                logging.error(f"Query embedding failed: {str(e)}; retrying in {SEMANTIC_RETRY_SECONDS}s")
+                error = str(e)
+                with self.lock:
+                    self.fail(error)
+            else:
+                if self.error_reported:
+                    print("[Semantic memory available again]")
+                    logging.info("Semantic memory recovered")
+                    self.error_reported = False
+        if error is not None:
+            if not self.error_reported:
+                print(f"[Semantic memory unavailable ({error}); using keyword recall only]")
+                self.error_reported = True
+            return []
+        if matrix is None:
+            return []
+        scores = matrix @ vector
+        count = min(limit, len(scores))
+        top = numpy.argpartition(-scores, count - 1)[:count]
+        top = top[numpy.argsort(-scores[top])]
+        return [key_passage[keys[row]] for row in top if keys[row] in key_passage]
+
+if SEMANTIC_MEMORY:
+    if numpy is None:
+        logging.warning("SEMANTIC_MEMORY needs numpy; similarity recall is disabled")
+    else:
+        story_memory.semantic = SemanticIndex(story_memory.path)
+
+# ===== End Semantic Memory =====
+
 def load_session():
     """Load a session with improved error checking and context validation."""
-    global messages, current_session_name, current_session_file, current_story, current_facts
-    
-    session_files = [f for f in os.listdir(sessions_dir) if f.endswith('.json') and not f.startswith('.')]
-    if not session_files:
-        print("No saved sessions found.")
-        return
-    
-    print("\nAvailable sessions:")
-    for i, session_file in enumerate(session_files, 1):
-        session_name = session_file[:-5]
-        print(f"{i}. {session_name}")
+    global messages, current_session_name, current_session_file, current_story, current_facts, pending_system_prompt, summary_state, current_archive
     
+    sort = "modified"
+    text = None
     try:
-        choice = input("\nEnter session number to load (or press Enter to cancel): ")
-        if not choice:
-            print("Loading cancelled.")
-            return
+        while True:
+            try:
+                rows = session_catalog.query(sort, text)
+            except Exception as e:
+                # Fall back to a plain listing if the catalog is unusable
+                logging.error(f"Session catalog error: {str(e)}")
+                rows = [{"name": f[:-5], "story_title": None, "message_count": None, "token_count": None,
+                         "mtime_ns": os.stat(os.path.join(sessions_dir, f)).st_mtime_ns,
+                         "unsaved_at": None, "preview": None}
+                        for f in sorted(os.listdir(sessions_dir)) if f.endswith('.json') and not f.startswith('.')]
+            if not rows and not text:
+                print("No saved sessions found.")
+                return
+            
+            print(f"\nAvailable sessions (sorted by {sort}{', matching ' + repr(text) if text else ''}):")
+            print_session_catalog(rows[:SESSION_LIST_LIMIT])
+            if len(rows) > SESSION_LIST_LIMIT:
+                print(f"      ... {len(rows) - SESSION_LIST_LIMIT} more; filter to narrow the list")
+            rows = rows[:SESSION_LIST_LIMIT]
+            print(f"\nSort with 's <{'|'.join(SessionCatalog.SORT_COLUMNS)}>', filter with 'f <text>' ('f' alone clears).")
+            choice = input("Enter session number to load (or press Enter to cancel): ").strip()
+            if not choice:
+                print("Loading cancelled.")
+                return
+            if choice.lower().startswith("s ") or choice.lower() == "s":
+                requested = choice[1:].strip().lower()
+                if requested in SessionCatalog.SORT_COLUMNS:
+                    sort = requested
+                else:
+                    unknown = f"Unknown sort '{requested}'. " if requested else ""
+                    print(f"{unknown}Sort by one of: {', '.join(SessionCatalog.SORT_COLUMNS)}.")
+                continue
+            if choice.lower().startswith("f ") or choice.lower() == "f":
+                text = choice[1:].strip() or None
+                continue
+            break
         
         choice = int(choice)
-        if choice < 1 or choice > len(session_files):
+        if choice < 1 or choice > len(rows):
             print("Invalid selection.")
             return
         
-        selected_file = session_files[choice-1]
+        selected_file = rows[choice-1]["name"] + ".json"
         filepath = os.path.join(sessions_dir, selected_file)
         
         # Create backup before loading
         create_backup(filepath)
         
+        # Index everything as it streams past, so trimmed messages can still be recalled
+        pending_memory = []
+        
+        def index_message(msg):
+            pending_memory.append(msg)
+            if len(pending_memory) >= SESSION_SEGMENT_MESSAGES:
+                sync_memory()
+        
+        def sync_memory():
+            try:
+                story_memory.sync(pending_memory)
+            except Exception as e:
+                logging.error(f"Error indexing story memory: {str(e)}")
+            pending_memory.clear()
+        
         try:
-            with open(filepath, 'r') as f:
-                session_data = json.load(f)
+            story_memory.load(StoryMemory.path_for(filepath))
+        except Exception as e:
+            logging.error(f"Error loading story memory: {str(e)}")
+        loader = ContextWindowLoader(NUM_CTX, MAX_MESSAGES, on_message=index_message)
+        try:
+            session_data = stream_session_file(filepath, loader.add)
+            sync_memory()
         except json.JSONDecodeError:
             logging.error(f"Error: Invalid JSON in session file {selected_file}")
             print(f"Error: The session file is corrupted.")
@@ -947,11 +3776,12 @@ def load_session():
             return
             
         # Check file format
-        if isinstance(session_data, dict) and "messages" in session_data:
+        if isinstance(session_data, dict):
             # Modern format with version and additional metadata
-            loaded_messages = session_data.get("messages", [])
             loaded_story = session_data.get("story_setting")
             loaded_facts = session_data.get("facts", [])
+            loaded_pending_prompt = session_data.get("pending_system_prompt")
+            loaded_summary_state = session_data.get("summary_state") or new_summary_state()
             version = session_data.get("version", 0)
             
             if version > SESSION_FORMAT_VERSION:
@@ -962,37 +3792,32 @@ def load_session():
                 current_story = loaded_story
         else:
             # Legacy format (just a list of messages)
-            loaded_messages = session_data
             loaded_story = None
             loaded_facts = []
+            loaded_pending_prompt = None
+            loaded_summary_state = new_summary_state()
             print("Note: Loading legacy session format (pre-versioning)")
         
-        # Validate message format
-        valid_messages = validate_messages(loaded_messages)
-        if len(valid_messages) != len(loaded_messages):
-            print(f"Warning: {len(loaded_messages) - len(valid_messages)} invalid messages were found and removed.")
-            loaded_messages = valid_messages
-        
-        # Check for duplicates
-        unique_messages = remove_duplicate_messages(loaded_messages)
-        if len(unique_messages) != len(loaded_messages):
-            print(f"Note: {len(loaded_messages) - len(unique_messages)} duplicate messages were found and removed.")
-            loaded_messages = unique_messages
+        # Validation and duplicate removal happened while streaming
+        if loader.invalid:
+            print(f"Warning: {loader.invalid} invalid messages were found and removed.")
+        if loader.duplicates:
+            print(f"Note: {loader.duplicates} duplicate messages were found and removed.")
         
-        # Track original message count for reporting
-        original_message_count = len(loaded_messages)
-        
-        # Trim messages to fit within context limits
-        messages[:] = trim_messages_to_fit(loaded_messages, NUM_CTX, MAX_MESSAGES)
+        # Only the messages that fit within context limits were kept
+        messages[:] = loader.result()
         
         # Report on trimming
-        trimmed_count = original_message_count - len(messages)
+        trimmed_count = loader.accepted - len(messages)
         if trimmed_count > 0:
             print(f"Trimmed {trimmed_count} older messages to fit within context limits.")
         
         # Set session information
         current_session_name = selected_file[:-5]
         current_session_file = filepath
+        if current_archive is not None:
+            current_archive.close()
+        current_archive = None
         
         # Load facts if they exist
         if not loaded_facts and current_session_name:
@@ -1002,12 +3827,11 @@ def load_session():
             current_facts = loaded_facts
             print(f"Loaded {len(loaded_facts)} story facts.")
         
-        # Make sure facts are appended to system prompt and no duplicates
+        # Make sure facts are placed in the system prompt without duplicates
         if messages and messages[0]["role"] == "system":
-            # Clean the system prompt first to remove any duplicates
-            system_prompt = clean_system_prompt(messages[0]["content"])
-            # Then append facts
-            messages[0]["content"] = append_facts_to_prompt(system_prompt)
+            messages.set_content(0, compose_system_prompt(messages[0]["content"]))
+        pending_system_prompt = loaded_pending_prompt
+        summary_state = loaded_summary_state
         
         # Report on context
         token_count = calculate_token_usage(messages)
@@ -1054,7 +3878,7 @@ def verify_context_integrity():
     return True
 
 def set_system_prompt():
-    global messages, current_story
+    global messages, current_story, pending_system_prompt
     
     print("Enter new system prompt (press Enter on blank line to finish):")
     lines = []
@@ -1073,18 +3897,15 @@ def set_system_prompt():
     
     new_system_prompt = "\n".join(lines)
     
-    # Clean the prompt and append facts
-    new_system_prompt = clean_system_prompt(new_system_prompt)
-    new_system_prompt = append_facts_to_prompt(new_system_prompt)
+    # Clean the prompt and place facts
+    new_system_prompt = compose_system_prompt(new_system_prompt)
     
     # Backup current messages before modifying
-    old_messages = deepcopy(messages)
+    old_messages = messages.copy()
+    old_pending_prompt = pending_system_prompt
     
     try:
-        if messages and messages[0]["role"] == "system":
-            messages[0]["content"] = new_system_prompt
-        else:
-            messages.insert(0, {"role": "system", "content": new_system_prompt})
+        install_system_prompt(new_system_prompt)
         
         if current_story:
             keep_story = input("Keep current story setting metadata? (y/n): ").lower()
@@ -1098,13 +3919,15 @@ def set_system_prompt():
             print("Warning: Context integrity check failed after system prompt update.")
             restore = input("Restore previous system prompt? (y/n): ").lower()
             if restore == 'y':
-                messages = old_messages
+                messages[:] = old_messages
+                pending_system_prompt = old_pending_prompt
                 print("Previous system prompt restored.")
         
     except Exception as e:
         logging.error(f"Error updating system prompt: {str(e)}")
         print(f"Error updating system prompt: {str(e)}")
-        messages = old_messages
+        messages[:] = old_messages
+        pending_system_prompt = old_pending_prompt
     
     save_temp_session()
 
@@ -1270,14 +4093,10 @@ def update_system_prompt_with_facts():
     if not messages or messages[0]["role"] != "system":
         return
     
-    system_prompt = messages[0]["content"]
-    
-    # First clean the system prompt to avoid duplicates
-    system_prompt = clean_system_prompt(system_prompt)
-    
-    # Then append facts (which has its own logic to avoid fact duplicates)
-    system_prompt = append_facts_to_prompt(system_prompt)
-    messages[0]["content"] = system_prompt
+    # In stable mode the facts are sent in the context block, so the
+    # system prompt (and the backend's cached prefix) stays untouched
+    if PROMPT_ASSEMBLY_MODE != "stable":
+        messages.set_content(0, compose_system_prompt(messages[0]["content"]))
     
     # Save facts to file if we have an active session
     if current_session_file:
@@ -1315,6 +4134,9 @@ def show_story_info():
             print(messages[0]["content"])
         else:
             print(current_story.get('system_prompt', 'No system prompt available.'))
+        if pending_system_prompt:
+            print("\nPending system prompt update (sent in the context block):")
+            print(pending_system_prompt)
     
     # Show context stats
     if messages:
@@ -1323,6 +4145,13 @@ def show_story_info():
         print(f"- Total messages: {len(messages)}")
         print(f"- Estimated tokens: {token_count}/{NUM_CTX}")
         print(f"- Context usage: {token_count/NUM_CTX*100:.1f}%")
+        tokenizer = get_tokenizer()
+        calibration = getattr(tokenizer, "calibration_samples", 0)
+        print(f"- Token counter: {tokenizer.name}" + (f" (calibrated on {calibration} samples)" if calibration else ""))
+        if NUM_CTX_BUCKETS and context_bucketer.current:
+            print(f"- Context bucket (num_ctx): {context_bucketer.current}")
+        if prompt_cache_stats.last:
+            print(f"- Last request: {prompt_cache_stats.describe()}")
         
         # Check if compression might be helpful
         if len(messages) > 20 and token_count > NUM_CTX * 0.7:
@@ -1342,7 +4171,8 @@ def manage_story_settings():
         choice = input("\nEnter your choice (1-5): ")
         
         if choice == "1":
-            story_files = [f for f in os.listdir(story_settings_dir) if f.endswith('.json')]
+            entries = story_setting_index.entries()
+            story_files = [filename for filename, _ in entries]
             if not story_files:
                 print("No saved story settings found.")
                 create_new = input("Would you like to create a new story setting? (y/n): ").lower()
@@ -1353,12 +4183,7 @@ def manage_story_settings():
                 continue
             
             print("\nAvailable story settings:")
-            for i, story_file in enumerate(story_files, 1):
-                story_title = story_file[:-5].replace('_', ' ').title()
-                if current_story and story_title.lower() == current_story.get("title", "").lower():
-                    print(f"{i}. {story_title} (current)")
-                else:
-                    print(f"{i}. {story_title}")
+            print_index_entries(entries, current_story.get("title") if current_story else None)
             
             try:
                 choice = input("\nEnter story number to load (or press Enter to cancel): ")
@@ -1410,15 +4235,14 @@ def manage_story_settings():
 
 def edit_story_setting():
     """Edit an existing story setting."""
-    story_files = [f for f in os.listdir(story_settings_dir) if f.endswith('.json')]
+    entries = story_setting_index.entries()
+    story_files = [filename for filename, _ in entries]
     if not story_files:
         print("No saved story settings found.")
         return
     
     print("\nAvailable story settings to edit:")
-    for i, story_file in enumerate(story_files, 1):
-        story_title = story_file[:-5].replace('_', ' ').title()
-        print(f"{i}. {story_title}")
+    print_index_entries(entries)
     
     try:
         choice = input("\nEnter story number to edit (or press Enter to cancel): ")
@@ -1550,15 +4374,14 @@ def delete_story_setting():
     """Delete an existing story setting."""
     global current_story  # Moved to the top of the function
     
-    story_files = [f for f in os.listdir(story_settings_dir) if f.endswith('.json')]
+    entries = story_setting_index.entries()
+    story_files = [filename for filename, _ in entries]
     if not story_files:
         print("No saved story settings found.")
         return
     
     print("\nAvailable story settings to delete:")
-    for i, story_file in enumerate(story_files, 1):
-        story_title = story_file[:-5].replace('_', ' ').title()
-        print(f"{i}. {story_title}")
+    print_index_entries(entries)
     
     try:
         choice = input("\nEnter story number to delete (or press Enter to cancel): ")
@@ -1592,70 +4415,423 @@ def delete_story_setting():
         create_backup(filepath)
         
         try:
-            os.remove(filepath)
-            print(f"Story setting '{story_title}' deleted.")
-            
-            # If this was the current story, clear it
-            if current_story and current_story.get('title') == story_title:
-                current_story = None
-                print("Note: Deleted the currently active story setting.")
-        
-        except Exception as e:
-            logging.error(f"Error deleting story setting: {str(e)}")
-            print(f"Error deleting story setting: {str(e)}")
-    
-    except (ValueError, IndexError) as e:
-        logging.error(f"Error selecting story setting: {str(e)}")
-        print(f"Error selecting story setting: {str(e)}")
+            os.remove(filepath)
+            print(f"Story setting '{story_title}' deleted.")
+            
+            # If this was the current story, clear it
+            if current_story and current_story.get('title') == story_title:
+                current_story = None
+                print("Note: Deleted the currently active story setting.")
+        
+        except Exception as e:
+            logging.error(f"Error deleting story setting: {str(e)}")
+            print(f"Error deleting story setting: {str(e)}")
+    
+    except (ValueError, IndexError) as e:
+        logging.error(f"Error selecting story setting: {str(e)}")
+        print(f"Error selecting story setting: {str(e)}")
+
+# ===== API Client Functions =====
+
+class APIError(Exception):
+    """Raised when the API answers with a non-200 status code."""
+
+    def __init__(self, status_code, text):
+        super().__init__(f"API returned status code {status_code}")
+        self.status_code = status_code
+        self.text = text
+
+class NDJSONDecoder:
+    """Incrementally decode newline-delimited JSON from a byte stream."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Add raw bytes and yield every complete object received so far."""
+        self._buffer += data
+        end = self._buffer.rfind(b"\n")
+        if end < 0:
+            return
+        complete = bytes(self._buffer[:end])
+        del self._buffer[:end + 1]
+        for line in complete.split(b"\n"):
+            chunk = self._decode(line)
+            if chunk is not None:
+                yield chunk
+
+    def flush(self):
+        """Yield a trailing object that was not terminated by a newline."""
+        line = bytes(self._buffer)
+        self._buffer.clear()
+        chunk = self._decode(line)
+        if chunk is not None:
+            yield chunk
+
+    def _decode(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            logging.error(f"Error decoding JSON from API: {line}")
+            print(f"\nError decoding response chunk")
+            return None
+
+def resolve_generation_options(profile):
+    """Return the request options for a generation profile."""
+    if profile not in GENERATION_PROFILES:
+        raise KeyError(f"Unknown generation profile: {profile}")
+    options = dict(BASE_GENERATION_OPTIONS)
+    options.update(GENERATION_PROFILES[profile])
+    return options
+
+class ReloadGuard:
+    """Detect option changes that would force the backend to reload a model."""
+
+    def __init__(self):
+        self.loaded = {}  # model -> load options of the last request sent
+
+    def check(self, model, options, profile):
+        """Record the options about to be sent and report changes that trigger a reload."""
+        load_options = {key: options.get(key) for key in MODEL_LOAD_OPTIONS}
+        previous = self.loaded.get(model)
+        self.loaded[model] = load_options
+        if previous is None:
+            return []
+        changed = [key for key in MODEL_LOAD_OPTIONS if previous[key] != load_options[key]]
+        if changed:
+            details = ", ".join(f"{key}: {previous[key]} -> {load_options[key]}" for key in changed)
+            logging.warning(f"Profile '{profile}' changes load options ({details}); model {model} will reload")
+            print(f"\nNote: request options changed ({details}); the model will be reloaded.")
+        return changed
+
+class ContextBucketer:
+    """Chooses the num_ctx of each request from a ladder of bucket sizes.
+    
+    A request that does not fit the current bucket moves it up at once; it
+    moves down only when a request fits within NUM_CTX_SHRINK_RATIO of a
+    smaller bucket, so prompts hovering near a boundary don't reload the model
+    every turn. The bucket is shared by all request paths and threads.
+    """
+
+    def __init__(self, buckets, limit=NUM_CTX):
+        self.buckets = sorted(size for size in set(buckets) if size <= limit)
+        if not self.buckets or self.buckets[-1] < limit:
+            self.buckets.append(limit)
+        self.current = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def request_size(chat_messages, options):
+        """Tokens a request needs: the prompt, the reply and a safety margin."""
+        reply = options.get("num_predict") or 0
+        if reply <= 0:
+            reply = CONTEXT_RESPONSE_RESERVE
+        return int((calculate_token_usage(chat_messages) + reply) * (1 + NUM_CTX_MARGIN))
+
+    def fit(self, needed, profile="chat"):
+        """Return the num_ctx to send for a request needing this many tokens."""
+        with self.lock:
+            current = self.current
+            fitting = [size for size in self.buckets if size >= needed] or self.buckets[-1:]
+            if current is None or fitting[0] > current:
+                chosen = fitting[0]
+            else:
+                roomy = [size for size in self.buckets if needed <= size * NUM_CTX_SHRINK_RATIO]
+                chosen = min(roomy[0], current) if roomy else current
+            if chosen != current:
+                self.current = chosen
+                logging.info(f"num_ctx bucket {current} -> {chosen} ({needed} tokens needed, profile '{profile}')")
+            if needed > chosen:
+                logging.warning(f"Request needs ~{needed} tokens, more than the largest context ({chosen})")
+            return chosen
+
+context_bucketer = ContextBucketer(NUM_CTX_BUCKETS)
+
+def encode_chat_body(model, chat_messages, options):
+    """Serialize a streaming chat request, reusing each message's cached JSON."""
+    return ('{"model": %s, "messages": [%s], "stream": true, "options": %s}' % (
+        json.dumps(model), ", ".join(message_json(msg) for msg in chat_messages), json.dumps(options))).encode()
+
+class ChatBodyEncoder:
+    """Client-side encoding reuse: copies the unchanged prefix of the previous request body.
+    
+    With stable prompt assembly consecutive requests share every message up to
+    the late context block, so only the messages after it are serialized. An
+    edit to the history (undo, compression, a prompt change) replaces records
+    and just shortens the reused prefix, down to a full encode. Produces the
+    same bytes as encode_chat_body, so this saves client CPU and allocation
+    only: the whole body is still sent on every request.
+    """
+
+    def __init__(self):
+        self.model = None
+        self.sent = []  # Messages of the last body
+        self.ends = []  # Byte offset in body just past each message's JSON
+        self.start = 0  # Byte offset in body of the first message
+        self.body = b""
+
+    def encode(self, model, chat_messages, options):
+        keep = 0
+        if model == self.model:
+            # Only immutable records can be trusted to match their old bytes
+            for old, msg in zip(self.sent, chat_messages):
+                if old is not msg or not isinstance(msg, Message):
+                    break
+                keep += 1
+        else:
+            self.model = model
+            self.body = b'{"model": %s, "messages": [' % json.dumps(model).encode()
+            self.start = len(self.body)
+        
+        ends = self.ends[:keep]
+        position = ends[-1] if ends else self.start
+        fragments = [message_json(msg).encode() for msg in chat_messages[keep:]]
+        separator = b", " if fragments and position > self.start else b""
+        if fragments:
+            lengths = [len(fragment) + 2 for fragment in fragments]
+            lengths[0] += position + len(separator) - 2
+            ends.extend(accumulate(lengths))
+        
+        self.body = b"".join((memoryview(self.body)[:position], separator, b", ".join(fragments),
+                              b'], "stream": true, "options": %s}' % json.dumps(options).encode()))
+        self.sent = list(chat_messages)
+        self.ends = ends
+        return self.body
+
+class OllamaClient:
+    """Streaming client for the chat API backed by a persistent keep-alive session."""
+
+    def __init__(self, api_url=API_URL, pool_connections=HTTP_POOL_CONNECTIONS,
+                 pool_maxsize=HTTP_POOL_MAXSIZE, chunk_size=STREAM_CHUNK_SIZE):
+        self.api_url = api_url
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+        self.reload_guard = ReloadGuard()
+        self.body_encoder = ChatBodyEncoder()
+
+    def stream_chat(self, chat_messages, profile="chat"):
+        """Send a chat request and yield the parsed response chunks as they arrive."""
+        options = resolve_generation_options(profile)
+        if NUM_CTX_BUCKETS:
+            options["num_ctx"] = context_bucketer.fit(ContextBucketer.request_size(chat_messages, options), profile)
+        self.reload_guard.check(MODEL, options, profile)
+        body = self.body_encoder.encode(MODEL, chat_messages, options)
+        with self.session.post(self.api_url, data=body, headers={"Content-Type": "application/json"},
+                               stream=True, timeout=(HTTP_CONNECT_TIMEOUT, None)) as response:
+            if response.status_code != 200:
+                raise APIError(response.status_code, response.text)
+            decoder = NDJSONDecoder()
+            for data in response.iter_content(chunk_size=self.chunk_size):
+                yield from decoder.feed(data)
+            yield from decoder.flush()
+
+class PromptCacheStats:
+    """Track how much of each request's prompt prefix the backend could reuse."""
+
+    def __init__(self):
+        self.previous_request = []  # (role, content) pairs of the last request
+        self.last = None
+
+    def record(self, request_messages, final_chunk):
+        """Update the stats from the final stream chunk of a request and return them."""
+        evaluated = final_chunk.get("prompt_eval_count")
+        if evaluated is None:
+            return None
+        current = [(msg["role"], msg["content"]) for msg in request_messages]
+        token_counts = message_token_counts(request_messages)
+        shared_tokens = 0
+        shared_messages = 0
+        for old, new, tokens in zip(self.previous_request, current, token_counts):
+            if old != new:
+                break
+            shared_tokens += tokens
+            shared_messages += 1
+        self.previous_request = current
+        
+        prompt_tokens = calculate_token_usage(request_messages)
+        self.last = {
+            "prompt_tokens": prompt_tokens,
+            "evaluated": evaluated,
+            "reused": max(0, prompt_tokens - evaluated),
+            "shared_prefix": shared_tokens,
+            "shared_messages": shared_messages
+        }
+        logging.info(f"Prompt cache: {self.describe()}")
+        return self.last
+
+    def describe(self):
+        last = self.last
+        return (f"~{last['reused']} prefix tokens reused, {last['evaluated']} evaluated "
+                f"(shared prefix ~{last['shared_prefix']} of ~{last['prompt_tokens']} tokens)")
+
+ollama_client = OllamaClient()
+prompt_cache_stats = PromptCacheStats()
+
+class ResponseAccumulator:
+    """Collects a streamed reply as a list of segments, checkpointing it to disk.
+    
+    With a path, the text so far is written there (on the background writer)
+    every PARTIAL_CHECKPOINT_CHUNKS chunks, along with the context fields
+    needed to resume it, so a cancelled, dropped or crashed reply can be kept
+    or continued instead of regenerated.
+    """
+
+    def __init__(self, path=None, context=None):
+        self.path = path
+        self.context = context or {}
+        self.segments = []
+        self.chunks = 0
+        self.checkpointed_at = 0
+
+    def add(self, content):
+        self.segments.append(content)
+        self.chunks += 1
+        if self.path and self.chunks - self.checkpointed_at >= PARTIAL_CHECKPOINT_CHUNKS:
+            self.checkpoint()
+
+    def text(self):
+        if len(self.segments) > 1:
+            self.segments[:] = ["".join(self.segments)]
+        return self.segments[0] if self.segments else ""
+
+    def checkpoint(self):
+        path = self.path
+        data = dict(self.context, text=self.text(), saved_at=datetime.datetime.now().isoformat())
+        self.checkpointed_at = self.chunks
+        persistence.submit("partial response", lambda: write_json_atomic(path, data))
+
+    def discard(self):
+        """Drop the checkpoint once the reply has been dealt with."""
+        path = self.path
+        if path and (self.checkpointed_at or os.path.exists(path)):
+            def remove():
+                if os.path.exists(path):
+                    os.remove(path)
+            persistence.submit("partial response", remove)
+
+    @classmethod
+    def recover(cls, path):
+        """An accumulator holding the checkpoint at path, or None if there is none."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Error reading partial response: {str(e)}")
+            return None
+        accumulator = cls(path, {key: value for key, value in data.items() if key not in ("text", "saved_at")})
+        accumulator.segments = [data.get("text", "")]
+        accumulator.saved_at = data.get("saved_at")
+        return accumulator
+
+def stream_chat_response(current_messages, profile, cancel_notice, accumulator=None):
+    """Stream a reply to stdout and return (text, cancelled).
+    
+    Chunks are collected in accumulator (a fresh one if not given); text it
+    already holds is treated as the start of the reply, as when continuing.
+    """
+    if accumulator is None:
+        accumulator = ResponseAccumulator()
+    start = len(accumulator.text())
+    cancelled = False
+    try:
+        for chunk in ollama_client.stream_chat(current_messages, profile):
+            content = chunk.get("message", {}).get("content")
+            if content:
+                print(content, end="", flush=True)
+                accumulator.add(content)
+            if chunk.get("done"):
+                stats = prompt_cache_stats.record(current_messages, chunk)
+                if stats:
+                    record_token_feedback(current_messages, accumulator.text()[start:], chunk, stats["shared_messages"])
+    except KeyboardInterrupt:
+        print(f"\n{cancel_notice}")
+        cancelled = True
+    return accumulator.text(), cancelled
+
+def resolve_partial_response(accumulator):
+    """Ask what to do with an interrupted reply to the last user message.
+    
+    Continuing sends the partial text as a trailing assistant message, which
+    the model extends. Returns the reply text to keep, or None to drop the turn.
+    """
+    while True:
+        partial = accumulator.text()
+        print(f"\n{len(partial)} characters of the reply were received.")
+        try:
+            choice = input("Keep the partial reply, continue it, or discard the turn? (k/c/d): ").strip().lower()
+        except KeyboardInterrupt:
+            choice = "d"
+        if choice == "k":
+            return partial
+        if choice == "d":
+            return None
+        if choice != "c":
+            print("Invalid option.")
+            continue
+        
+        print(f"\nCharacters: ...{partial[-200:]}", end="", flush=True)
+        request_messages = list(assemble_request_messages(messages))
+        request_messages.append(Message("assistant", partial))
+        try:
+            _, cancelled = stream_chat_response(request_messages, "chat", "[AI output cancelled]", accumulator)
+        except APIError as e:
+            report_api_error(e)
+            continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            print("\nError: The connection dropped again.")
+            logging.error("API connection lost while continuing a reply")
+            continue
+        if not cancelled:
+            print()
+            return accumulator.text()
+
+def recover_partial_response():
+    """Offer a reply checkpointed before the script last stopped."""
+    accumulator = ResponseAccumulator.recover(PARTIAL_RESPONSE_FILE)
+    if accumulator is None:
+        return
+    context = accumulator.context
+    previous = get_message_hash(messages[-1]) if messages else None
+    if context.get("user") and previous == context.get("after"):
+        print(f"\nFound a reply interrupted at {str(accumulator.saved_at)[:19].replace('T', ' ')}, "
+              f"answering: {context['user'][:80]}")
+        messages.append({"role": "user", "content": context["user"]})
+        reply = resolve_partial_response(accumulator)
+        if reply is not None and reply.strip():
+            messages.append({"role": "assistant", "content": reply})
+            save_temp_session()
+        else:
+            messages.pop()
+    else:
+        # It belongs to a story that was not restored; keep it where /backups can find it
+        create_backup(PARTIAL_RESPONSE_FILE)
+        print("Found an interrupted reply from another session; it was backed up (see /backups).")
+    accumulator.discard()
+
+def report_api_error(error):
+    """Print and log a non-200 API response."""
+    print(f"\nError: API returned status code {error.status_code}")
+    print(f"API error: {error.text[:200]}")  # Show first 200 chars of error
+    logging.error(f"API error: {error.status_code} - {error.text}")
+
+# ===== End API Client Functions =====
 
 def get_ai_response(current_messages):
     """Helper function to get a response from the AI."""
-    payload = {
-        "model": MODEL,
-        "messages": current_messages,
-        "stream": True,
-        "options": {
-            "num_ctx": NUM_CTX,
-            "temperature": TEMPERATURE,
-            "top_k": TOP_K,
-            "top_p": TOP_P,
-            "min_p": MIN_P,
-            "microstat": MICROSTAT,
-            "microstat_tau": MICROSTAT_TAU,
-            "microstat_eta": MICROSTAT_ETA,
-            #"num_thread": NUM_THREAD
-        }
-    }
-    
     print("\nAI: ", end="", flush=True)
     
     try:
-        response = requests.post(API_URL, json=payload, stream=True)
-        
-        if response.status_code != 200:
-            print(f"\nError: API returned status code {response.status_code}")
-            error_msg = response.text[:200]
-            print(f"API error: {error_msg}")
-            return None
-        
-        ai_response = ""
-        cancelled = False
-        
-        try:
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        chunk = json.loads(line)
-                        if "message" in chunk and "content" in chunk["message"]:
-                            content = chunk["message"]["content"]
-                            print(content, end="", flush=True)
-                            ai_response += content
-                    except json.JSONDecodeError:
-                        logging.error(f"Error decoding JSON from API: {line}")
-                        print(f"\nError decoding response chunk")
-        except KeyboardInterrupt:
-            print("\n[AI response cancelled]")
-            cancelled = True
+        request_messages = assemble_request_messages(current_messages)
+        ai_response, cancelled = stream_chat_response(request_messages, "chat", "[AI response cancelled]")
         
         print()  # Add a newline
         
@@ -1664,29 +4840,17 @@ def get_ai_response(current_messages):
         
         return ai_response
     
+    except APIError as e:
+        report_api_error(e)
+        return None
     except Exception as e:
         print(f"\nError during AI response: {str(e)}")
         logging.error(f"Error during AI response: {str(e)}")
         return None
 
-def summarize_story():
-    """Generate a summary of the story so far and handle chapter transitions."""
-    global messages
-    
-    if len(messages) <= 1:  # Only system message or empty
-        print("No story to summarize yet.")
-        return
-    
-    print("\nGenerating story summary...")
-    
-    # Create a copy of messages to build summary request
-    summary_messages = deepcopy(messages)
-    
-    # Add a request for summary to the AI
-    summary_request = (
-	"""Please read the following story and generate a detailed summary, aiming for a condensed narrative rather than a simple bullet-point list. Think of it as a "previously on..." segment or a short, self-contained story that captures the essence of the original.
+# ===== Rolling Summary =====
 
-Specifically, your summary should:
+SUMMARY_INSTRUCTIONS = """Specifically, your summary should:
 
 * **Retain the core plot points and character arcs.** Don't just list events; weave them into a coherent narrative.
 * **Include relevant context and background information.** Explain the "why" behind significant actions, not just the "what."
@@ -1694,62 +4858,465 @@ Specifically, your summary should:
 * **Focus on providing enough detail to understand the story's progression without reading the full text.** Think of it as a detailed recap that prepares someone for a continuation or reminds them of key elements.
 * **Aim for a length that is significantly shorter than the original, but still substantial enough to convey the story's complexity.**
 * **If there are particular themes or motifs that are significant, include them in the summary.**"""
-    )
-    
-    summary_messages.append({"role": "user", "content": summary_request})
-    
-    # API request payload
-    payload = {
-        "model": MODEL,
-        "messages": summary_messages,
-        "stream": True,
-        "options": {
-            "temperature": TEMPERATURE,
-            "top_k": TOP_K,
-            "top_p": TOP_P,
-            "min_p": MIN_P,
-            "microstat": MICROSTAT,
-            "microstat_tau": MICROSTAT_TAU,
-            "microstat_eta": MICROSTAT_ETA,
-        }
-    }
-    
-    print("\nGenerating Summary: ", end="", flush=True)
+
+SUMMARY_UPDATE_PROMPT = """Below is the summary of the current chapter of a story so far, followed by the passages that happened since. Rewrite the chapter summary so it also covers the new passages, aiming for a condensed narrative rather than a simple bullet-point list. Think of it as a "previously on..." segment or a short, self-contained story that captures the essence of the original.
+
+{instructions}
+
+Earlier chapters, for background only (do not repeat or rewrite them):
+{background}
+
+Summary of the current chapter so far:
+{summary}
+
+New passages:
+{transcript}
+
+Reply with the updated summary only."""
+
+SUMMARY_MERGE_PROMPT = """The following are summaries of consecutive parts of one story. Merge them into a single summary of the whole arc, keeping the order of events, the character arcs and any details later parts depend on.
+
+{instructions}
+
+{parts}
+
+Reply with the merged summary only."""
+
+SUMMARY_SEGMENT_PROMPT = """Below is part {part} of {total} of a story. Summarize what happens in this part as a condensed narrative, keeping names, motives and any open threads later parts may depend on.
+
+{instructions}
+
+Passages:
+{transcript}
+
+Reply with the summary only."""
+
+def new_summary_state():
+    """Empty rolling summary: closed chapter summaries, the open chapter's summary and a watermark."""
+    return {"chapters": [], "current": "", "watermark": None}
+
+summary_state = new_summary_state()
+
+def story_so_far(state):
+    """All chapter summaries followed by the summary of the current chapter."""
+    parts = [chapter["summary"] for chapter in state["chapters"]]
+    if state["current"]:
+        parts.append(state["current"])
+    return "\n\n".join(parts)
+
+def messages_since_watermark(history, watermark):
+    """Messages after the last summarized one, without the system prompt or pinned summaries."""
+    start = 1 if history and history[0]["role"] == "system" else 0
+    if watermark:
+        for i in range(len(history) - 1, start - 1, -1):
+            if get_message_hash(history[i]) == watermark:
+                start = i + 1
+                break
+        else:
+            logging.warning("Summary watermark not found in history; summarizing all messages")
+    return [msg for msg in history[start:] if not is_pinned_message(msg)]
+
+def format_transcript(messages_list):
+    """Render messages as a plain narrator/characters transcript."""
+    labels = {"user": "Narrator", "assistant": "Characters"}
+    return "\n\n".join(f"{labels.get(msg['role'], msg['role'].title())}: {msg['content']}" for msg in messages_list)
+
+def summary_segments(messages_list, budget):
+    """Split messages into runs of at most budget tokens, cutting only before user messages."""
+    segments = []
+    current = []
+    current_tokens = 0
+    for msg in messages_list:
+        tokens = count_message_tokens(msg)
+        if current and current_tokens + tokens > budget and msg["role"] == "user":
+            segments.append(current)
+            current, current_tokens = [], 0
+        current.append(msg)
+        current_tokens += tokens
+    if current:
+        segments.append(current)
+    return segments
+
+def summary_request_messages(system_message, prompt):
+    """A summarization request: the story's system prompt plus the instruction."""
+    request = [system_message] if system_message else []
+    request.append({"role": "user", "content": prompt})
+    return request
+
+def merge_prompt(summaries, label):
+    """Prompt merging consecutive summaries, labelled "<label> 1", "<label> 2", ..."""
+    return SUMMARY_MERGE_PROMPT.format(
+        instructions=SUMMARY_INSTRUCTIONS,
+        parts="\n\n".join(f"{label} {i}:\n{text}" for i, text in enumerate(summaries, 1)))
+
+def request_summary(system_message, prompt, label, quiet=False):
+    """Run one summarization request; returns the text or None if cancelled or empty.
+    
+    With quiet the reply is not printed, for use off the main thread.
+    """
+    request = summary_request_messages(system_message, prompt)
+    if quiet:
+        return collect_chat_response(summary_client(API_URL), request, "summary").strip() or None
+    print(f"\n{label}: ", end="", flush=True)
+    text, cancelled = stream_chat_response(request, "summary", "[Summary generation cancelled]")
+    print()
+    if cancelled or not text.strip():
+        return None
+    return text.strip()
+
+def update_rolling_summary(state, history, quiet=False):
+    """Fold the messages added since the watermark into the summary.
+    
+    Only the summary of the current chapter is rewritten, from the new
+    messages in segments of at most SUMMARY_SEGMENT_TOKENS; closed chapters
+    are sent as read-only background. Returns an updated copy of state, or
+    None when generation was cancelled; state itself is left untouched, so a
+    cancelled run discards the segments it had already folded in and the
+    next run starts again from the old watermark.
+    """
+    new_messages = messages_since_watermark(history, state["watermark"])
+    updated = {"chapters": list(state["chapters"]), "current": state["current"], "watermark": state["watermark"]}
+    if not new_messages:
+        if not quiet:
+            print("\nNo new messages since the last summary.")
+        return updated
+    
+    system_message = history[0] if history and history[0]["role"] == "system" else None
+    segments = summary_segments(new_messages, SUMMARY_SEGMENT_TOKENS)
+    if len(segments) > 1 and not updated["current"]:
+        # The chapter has no summary to fold into yet, so the segments are independent
+        text = map_reduce_summary(system_message, segments, quiet)
+        if text is None:
+            return None
+        updated["current"] = text
+        updated["watermark"] = get_message_hash(history[-1])
+        return updated
+    
+    background = "\n\n".join(chapter["summary"] for chapter in updated["chapters"]) or "(None.)"
+    for number, segment in enumerate(segments, 1):
+        label = "Updating summary" if len(segments) == 1 else f"Updating summary ({number}/{len(segments)})"
+        prompt = SUMMARY_UPDATE_PROMPT.format(
+            instructions=SUMMARY_INSTRUCTIONS,
+            background=background,
+            summary=updated["current"] or "(The chapter has just begun.)",
+            transcript=format_transcript(segment))
+        text = request_summary(system_message, prompt, label, quiet)
+        if text is None:
+            return None
+        updated["current"] = text
+        logging.info(f"Rolling summary covered {len(segment)} more messages")
     
-    try:
-        response = requests.post(API_URL, json=payload, stream=True)
-        
-        if response.status_code != 200:
-            print(f"\nError: API returned status code {response.status_code}")
-            error_msg = response.text[:200]  # Show first 200 chars of error
-            print(f"API error: {error_msg}")
-            logging.error(f"API error: {response.status_code} - {response.text}")
+    updated["watermark"] = get_message_hash(history[-1])
+    return updated
+
+class SummaryCache:
+    """Finished summaries keyed by a hash of the exact request."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def key(request):
+        return hashlib.sha256(json.dumps([MODEL, [message_json(msg) for msg in request]]).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'r') as f:
+                return json.load(f)["summary"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, summary):
+        os.makedirs(self.directory, exist_ok=True)
+        write_json_atomic(self.path(key), {"created": datetime.datetime.now().isoformat(), "summary": summary})
+
+    def prune(self, limit=SUMMARY_CACHE_MAX_ENTRIES):
+        """Delete the oldest entries beyond limit."""
+        if not os.path.isdir(self.directory):
+            return
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+        if len(entries) <= limit:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in entries[:len(entries) - limit]:
+            os.remove(entry.path)
+
+summary_cache = SummaryCache(SUMMARY_CACHE_DIR)
+_summary_clients = threading.local()
+
+def summary_client(api_url):
+    """This thread's client for a summary backend."""
+    clients = getattr(_summary_clients, "clients", None)
+    if clients is None:
+        clients = _summary_clients.clients = {}
+    if api_url not in clients:
+        clients[api_url] = OllamaClient(api_url=api_url)
+    return clients[api_url]
+
+def collect_chat_response(client, request, profile):
+    """Read a streamed reply without printing it."""
+    parts = []
+    for chunk in client.stream_chat(request, profile):
+        content = chunk.get("message", {}).get("content")
+        if content:
+            parts.append(content)
+    return "".join(parts)
+
+def run_summary_requests(summary_requests, label, quiet=False):
+    """Run independent summary requests concurrently across SUMMARY_BACKENDS.
+    
+    Each backend takes at most SUMMARY_PARALLELISM requests at a time. Results
+    are cached as they finish, so a rerun after an interruption only sends the
+    missing ones. Returns the texts in order, or None if interrupted or a
+    reply came back empty.
+    """
+    results = [None] * len(summary_requests)
+    pending = []
+    for i, request in enumerate(summary_requests):
+        key = summary_cache.key(request)
+        results[i] = summary_cache.get(key)
+        if results[i] is None:
+            pending.append((i, request, key))
+    
+    total = len(summary_requests)
+    done = total - len(pending)
+    
+    def show_progress():
+        if quiet:
             return
+        cached = f", {total - len(pending)} cached" if len(pending) < total else ""
+        print(f"\r{label}: {done}/{total} done{cached}", end="", flush=True)
+    
+    if not quiet:
+        print()
+    show_progress()
+    if pending:
+        slots = queue.Queue()
+        for api_url in SUMMARY_BACKENDS:
+            for _ in range(SUMMARY_PARALLELISM):
+                slots.put(api_url)
         
-        summary = ""
-        cancelled = False
+        def summarize(request, key):
+            api_url = slots.get()
+            try:
+                text = collect_chat_response(summary_client(api_url), request, "summary").strip()
+            finally:
+                slots.put(api_url)
+            if text:
+                summary_cache.put(key, text)
+            return text
         
+        executor = ThreadPoolExecutor(max_workers=slots.qsize())
         try:
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        chunk = json.loads(line)
-                        if "message" in chunk and "content" in chunk["message"]:
-                            content = chunk["message"]["content"]
-                            print(content, end="", flush=True)
-                            summary += content
-                    except json.JSONDecodeError:
-                        logging.error(f"Error decoding JSON from API: {line}")
-                        print(f"\nError decoding response chunk")
+            futures = {executor.submit(summarize, request, key): i for i, request, key in pending}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                done += 1
+                show_progress()
         except KeyboardInterrupt:
-            print("\n[Summary generation cancelled]")
-            cancelled = True
+            print("\n[Summary generation cancelled; finished segments are kept for the next run]")
+            return None
+        finally:
+            # Requests already sent finish in the background and still fill the cache
+            executor.shutdown(wait=False, cancel_futures=True)
+    if not quiet:
+        print()
+    
+    if not all(results):
+        logging.warning(f"{label}: some summaries came back empty")
+        if not quiet:
+            print("Some segments came back empty.")
+        return None
+    return results
+
+def reduce_groups(summaries, budget):
+    """Group consecutive summaries so each group fits budget tokens, at least two per group."""
+    groups = []
+    current = []
+    current_tokens = 0
+    for text in summaries:
+        tokens = estimate_tokens(text)
+        if len(current) >= 2 and current_tokens + tokens > budget:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        if len(current) == 1 and groups:
+            groups[-1].append(current[0])
+        else:
+            groups.append(current)
+    return groups
+
+def map_reduce_summary(system_message, segments, quiet=False):
+    """Summarize segments in parallel, then merge the partial summaries into one recap."""
+    summary_requests = [
+        summary_request_messages(system_message, SUMMARY_SEGMENT_PROMPT.format(
+            part=number, total=len(segments), instructions=SUMMARY_INSTRUCTIONS,
+            transcript=format_transcript(segment)))
+        for number, segment in enumerate(segments, 1)]
+    summaries = run_summary_requests(summary_requests, "Summarizing segments", quiet)
+    if summaries is None:
+        return None
+    
+    # Merge in rounds while the partial summaries do not fit in one request
+    level = 1
+    groups = reduce_groups(summaries, SUMMARY_SEGMENT_TOKENS)
+    while len(groups) > 1:
+        merge_requests = [summary_request_messages(system_message, merge_prompt(group, "Part")) for group in groups]
+        summaries = run_summary_requests(merge_requests, f"Merging summaries (round {level})", quiet)
+        if summaries is None:
+            return None
+        level += 1
+        groups = reduce_groups(summaries, SUMMARY_SEGMENT_TOKENS)
+    
+    summary_cache.prune()
+    return request_summary(system_message, merge_prompt(groups[0], "Part"), "Final summary", quiet)
+
+def close_summary_chapter(state, system_message=None):
+    """Move the open chapter's summary into the chapter list, merging full levels.
+    
+    Chapters form levels like a counter: once SUMMARY_MERGE_FANOUT summaries of
+    the same level are adjacent at the end, they are merged into one summary a
+    level up, so the recap grows logarithmically with the number of chapters.
+    """
+    if state["current"]:
+        state["chapters"].append({"level": 0, "summary": state["current"]})
+    state["current"] = ""
+    
+    chapters = state["chapters"]
+    while len(chapters) >= SUMMARY_MERGE_FANOUT:
+        tail = chapters[-SUMMARY_MERGE_FANOUT:]
+        level = tail[0]["level"]
+        if any(chapter["level"] != level for chapter in tail):
+            break
+        prompt = merge_prompt([chapter["summary"] for chapter in tail], "Chapter")
+        merged = request_summary(system_message, prompt, "Merging chapter summaries")
+        if merged is None:
+            # Keep the chapters unmerged; the merge is retried when the next chapter closes
+            break
+        chapters[-SUMMARY_MERGE_FANOUT:] = [{"level": level + 1, "summary": merged}]
+    return state
+
+def compressed_history(history, summary, recent_count):
+    """History reshaped like /summarize option 4: system prompt, summary, recent messages."""
+    system_message = history[0] if history and history[0]["role"] == "system" else None
+    recent_messages = history[-recent_count:] if recent_count > 0 else []
+    new_messages = [system_message] if system_message else []
+    new_messages.append({"role": "system", "content": f"STORY SUMMARY (Previous exchanges compressed): {summary}"})
+    new_messages.extend(recent_messages)
+    return new_messages
+
+class BackgroundCompactor:
+    """Summarizes the oldest part of the history on a worker thread.
+    
+    Started once usage crosses AUTO_COMPACT_WATERMARK. The result is swapped in
+    by apply_if_ready() only when the worker has finished and the summarized
+    prefix is still exactly what the worker saw; a request never waits on it.
+    The worker counts tokens while the main thread does too, so every count
+    goes through token_lock.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.snapshot = None
+        self.base_state = None
+        self.result = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def maybe_start(self):
+        """Start a compaction if enabled, idle and over the watermark."""
+        if not AUTO_COMPACT or self.thread is not None:
+            return False
+        if calculate_token_usage(messages) <= NUM_CTX * AUTO_COMPACT_WATERMARK:
+            return False
+        cut = len(messages) - AUTO_COMPACT_KEEP_RECENT
+        if cut <= 2:
+            return False
+        
+        snapshot = list(messages[:cut])
+        # Not worth a request when little beyond the last summary would be compacted
+        if calculate_token_usage(messages_since_watermark(snapshot, summary_state["watermark"])) < NUM_CTX * 0.1:
+            return False
+        
+        self.snapshot = snapshot
+        self.base_state = summary_state
+        self.result = None
+        self.thread = threading.Thread(target=self.run, name="compactor", daemon=True)
+        self.thread.start()
+        logging.info(f"Background compaction started for the oldest {cut} messages")
+        return True
+
+    def run(self):
+        try:
+            self.result = update_rolling_summary(self.base_state, self.snapshot, quiet=True)
+        except Exception as e:
+            logging.error(f"Background compaction failed: {str(e)}")
+            self.result = None
+
+    def apply_if_ready(self):
+        """Swap in a finished compaction; returns True if the history was compacted."""
+        global summary_state
+        if self.thread is None or self.running():
+            return False
+        self.thread = None
+        candidate, snapshot = self.result, self.snapshot
+        self.result = self.snapshot = None
+        if candidate is None or not story_so_far(candidate):
+            return False
         
-        if cancelled or not summary.strip():
+        cut = len(snapshot)
+        if summary_state is not self.base_state or len(messages) < cut or \
+                any(old is not new for old, new in zip(snapshot, messages[:cut])):
+            logging.info("History changed during background compaction; result discarded")
+            return False
+        
+        old_tokens = calculate_token_usage(messages)
+        recent_count = len(messages) - cut
+        messages[:] = compressed_history(messages, story_so_far(candidate), recent_count)
+        # The summarized messages are gone; the summary message now marks where new history starts
+        candidate["watermark"] = get_message_hash(messages[len(messages) - recent_count - 1])
+        summary_state = candidate
+        print(f"[Context compacted in the background: {old_tokens} -> {calculate_token_usage(messages)} tokens]")
+        logging.info(f"Background compaction applied: {old_tokens} -> {calculate_token_usage(messages)} tokens")
+        save_temp_session()
+        return True
+
+background_compactor = BackgroundCompactor()
+
+def summarize_story():
+    """Generate a summary of the story so far and handle chapter transitions."""
+    global messages, summary_state
+    
+    if len(messages) <= 1:  # Only system message or empty
+        print("No story to summarize yet.")
+        return
+    
+    print("\nGenerating story summary...")
+    
+    try:
+        try:
+            candidate = update_rolling_summary(summary_state, messages)
+        except APIError as e:
+            report_api_error(e)
+            return
+        
+        if candidate is None or not story_so_far(candidate):
             print("\nSummary generation was cancelled or failed.")
             return
+        summary = story_so_far(candidate)
         
-        print("\n\n" + "-" * 50)
+        print("\n" + "-" * 50)
+        # The update was streamed already; show the whole recap when it holds more than that
+        if candidate["chapters"] or candidate["current"] == summary_state["current"]:
+            print(f"\nStory so far ({len(candidate['chapters'])} earlier chapter summaries):")
+            print(summary)
+            print("\n" + "-" * 50)
         
         # Ask what to do with the summary
         print("\nOptions:")
@@ -1765,7 +5332,8 @@ Specifically, your summary should:
             print("\nOperation cancelled.")
             return
         
-        chapter_marker = f"\n{'=' * 40}\nCHAPTER SUMMARY\n{'=' * 40}\n{summary}\n{'=' * 40}\n"
+        chapter_marker = f"\n{'=' * 40}\n{CHAPTER_MARKER_TITLE}\n{'=' * 40}\n{summary}\n{'=' * 40}\n"
+        system_message = messages[0] if messages[0]["role"] == "system" else None
         
         if choice == "1":
             # Add the summary as a chapter marker
@@ -1777,6 +5345,8 @@ Specifically, your summary should:
             
             if chat_response:
                 messages.append({"role": "assistant", "content": chat_response})
+                summary_state = close_summary_chapter(candidate, system_message)
+                summary_state["watermark"] = get_message_hash(messages[-1])
                 print("\nChapter ended. New chapter started.")
                 save_temp_session()
             else:
@@ -1793,6 +5363,8 @@ Specifically, your summary should:
             
             if chat_response:
                 messages.append({"role": "assistant", "content": chat_response})
+                summary_state = candidate
+                summary_state["watermark"] = get_message_hash(messages[-1])
                 print("\nSummary noted. Continuing story.")
                 save_temp_session()
             else:
@@ -1806,7 +5378,7 @@ Specifically, your summary should:
             backup_file = os.path.join(sessions_dir, f"{backup_name}.json")
             
             # Create a special backup including the chapter summary
-            full_messages = deepcopy(messages)
+            full_messages = messages.copy()
             full_messages.append({"role": "user", "content": f"Chapter End Summary: {chapter_marker}"})
             
             chapter_end_data = {
@@ -1815,17 +5387,15 @@ Specifically, your summary should:
                 "messages": full_messages,
                 "story_setting": current_story,
                 "facts": current_facts,
-                "chapter_summary": summary
+                "chapter_summary": summary,
+                "summary_state": candidate
             }
             
             try:
                 with open(backup_file, 'w') as f:
-                    json.dump(chapter_end_data, f, indent=2)
+                    json.dump(chapter_end_data, f, indent=2, default=json_default)
                 print(f"\nChapter end saved to {backup_file}")
                 
-                # Keep system message and add summary as first user message
-                system_message = messages[0]
-                
                 # Start new conversation with system message and chapter summary
                 messages[:] = [
                     system_message,
@@ -1838,37 +5408,27 @@ Specifically, your summary should:
                 
                 if chat_response:
                     messages.append({"role": "assistant", "content": chat_response})
+                    fold_pending_system_prompt()
+                    summary_state = close_summary_chapter(candidate, system_message)
+                    summary_state["watermark"] = get_message_hash(messages[-1])
                     print("\nNew chapter started with cleared dialogue history.")
                     save_temp_session()
                 else:
                     print("\nFailed to start new chapter with AI. Please try again.")
                     # Restore full messages if AI response fails
-                    messages = full_messages
+                    messages[:] = full_messages
             except Exception as e:
                 logging.error(f"Error saving chapter end: {str(e)}")
                 print(f"\nError saving chapter end: {str(e)}")
                 
         elif choice == "4":
             # Use the summary to compress older messages
-            system_message = messages[0] if messages[0]["role"] == "system" else None
             
             # Keep the last 10 messages (5 exchanges) intact for continuity
             recent_msg_count = min(10, len(messages) - 1)  # minus system message
-            recent_messages = messages[-recent_msg_count:] if recent_msg_count > 0 else []
-            
-            # Create a compressed representation of older messages
-            compressed_summary = {
-                "role": "system",
-                "content": f"STORY SUMMARY (Previous exchanges compressed): {summary}"
-            }
             
             # Reconstruct the messages array with summary and recent messages
-            new_messages = []
-            if system_message:
-                new_messages.append(system_message)
-            
-            new_messages.append(compressed_summary)
-            new_messages.extend(recent_messages)
+            new_messages = compressed_history(messages, summary, recent_msg_count)
             
             # Calculate token savings
             old_tokens = calculate_token_usage(messages)
@@ -1883,6 +5443,7 @@ Specifically, your summary should:
             confirm = input("\nApply compression? (y/n): ").lower()
             if confirm == 'y':
                 messages[:] = new_messages
+                summary_state = candidate
                 print("\nContext compressed. Recent messages preserved with summary of older content.")
                 save_temp_session()
             else:
@@ -1914,12 +5475,12 @@ def optimize_context():
         cleaned_system = clean_system_prompt(old_system)
         
         if old_system != cleaned_system:
-            messages[0]["content"] = cleaned_system
+            messages.set_content(0, cleaned_system)
             print("Optimized system prompt by removing duplicated content.")
     
     # Check for redundant whitespace in all messages
     spaces_saved = 0
-    for msg in messages:
+    for i, msg in enumerate(messages):
         old_content = msg["content"]
         # Remove excessive newlines and spaces
         new_content = '\n'.join(line.strip() for line in old_content.split('\n'))
@@ -1927,7 +5488,7 @@ def optimize_context():
         
         if len(old_content) > len(new_content):
             spaces_saved += len(old_content) - len(new_content)
-            msg["content"] = new_content
+            messages.set_content(i, new_content)
     
     if spaces_saved > 0:
         print(f"Removed {spaces_saved} redundant whitespace characters.")
@@ -1947,11 +5508,10 @@ def optimize_context():
         
         if choice == "1":
             # Compress older messages
-            old_msgs = deepcopy(messages)
             compressed_msgs = compress_older_messages(messages, threshold=20)
             
             # Calculate savings
-            old_count = calculate_token_usage(old_msgs)
+            old_count = calculate_token_usage(messages)
             new_count = calculate_token_usage(compressed_msgs)
             savings = old_count - new_count
             
@@ -1990,6 +5550,10 @@ def chat_with_model():
     print("  /undo     - Undo the last interaction")
     print("  /redo     - Redo the last undone interaction")
     print("  /verify   - Verify context integrity")
+    print("  /backups  - Browse and restore backups")
+    print("  /migrate  - Convert saved sessions to the segmented format")
+    print("  /archive  - Export, import or resume from binary session archives")
+    print("  /history [page] - Page back through the archive of a resumed story")
     print("  /exit or /bye - Quit")
     print("Press Ctrl+C to cancel current output or input.")
     print("-" * 50)
@@ -2006,6 +5570,9 @@ def chat_with_model():
                 save_temp = input("Save temporary session before exiting? (y/n): ").lower()
                 if save_temp == 'y':
                     save_temp_session()
+                if not persistence.flush(PERSIST_FLUSH_TIMEOUT):
+                    print("Warning: Some changes could not be written in time.")
+                persistence.report_errors()
                 print("Goodbye!")
                 break
             
@@ -2033,6 +5600,26 @@ def chat_with_model():
                 manage_story_settings()
                 continue
             
+            elif user_input.lower() == "/backups":
+                manage_backups()
+                continue
+            
+            elif user_input.lower() == "/migrate":
+                migrate_sessions()
+                continue
+            
+            elif user_input.lower() == "/archive":
+                manage_archives()
+                continue
+            
+            elif user_input.lower().split()[:1] == ["/history"]:
+                page = user_input.split()[1:2]
+                if page and not page[0].isdigit():
+                    print("Usage: /history [page]")
+                else:
+                    show_history_page(int(page[0]) if page else 1)
+                continue
+            
             elif user_input.lower() == "/info":
                 show_story_info()
                 continue
@@ -2054,6 +5641,7 @@ def chat_with_model():
                     undone_assistant = messages.pop()
                     undone_user = messages.pop()
                     undo_stack.append((undone_user, undone_assistant))
+                    story_memory.forget((undone_user, undone_assistant))
                     redo_stack.clear()  # Clear redo stack on new action
                     print("Undid the last interaction.")
                     save_temp_session()
@@ -2085,6 +5673,9 @@ def chat_with_model():
                         fix_context()
                 continue
 
+            # Swap in a finished background compaction; never wait for one
+            background_compactor.apply_if_ready()
+            
             # Append the user input to the message history
             messages.append({"role": "user", "content": user_input})
             
@@ -2094,58 +5685,34 @@ def chat_with_model():
                 print(f"\nWarning: Context is at {token_count}/{NUM_CTX} tokens ({token_count/NUM_CTX*100:.1f}%).")
                 print("Consider saving and starting a new session or using /optimize to reduce token usage.")
             
-            # API request payload
-            payload = {
-                "model": MODEL,
-                "messages": messages,
-                "stream": True,
-                "options": {
-                    "num_ctx": NUM_CTX,
-                    "temperature": TEMPERATURE,
-                    "top_k": TOP_K,
-                    "top_p": TOP_P,
-                    "min_p": MIN_P,
-                    "microstat": MICROSTAT,
-                    "microstat_tau": MICROSTAT_TAU,
-                    "microstat_eta": MICROSTAT_ETA,
-                    #"num_thread": NUM_THREAD
-                }
-            }
-
             print("\nCharacters: ", end="", flush=True)
             
+            # Checkpointed while streaming, so an interrupted reply can be kept or continued
+            accumulator = ResponseAccumulator(PARTIAL_RESPONSE_FILE, {
+                "user": user_input,
+                "after": get_message_hash(messages[-2]) if len(messages) > 1 else None
+            })
             try:
-                response = requests.post(API_URL, json=payload, stream=True)
-                
-                if response.status_code != 200:
-                    print(f"\nError: API returned status code {response.status_code}")
-                    error_msg = response.text[:200]  # Show first 200 chars of error
-                    print(f"API error: {error_msg}")
-                    logging.error(f"API error: {response.status_code} - {response.text}")
+                try:
+                    request_messages = assemble_request_messages(messages)
+                    assistant_response, cancelled = stream_chat_response(request_messages, "chat", "[AI output cancelled]", accumulator)
+                except APIError as e:
+                    report_api_error(e)
                     
                     # Remove the last user message so the failed turn is not saved
                     messages.pop()
                     continue
-                
-                assistant_response = ""
-                cancelled = False
-                
-                try:
-                    for line in response.iter_lines():
-                        if line:
-                            try:
-                                chunk = json.loads(line)
-                                if "message" in chunk and "content" in chunk["message"]:
-                                    content = chunk["message"]["content"]
-                                    print(content, end="", flush=True)
-                                    assistant_response += content
-                            except json.JSONDecodeError:
-                                logging.error(f"Error decoding JSON from API: {line}")
-                                print(f"\nError decoding response chunk")
-                except KeyboardInterrupt:
-                    print("\n[AI output cancelled]")
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                    if not accumulator.text().strip():
+                        raise
+                    print("\nError: The connection dropped before the reply was finished.")
+                    logging.error("API connection lost while streaming a reply")
                     cancelled = True
                 
+                if cancelled and accumulator.text().strip():
+                    assistant_response = resolve_partial_response(accumulator)
+                    cancelled = assistant_response is None
+                
                 if cancelled:
                     # Remove the last user message so the cancelled turn is not saved
                     messages.pop()
@@ -2159,8 +5726,14 @@ def chat_with_model():
                         # Clear redo stack on new interactions
                         redo_stack.clear()
                         
+                        if SHOW_PROMPT_CACHE_STATS and prompt_cache_stats.last:
+                            print(f"[Prompt cache: {prompt_cache_stats.describe()}]")
+                        
                         # Save after each successful interaction
                         save_temp_session()
+                        
+                        # Summarize the oldest messages while the user types
+                        background_compactor.maybe_start()
                     else:
                         print("Warning: Received empty response from API")
                         messages.pop()  # Remove the user message
@@ -2173,6 +5746,8 @@ def chat_with_model():
                 print(f"\nError during API communication: {str(e)}")
                 logging.error(f"API communication error: {str(e)}")
                 messages.pop()  # Remove the user message
+            finally:
+                accumulator.discard()
         
         except KeyboardInterrupt:
             print("\nOperation cancelled.")
@@ -2193,12 +5768,12 @@ def fix_context():
         if current_story and "system_prompt" in current_story:
             system_content = current_story["system_prompt"]
         
-        system_message = {"role": "system", "content": append_facts_to_prompt(system_content)}
+        system_message = {"role": "system", "content": compose_system_prompt(system_content)}
         
         if messages:
             messages.insert(0, system_message)
         else:
-            messages = [system_message]
+            messages[:] = [system_message]
         print("Fixed: Added missing system message.")
     
     # Check for and fix consecutive same-role messages
@@ -2207,12 +5782,12 @@ def fix_context():
         if messages[i]["role"] == messages[i+1]["role"]:
             # For consecutive user messages, combine them
             if messages[i]["role"] == "user":
-                messages[i]["content"] += "\n\n" + messages[i+1]["content"]
+                messages.set_content(i, messages[i]["content"] + "\n\n" + messages[i+1]["content"])
                 messages.pop(i+1)
                 print(f"Fixed: Combined consecutive user messages at position {i}.")
             # For consecutive assistant messages, combine them
             elif messages[i]["role"] == "assistant":
-                messages[i]["content"] += "\n\n" + messages[i+1]["content"]
+                messages.set_content(i, messages[i]["content"] + "\n\n" + messages[i+1]["content"])
                 messages.pop(i+1)
                 print(f"Fixed: Combined consecutive assistant messages at position {i}.")
         else:
@@ -2232,12 +5807,12 @@ def fix_context():
                 expected_role = "user" if expected_role == "assistant" else "assistant"
         
         if len(fixed_messages) < len(messages):
-            messages = fixed_messages
+            messages[:] = fixed_messages
             print(f"Fixed: Removed {len(messages) - len(fixed_messages)} messages to maintain proper alternation.")
     
     # Remove empty messages
     original_count = len(messages)
-    messages = [msg for msg in messages if msg.get("content", "").strip()]
+    messages[:] = [msg for msg in messages if msg.get("content", "").strip()]
     if len(messages) != original_count:
         print(f"Fixed: Removed {original_count - len(messages)} empty messages.")
     
@@ -2246,53 +5821,386 @@ def fix_context():
         old_system = messages[0]["content"]
         cleaned_system = clean_system_prompt(old_system)
         if old_system != cleaned_system:
-            messages[0]["content"] = cleaned_system
+            messages.set_content(0, cleaned_system)
             print("Fixed: Cleaned system prompt of duplicate content.")
     
     print("Context fixing complete.")
 
+def write_json_atomic(filepath, data, indent=2):
+    """Write JSON to a temp file, fsync it and rename it over filepath."""
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=indent, default=json_default)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+
+class PersistenceWorker:
+    """Runs file writes on a background thread, merging bursts per key.
+    
+    submit(key, job) replaces a queued job with the same key that has not
+    started yet, and jobs wait PERSIST_COALESCE_SECONDS before running, so
+    undo, redo and a turn in quick succession become a single write. Jobs
+    must not read live state; they get copies taken when they are queued.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.jobs = {}  # key -> (job, queued at); oldest first
+        self.busy = False
+        self.flushing = 0
+        self.thread = None
+        self.errors = []
+
+    def submit(self, key, job):
+        with self.condition:
+            self.jobs.pop(key, None)
+            self.jobs[key] = (job, datetime.datetime.now().timestamp())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="persistence", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.jobs:
+                        self.busy = False
+                        self.condition.notify_all()
+                        self.condition.wait()
+                        continue
+                    key = next(iter(self.jobs))
+                    job, queued_at = self.jobs[key]
+                    delay = queued_at + PERSIST_COALESCE_SECONDS - datetime.datetime.now().timestamp()
+                    if delay <= 0 or self.flushing:
+                        break
+                    self.condition.wait(delay)
+                del self.jobs[key]
+                self.busy = True
+            try:
+                job()
+            except Exception as e:
+                logging.error(f"Background save '{key}' failed: {str(e)}")
+                with self.condition:
+                    self.errors.append(f"{key}: {str(e)}")
+
+    def flush(self, timeout=None):
+        """Run every queued job now and wait for them; False if timeout ran out first."""
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                return self.condition.wait_for(lambda: not self.jobs and not self.busy, timeout)
+            finally:
+                self.flushing -= 1
+
+    def report_errors(self):
+        """Print background save failures not reported yet."""
+        with self.condition:
+            errors, self.errors = self.errors, []
+        for error in errors:
+            print(f"Warning: A background save failed ({error})")
+
+persistence = PersistenceWorker()
+
+class TempSessionJournal:
+    """Append-only log of session mutations on top of a compacted snapshot.
+
+    The snapshot holds the full session state tagged with a generation number;
+    the journal starts with a matching "begin" line followed by one JSON op per
+    line. Changes are found by comparing the live objects against references
+    kept at the last sync, so a turn costs one small append. Syncs run on the
+    background writer while the main thread reads, resets and removes, so
+    every operation holds the lock.
+    """
+    META_FIELDS = ("story_setting", "facts", "current_session_name",
+                   "current_session_file", "pending_system_prompt", "summary_state")
+
+    def __init__(self, snapshot_path, journal_path):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.generation = 0
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Forget what was synced; the next sync writes a fresh snapshot."""
+        with self.lock:
+            self.synced = False
+            self.synced_messages = []
+            self.synced_stacks = {"undo_stack": [], "redo_stack": []}
+            self.synced_meta = {}
+            self.journal_ops = 0
+            self.journal_bytes = 0
+
+    def current_state(self):
+        """Copy the state that the temp session persists, for the background writer.
+        
+        Message records are immutable, so the lists are copied shallowly.
+        """
+        return {
+            "messages": list(messages),
+            "undo_stack": list(undo_stack),
+            "redo_stack": list(redo_stack),
+            "story_setting": deepcopy(current_story),
+            "facts": list(current_facts),
+            "current_session_name": current_session_name,
+            "current_session_file": current_session_file,
+            "pending_system_prompt": pending_system_prompt,
+            "summary_state": deepcopy(summary_state)
+        }
+
+    def remember(self, state):
+        """Keep references to everything that was just written."""
+        self.synced_messages = [(msg, msg.get("content")) for msg in state["messages"]]
+        self.synced_stacks = {name: list(state[name]) for name in ("undo_stack", "redo_stack")}
+        self.synced_meta = {field: json.dumps(state[field], sort_keys=True, default=json_default) for field in self.META_FIELDS}
+        self.synced = True
+
+    @staticmethod
+    def common_prefix(old_refs, current, same):
+        """Length of the prefix of current that is unchanged since the last sync."""
+        keep = 0
+        for old, new in zip(old_refs, current):
+            if not same(old, new):
+                break
+            keep += 1
+        return keep
+
+    def diff(self, state):
+        """Build the journal ops that turn the synced state into state."""
+        ops = []
+        msgs = state["messages"]
+        keep = self.common_prefix(self.synced_messages, msgs,
+                                  lambda old, msg: old[0] is msg and old[1] is msg.get("content"))
+        if keep < len(self.synced_messages) or keep < len(msgs):
+            # Rewriting most of the history in the log is worse than a snapshot
+            if len(msgs) - keep > max(len(msgs) // 2, 8):
+                return None
+            ops.append({"op": "messages", "keep": keep, "append": list(msgs[keep:])})
+
+        for name in ("undo_stack", "redo_stack"):
+            old_stack = self.synced_stacks[name]
+            stack = state[name]
+            keep = self.common_prefix(old_stack, stack, lambda old, entry: old is entry)
+            if keep < len(old_stack) or keep < len(stack):
+                ops.append({"op": "stack", "name": name, "keep": keep, "append": list(stack[keep:])})
+
+        changed = {}
+        for field in self.META_FIELDS:
+            if json.dumps(state[field], sort_keys=True, default=json_default) != self.synced_meta.get(field):
+                changed[field] = state[field]
+        if changed:
+            ops.append({"op": "meta", "fields": changed})
+        return ops
+
+    def sync(self, state=None):
+        """Persist changes since the last sync, compacting when the log grows."""
+        with self.lock:
+            state = state or self.current_state()
+            ops = self.diff(state) if self.synced else None
+            if ops is None or self.journal_ops + len(ops) > TEMP_JOURNAL_COMPACT_OPS \
+                    or self.journal_bytes > TEMP_JOURNAL_COMPACT_BYTES:
+                self.compact(state)
+                return
+            if not ops:
+                return
+
+            timestamp = datetime.datetime.now().isoformat()
+            lines = "".join(json.dumps(dict(op, timestamp=timestamp), default=json_default) + "\n" for op in ops)
+            with open(self.journal_path, 'a') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_ops += len(ops)
+            self.journal_bytes += len(lines)
+            self.remember(state)
+            logging.info(f"Temporary session journaled: {len(ops)} ops, {len(lines)} bytes")
+
+    def compact(self, state=None):
+        """Write a full snapshot and start an empty journal for it."""
+        with self.lock:
+            state = state or self.current_state()
+            self.generation += 1
+            session_data = {
+                "version": SESSION_FORMAT_VERSION,
+                "generation": self.generation,
+                "timestamp": datetime.datetime.now().isoformat(),
+                # Unvalidated so journal indices line up; loading validates
+                "messages": list(state["messages"]),
+                "undo_stack": state["undo_stack"],
+                "redo_stack": state["redo_stack"]
+            }
+            for field in self.META_FIELDS:
+                session_data[field] = state[field]
+
+            write_json_atomic(self.snapshot_path, session_data)
+            # A stale journal is ignored on replay because its generation no longer matches
+            begin_line = json.dumps({"op": "begin", "generation": self.generation}) + "\n"
+            tmp_path = self.journal_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(begin_line)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.journal_path)
+
+            self.journal_ops = 0
+            self.journal_bytes = len(begin_line)
+            self.remember(state)
+            logging.info(f"Temporary session compacted: {len(session_data['messages'])} messages, generation {self.generation}")
+
+    def journal_entries(self):
+        """The journal ops in order, up to a torn final line."""
+        if not os.path.exists(self.journal_path):
+            return []
+        entries = []
+        with open(self.journal_path, 'r') as f:
+            lines = f.read().split("\n")
+        for line_number, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A torn final write from a crash; everything before it is intact
+                logging.warning(f"Temporary session journal truncated at line {line_number + 1}")
+                break
+        return entries
+
+    def read(self, loader=None):
+        """Rebuild session data from the snapshot plus the journal; None if absent.
+        
+        With a ContextWindowLoader, the messages are streamed into it instead
+        of being returned. The journal is replayed on the message list first,
+        so only the snapshot prefix it keeps is fed, then what it appended.
+        """
+        with self.lock:
+            if not os.path.exists(self.snapshot_path):
+                return None
+            entries = self.journal_entries()
+
+            def stream(entries):
+                keep = None  # Snapshot messages kept; None for all of them
+                appended = []
+                for op in entries:
+                    if op.get("op") != "messages":
+                        continue
+                    if keep is None or op["keep"] <= keep:
+                        keep, appended = op["keep"], list(op["append"])
+                    else:
+                        appended = appended[:op["keep"] - keep] + op["append"]
+                fed = 0
+
+                def add(msg):
+                    nonlocal fed
+                    if keep is None or fed < keep:
+                        loader.add(msg)
+                    fed += 1
+                with open(self.snapshot_path, 'r') as f:
+                    session_data = stream_json_session(f, add) or {}
+                loader.extend(appended)
+                return session_data
+
+            if loader is None:
+                with open(self.snapshot_path, 'r') as f:
+                    session_data = json.load(f)
+            else:
+                session_data = stream(entries)
+            generation = session_data.get("generation", 0)
+            self.generation = max(self.generation, generation)
+
+            for index, op in enumerate(entries):
+                if op.get("op") == "begin" and op.get("generation") != generation:
+                    logging.warning("Temporary session journal belongs to another snapshot; ignoring it.")
+                    if loader is not None:
+                        loader.reset()
+                        session_data = stream([])
+                    entries = entries[:index]
+                    break
+
+            for op in entries:
+                kind = op.get("op")
+                if kind == "messages" and loader is None:
+                    session_data["messages"] = session_data.get("messages", [])[:op["keep"]] + op["append"]
+                elif kind == "stack":
+                    session_data[op["name"]] = session_data.get(op["name"], [])[:op["keep"]] + op["append"]
+                elif kind == "meta":
+                    session_data.update(op["fields"])
+            logging.info(f"Temporary session replayed {len(entries)} journal entries")
+            return session_data
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path)
+
+    def remove(self, backup=False):
+        """Delete the snapshot and journal, optionally backing up the merged state."""
+        with self.lock:
+            if backup and self.exists():
+                try:
+                    # Fold the journal in first so the backup holds the latest state
+                    session_data = self.read()
+                    if session_data is not None:
+                        write_json_atomic(self.snapshot_path, session_data)
+                    create_backup(self.snapshot_path)
+                except Exception as e:
+                    logging.error(f"Error backing up temporary session: {str(e)}")
+            for path in (self.snapshot_path, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.reset()
+
+temp_journal = TempSessionJournal(os.path.join(sessions_dir, ".temp_session.json"),
+                                  os.path.join(sessions_dir, ".temp_session.jsonl"))
+
 def save_temp_session():
-    """Save current state to temporary session file with improved error handling."""
-    temp_filepath = os.path.join(sessions_dir, ".temp_session.json")
+    """Queue the changes to the temporary session for its append-only journal."""
+    persistence.report_errors()
+    state = temp_journal.current_state()
     
-    # Validate messages before saving
-    valid_messages = validate_messages(messages)
+    def write():
+        try:
+            temp_journal.sync(state)
+        except Exception:
+            # Start over from a full snapshot next time
+            temp_journal.reset()
+            raise
+        try:
+            session_catalog.note_unsaved(state["current_session_file"], len(state["messages"]))
+        except Exception as e:
+            logging.error(f"Error updating session catalog: {str(e)}")
     
-    session_data = {
-        "version": SESSION_FORMAT_VERSION,
-        "timestamp": datetime.datetime.now().isoformat(),
-        "messages": valid_messages,
-        "story_setting": current_story,
-        "facts": current_facts,
-        "undo_stack": undo_stack,
-        "redo_stack": redo_stack,
-        "current_session_name": current_session_name,
-        "current_session_file": current_session_file
-    }
+    persistence.submit("temporary session", write)
+
+def discard_temp_session(backup=False):
+    """Delete the temporary session and clear the catalog's unsaved-changes flag."""
+    temp_journal.remove(backup=backup)
+    try:
+        session_catalog.clear_unsaved()
+    except Exception as e:
+        logging.error(f"Error updating session catalog: {str(e)}")
     
+    # The memory index is read on this thread, so it is updated here
     try:
-        with open(temp_filepath, 'w') as f:
-            json.dump(session_data, f, indent=2)
-        logging.info(f"Temporary session saved: {len(valid_messages)} messages")
+        story_memory.sync(messages)
     except Exception as e:
-        logging.error(f"Error saving temporary session: {str(e)}")
-        print(f"Warning: Could not save temporary session: {str(e)}")
+        logging.error(f"Error updating story memory: {str(e)}")
 
 def load_temp_session():
-    """Load temporary session with improved validation."""
-    global messages, current_story, current_facts, undo_stack, redo_stack, current_session_name, current_session_file
-    
-    temp_filepath = os.path.join(sessions_dir, ".temp_session.json")
+    """Load temporary session by replaying its snapshot and journal."""
+    global messages, current_story, current_facts, undo_stack, redo_stack, current_session_name, current_session_file, pending_system_prompt, summary_state
     
-    if os.path.exists(temp_filepath):
+    if temp_journal.exists():
         try:
-            with open(temp_filepath, 'r') as f:
-                session_data = json.load(f)
+            loader = ContextWindowLoader(NUM_CTX, MAX_MESSAGES)
+            session_data = temp_journal.read(loader)
             
-            # Validate messages
-            loaded_messages = validate_messages(session_data.get("messages", []))
+            # Validated and de-duplicated while streaming
+            loaded_messages = loader.result()
+            if loader.invalid or loader.duplicates:
+                print(f"Note: {loader.invalid} invalid and {loader.duplicates} duplicate messages were removed.")
             if loaded_messages:
-                messages = loaded_messages
+                messages[:] = loaded_messages
             else:
                 print("Warning: No valid messages found in temporary session.")
                 return False
@@ -2303,11 +6211,17 @@ def load_temp_session():
             redo_stack = session_data.get("redo_stack", [])
             current_session_name = session_data.get("current_session_name", "default")
             current_session_file = session_data.get("current_session_file")
+            pending_system_prompt = session_data.get("pending_system_prompt")
+            summary_state = session_data.get("summary_state") or new_summary_state()
+            
+            try:
+                story_memory.load(StoryMemory.path_for(current_session_file))
+            except Exception as e:
+                logging.error(f"Error loading story memory: {str(e)}")
             
             # Make sure system prompt has facts and no duplicates
             if messages and messages[0]['role'] == 'system':
-                system_prompt = clean_system_prompt(messages[0]['content'])
-                messages[0]['content'] = append_facts_to_prompt(system_prompt)
+                messages.set_content(0, compose_system_prompt(messages[0]['content']))
             
             # Context integrity check
             if verify_context_integrity():
@@ -2318,6 +6232,9 @@ def load_temp_session():
                 if fix == 'y':
                     fix_context()
             
+            # Fold the replayed journal into a fresh snapshot
+            temp_journal.reset()
+            save_temp_session()
             return True
         
         except json.JSONDecodeError:
@@ -2347,8 +6264,10 @@ if __name__ == "__main__":
             logging.info(f"Created directory: {directory}")
 
     # Check for temp session
-    temp_filepath = os.path.join(sessions_dir, ".temp_session.json")
-    if os.path.exists(temp_filepath):
+    if not temp_journal.exists():
+        # A memory file left without its temporary session is stale
+        story_memory.reset()
+    else:
         try:
             choice = input("Found an unsaved session. Load it? (y/n): ").lower()
             if choice == 'y':
@@ -2356,16 +6275,19 @@ if __name__ == "__main__":
                     print("Temporary session loaded.")
                 else:
                     print("Could not load temporary session. Starting fresh.")
-                    os.remove(temp_filepath)
+                    discard_temp_session()
+                    story_memory.reset()
             else:
                 # Backup temp file before removing
-                create_backup(temp_filepath)
-                os.remove(temp_filepath)
+                discard_temp_session(backup=True)
+                story_memory.reset()
                 print("Temporary session discarded.")
         except KeyboardInterrupt:
             print("\nStarting fresh session.")
-            create_backup(temp_filepath)
-            os.remove(temp_filepath)
+            discard_temp_session(backup=True)
+            story_memory.reset()
+
+    recover_partial_response()
 
     try:
         chat_with_model()
@@ -2373,17 +6295,22 @@ if __name__ == "__main__":
         logging.critical(f"Critical error: {str(e)}")
         print(f"A critical error occurred: {str(e)}")
         
+        # Let queued saves finish before writing the emergency backup
+        try:
+            persistence.flush(PERSIST_FLUSH_TIMEOUT)
+        except Exception as flush_error:
+            logging.error(f"Error flushing pending saves: {str(flush_error)}")
+        
         # Create emergency backup
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         emergency_filepath = os.path.join(backup_dir, f"emergency_backup_{timestamp}.json")
         try:
-            with open(emergency_filepath, 'w') as f:
-                json.dump({
-                    "messages": messages,
-                    "story_setting": current_story,
-                    "facts": current_facts,
-                    "error": str(e)
-                }, f, indent=2)
+            write_json_atomic(emergency_filepath, {
+                "messages": messages,
+                "story_setting": current_story,
+                "facts": current_facts,
+                "error": str(e)
+            })
             print(f"Emergency backup created at: {emergency_filepath}")
         except:
             print("Could not create emergency backup.")